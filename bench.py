@@ -0,0 +1,284 @@
+""" bench.py
+Synthesis/timing benchmarks for individual modules and the whole core.
+
+Each module is synthesized with Yosys and placed/routed with nextpnr for an
+iCE40 or ECP5 target. We record LUT/FF/BRAM usage and the worst-path delay
+(and corresponding Fmax) for each module, for each configuration of
+'RVREParams' listed in CONFIGS, and compare the results against a stored
+baseline.
+
+Usage:
+
+    python bench.py [--target ice40|ecp5] [--save-baseline] [--tolerance 5]
+
+NOTE: Constants like 'PhysReg' are computed from 'PARAM' when 'rvre.common' is
+first imported, so each configuration is elaborated in a separate process.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BASELINE_FILE = "bench/baseline.json"
+
+# Configurations of 'RVREParams' to benchmark
+CONFIGS = {
+    "default": {},
+    "prf48":   { "prf_size": 48 },
+    "prf128":  { "prf_size": 128 },
+    "rvc":     { "rvc": True },
+    "capture": { "operand_capture": True },
+    "smt":     { "smt_threads": 2, "prf_size": 128 },
+    "prefetch": { "l1i_prefetch": True, "l1d_prefetch": True },
+}
+
+# Yosys cell types counted for each kind of resource
+TARGETS = {
+    "ice40": {
+        "synth":   "synth_ice40",
+        "nextpnr": [ "nextpnr-ice40", "--hx8k", "--package", "ct256" ],
+        "lut":     ("SB_LUT4",),
+        "ff":      ("SB_DFF",),
+        "bram":    ("SB_RAM40_4K",),
+    },
+    "ecp5": {
+        "synth":   "synth_ecp5",
+        "nextpnr": [ "nextpnr-ecp5", "--45k", "--package", "CABGA381" ],
+        "lut":     ("LUT4",),
+        "ff":      ("TRELLIS_FF",),
+        "bram":    ("DP16KD",),
+    },
+}
+
+# Metrics where a larger number is worse
+LARGER_IS_WORSE = ("lut", "ff", "bram", "delay_ns")
+
+
+def modules():
+    """ Map from a module name to a function that builds the module. """
+    from rvre.core import RVRECore
+    from rvre.cam import CAM
+    from rvre.decode import DecodeUnit
+    from rvre.rename import RegisterAliasTable, RegisterBusyTable
+    from rvre.rename import RegisterFreeTable
+    from rvre.rf import PhysicalRegisterFile
+    from rvre.alu import ALU
+    from rvre.lsu import StoreSetPredictor, LoadQueue, LoadHitPredictor
+    from rvre.issue import IssueUnit, DistributedIssueUnit
+    from rvre.fetch import FetchAligner, ICountSelect
+    from rvre.rvc import CompressedExpander
+    from rvre.cache import L1Cache, L2Cache, CoherencePort
+    from rvre.prefetch import NextLinePrefetcher, StridePrefetcher
+    from amaranth.hdl.rec import Record
+    from rvre.param import PARAM
+    return {
+        "CAM":                lambda: CAM(32, 32),
+        "DecodeUnit":         lambda: DecodeUnit(),
+        "FetchAligner":       lambda: FetchAligner(),
+        "ICountSelect":       lambda: ICountSelect(max(PARAM.smt_threads, 2), 3),
+        "CompressedExpander": lambda: CompressedExpander(),
+        "ALU":                lambda: ALU(),
+        "RegisterAliasTable":
+            lambda: RegisterAliasTable(PARAM.arf_size, PARAM.prf_size),
+        "RegisterBusyTable":  lambda: RegisterBusyTable(PARAM.prf_size),
+        "RegisterFreeTable":
+            lambda: RegisterFreeTable(PARAM.prf_size, PARAM.arf_size),
+        # Operands are read at dispatch with 'operand_capture' (otherwise, 
+        # after issue from each of the distributed reservation stations)
+        "PhysicalRegisterFile": lambda: PhysicalRegisterFile(PARAM.prf_size,
+            2 if PARAM.operand_capture else 2 * (PARAM.rs_alu_count + 2)),
+        "StoreSetPredictor":  lambda: StoreSetPredictor(PARAM.ssit_size, 
+            PARAM.lfst_size, PARAM.ssit_clear_interval),
+        "LoadQueue":          lambda: LoadQueue(PARAM.lq_size),
+        "LoadHitPredictor":   lambda: LoadHitPredictor(PARAM.lhp_size,
+            PARAM.l1_hit_latency, PARAM.spec_load_slots),
+        "IssueUnit":          lambda: IssueUnit(PARAM.iq_size),
+        "DistributedIssueUnit": lambda: DistributedIssueUnit(
+            PARAM.rs_alu_count, PARAM.rs_alu_size, PARAM.rs_bru_size,
+            PARAM.rs_lsu_size),
+        "NextLinePrefetcher": lambda: NextLinePrefetcher(PARAM.line_words,
+            PARAM.pf_degree, PARAM.pf_distance, PARAM.pf_interval),
+        "StridePrefetcher":   lambda: StridePrefetcher(PARAM.rpt_size,
+            PARAM.pf_degree, PARAM.pf_distance, PARAM.pf_interval),
+        "L1Cache":            lambda: L1Cache(PARAM.l1d_lines, 
+            PARAM.line_words, StridePrefetcher(PARAM.rpt_size, 
+                PARAM.pf_degree, PARAM.pf_distance, PARAM.pf_interval)
+            if PARAM.l1d_prefetch else None),
+        "L2Cache":            lambda: L2Cache(PARAM.l2_lines, 
+            PARAM.line_words, [ Record(CoherencePort(32 * PARAM.line_words))
+                                for _ in range(2 * PARAM.cores) ]),
+        "RVRECore":           lambda: RVRECore(),
+    }
+
+
+def registered(factory):
+    """ Wrap a module so that all of its ports are registered.
+    This gives purely-combinational modules (like 'DecodeUnit') a clock
+    domain, so that their worst path shows up as a register-to-register path
+    in the timing report.
+    """
+    from amaranth import Module, Signal
+    from amaranth.hdl.ir import Fragment
+
+    # Elaborate a throwaway instance to find the direction of each port
+    probe = factory()
+    frag  = Fragment.get(probe, None).prepare(ports=probe.ports())
+    dirs  = [ frag.ports[p] for p in probe.ports() ]
+
+    dut = factory()
+    m = Module()
+    m.submodules.dut = dut
+    top_ports = []
+    for idx, (port, direction) in enumerate(zip(dut.ports(), dirs)):
+        if direction == "i":
+            pin = Signal.like(port, name="in{}".format(idx))
+            m.d.sync += port.eq(pin)
+        else:
+            pin = Signal.like(port, name="out{}".format(idx))
+            m.d.sync += pin.eq(port)
+        top_ports.append(pin)
+    return m, top_ports
+
+
+def synthesize(name, target, workdir):
+    """ Synthesize and place/route a single module, returning its metrics. """
+    from amaranth.back import verilog
+
+    cfg = TARGETS[target]
+    m, ports = registered(modules()[name])
+    v_file    = os.path.join(workdir, name + ".v")
+    json_file = os.path.join(workdir, name + ".json")
+    stat_file = os.path.join(workdir, name + ".stat.json")
+    rpt_file  = os.path.join(workdir, name + ".report.json")
+
+    with open(v_file, "w") as f:
+        f.write(verilog.convert(m, name=name, ports=ports))
+
+    subprocess.run([ "yosys", "-q", "-p", "; ".join([
+        "read_verilog {}".format(v_file),
+        "{} -top {} -json {}".format(cfg["synth"], name, json_file),
+        "tee -q -o {} stat -json".format(stat_file),
+    ])], check=True)
+    subprocess.run(cfg["nextpnr"] + [
+        "--json", json_file, "--report", rpt_file, "--quiet",
+    ], check=True)
+
+    with open(stat_file) as f:
+        cells = json.load(f)["design"]["num_cells_by_type"]
+    with open(rpt_file) as f:
+        fmax = json.load(f)["fmax"]
+
+    def count(kinds):
+        return sum(n for cell, n in cells.items()
+                   if any(cell.startswith(k) for k in kinds))
+
+    # NOTE: The wrapper only has a single clock domain
+    achieved = min(clk["achieved"] for clk in fmax.values())
+    return {
+        "lut":      count(cfg["lut"]),
+        "ff":       count(cfg["ff"]),
+        "bram":     count(cfg["bram"]),
+        "fmax_mhz": round(achieved, 2),
+        "delay_ns": round(1000.0 / achieved, 3),
+    }
+
+
+def run_worker(config, target):
+    """ Benchmark all modules for a single configuration. """
+    import rvre.param
+    rvre.param.PARAM = rvre.param.RVREParams(**CONFIGS[config])
+
+    res = {}
+    with tempfile.TemporaryDirectory(prefix="rvre-bench-") as workdir:
+        for name in modules():
+            res[name] = synthesize(name, target, workdir)
+    json.dump(res, sys.stdout)
+
+
+def run_config(config, target):
+    """ Benchmark a configuration in a fresh interpreter. """
+    out = subprocess.run([
+        sys.executable, __file__, "--worker", config, "--target", target
+    ], check=True, stdout=subprocess.PIPE)
+    return json.loads(out.stdout)
+
+
+def compare(results, baseline, tolerance):
+    """ Return a list of regressions (relative to the baseline) that are
+    larger than 'tolerance' percent.
+    """
+    regressions = []
+    for config, mods in results.items():
+        for name, metrics in mods.items():
+            base = baseline.get(config, {}).get(name)
+            if base is None:
+                continue
+            for key in LARGER_IS_WORSE:
+                old, new = base[key], metrics[key]
+                limit = old * (1.0 + tolerance / 100.0)
+                if new > limit:
+                    regressions.append((config, name, key, old, new))
+    return regressions
+
+
+def report(results):
+    fmt = "{:<8} {:<20} {:>6} {:>6} {:>5} {:>9} {:>9}"
+    print(fmt.format("config", "module", "LUT", "FF", "BRAM",
+                     "Fmax/MHz", "delay/ns"))
+    for config, mods in results.items():
+        for name, r in mods.items():
+            print(fmt.format(config, name, r["lut"], r["ff"], r["bram"],
+                             r["fmax_mhz"], r["delay_ns"]))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--target", choices=TARGETS.keys(), default="ice40")
+    ap.add_argument("--config", action="append", choices=CONFIGS.keys(),
+                    help="Only benchmark these configurations")
+    ap.add_argument("--baseline", default=BASELINE_FILE)
+    ap.add_argument("--save-baseline", action="store_true",
+                    help="Overwrite the baseline with these results")
+    ap.add_argument("--tolerance", type=float, default=5.0,
+                    help="Allowed regression (in percent)")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.target)
+        sys.exit(0)
+
+    for tool in ("yosys", TARGETS[args.target]["nextpnr"][0]):
+        if shutil.which(tool) is None:
+            sys.exit("Can't find '{}' in PATH".format(tool))
+
+    baseline_path = args.baseline.replace(".json",
+                                          "-{}.json".format(args.target))
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = {
+        config: run_config(config, args.target)
+        for config in (args.config or CONFIGS.keys())
+    }
+    report(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        baseline.update(results)
+        with open(baseline_path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(baseline_path))
+        sys.exit(0)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for config, name, key, old, new in regressions:
+        print("REGRESSION: [{}] {}: {} {} -> {}".format(
+            config, name, key, old, new))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,15 @@
+# Taken-branch loop: a tight loop with a taken branch every other 
+# instruction.
+# Per iteration: 2 instructions (1 ALU, 1 taken branch).
+
+	.equ ITERS, 1000
+
+	.text
+	.globl _start
+_start:
+	li   x7, ITERS
+loop:
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
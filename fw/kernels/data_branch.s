@@ -0,0 +1,29 @@
+# Data-dependent branches: branch on the low bit of a xorshift32 sequence.
+# The branch is taken about half of the time (in a pattern that a branch 
+# predictor shouldn't be able to learn).
+# Per iteration (on average): 10.5 instructions (8.5 ALU, 2 branches, 1.5 
+# taken, 0.5 mispredicted), and a 6-cycle loop-carried chain through x5.
+
+	.equ ITERS, 1000
+
+	.text
+	.globl _start
+_start:
+	li   x5, 0x2545f491
+	li   x7, ITERS
+	li   x8, 0
+loop:
+	slli x6, x5, 13
+	xor  x5, x5, x6
+	srli x6, x5, 17
+	xor  x5, x5, x6
+	slli x6, x5, 5
+	xor  x5, x5, x6
+	andi x6, x5, 1
+	beqz x6, skip
+	addi x8, x8, 1
+skip:
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
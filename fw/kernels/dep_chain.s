@@ -0,0 +1,20 @@
+# Long dependency chain: each 'add' depends on the one before it.
+# Per iteration: 18 instructions (17 ALU, 1 taken branch), and a 16-cycle
+# loop-carried chain through x5.
+
+	.equ ITERS, 1000
+
+	.text
+	.globl _start
+_start:
+	li   x5, 0
+	li   x6, 1
+	li   x7, ITERS
+loop:
+	.rept 16
+	add  x5, x5, x6
+	.endr
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
@@ -0,0 +1,21 @@
+# Independent ALU streams: eight separate accumulators.
+# Per iteration: 18 instructions (17 ALU, 1 taken branch), and a 2-cycle 
+# loop-carried chain through each accumulator.
+
+	.equ ITERS, 1000
+
+	.text
+	.globl _start
+_start:
+	li   x6, 1
+	li   x7, ITERS
+loop:
+	.rept 2
+	.irp r, 8, 9, 10, 11, 12, 13, 14, 15
+	add  x\r, x\r, x6
+	.endr
+	.endr
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
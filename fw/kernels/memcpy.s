@@ -0,0 +1,29 @@
+# Copy a block of memory, four words at a time.
+# Per iteration: 12 instructions (3 ALU, 4 loads, 4 stores, 1 taken 
+# branch), and a 1-cycle loop-carried chain through the pointers.
+
+	.equ SRC,   0x00010000
+	.equ DST,   0x00014000
+	.equ WORDS, 4096
+
+	.text
+	.globl _start
+_start:
+	li   x5, SRC
+	li   x6, DST
+	li   x7, WORDS / 4
+loop:
+	lw   x8,  0(x5)
+	lw   x9,  4(x5)
+	lw   x10, 8(x5)
+	lw   x11, 12(x5)
+	sw   x8,  0(x6)
+	sw   x9,  4(x6)
+	sw   x10, 8(x6)
+	sw   x11, 12(x6)
+	addi x5, x5, 16
+	addi x6, x6, 16
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
@@ -0,0 +1,34 @@
+# Pointer chasing: walk a ring of linked nodes, where the address of each 
+# load depends on the result of the previous load.
+# Per iteration: 10 instructions (1 ALU, 8 loads, 1 taken branch), and 
+# a loop-carried chain of 8 loads through x5.
+
+	.equ ITERS,  1000
+	.equ DATA,   0x00010000
+	.equ NODES,  64
+	.equ STRIDE, 64
+
+	.text
+	.globl _start
+_start:
+	# Each node points to the next one, and the last points to the first
+	li   x5, DATA
+	li   x6, NODES
+	mv   x8, x5
+init:
+	addi x9, x8, STRIDE
+	sw   x9, 0(x8)
+	mv   x8, x9
+	addi x6, x6, -1
+	bnez x6, init
+	sw   x5, -STRIDE(x8)
+
+	li   x7, ITERS
+loop:
+	.rept 8
+	lw   x5, 0(x5)
+	.endr
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
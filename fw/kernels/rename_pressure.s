@@ -0,0 +1,30 @@
+# Rename pressure: a chain of dependent loads holds up retirement while 
+# more than 'prf_size' (with the default parameters) independent values are
+# written, so we run out of physical registers before the chain completes.
+# Per iteration: 98 instructions (73 ALU, 24 loads, 1 taken branch), and 
+# a loop-carried chain of 24 loads through x5.
+
+	.equ ITERS, 100
+	.equ DATA,  0x00010000
+
+	.text
+	.globl _start
+_start:
+	# A single node that points to itself
+	li   x5, DATA
+	sw   x5, 0(x5)
+
+	li   x7, ITERS
+loop:
+	.rept 24
+	lw   x5, 0(x5)
+	.endr
+	.rept 9
+	.irp r, 8, 9, 10, 11, 12, 13, 14, 15
+	addi x\r, x0, 1
+	.endr
+	.endr
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
@@ -0,0 +1,22 @@
+# Store-to-load forwarding: each load reads the value written by the store 
+# just before it, and the next store depends on the load.
+# Per iteration: 5 instructions (2 ALU, 1 store, 1 load, 1 taken branch), 
+# and a loop-carried chain through memory (store, load, and 'addi').
+
+	.equ ITERS, 1000
+	.equ DATA,  0x00010000
+
+	.text
+	.globl _start
+_start:
+	li   x5, 0
+	li   x8, DATA
+	li   x7, ITERS
+loop:
+	sw   x5, 0(x8)
+	lw   x6, 0(x8)
+	addi x5, x6, 1
+	addi x7, x7, -1
+	bnez x7, loop
+done:
+	j    done
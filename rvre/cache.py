@@ -0,0 +1,619 @@
+""" cache.py
+Private L1 caches, and a shared L2 cache with a coherence directory.
+"""
+
+from enum import Enum, unique
+from math import ceil, log2
+
+from amaranth import *
+from amaranth.hdl.rec import *
+from amaranth.lib.coding import PriorityEncoder
+
+from .mem import *
+from .prefetch import *
+
+__all__ = [
+    "CohOp", "SnoopOp", "LineState", "CoherencePort",
+    "L1Cache", "L2Cache",
+]
+
+@unique
+class CohOp(Enum):
+    """ Request from a private cache to the directory.
+    """
+    GETS = 0b00 # Get a read-only copy of a line
+    GETM = 0b01 # Get a writable copy of a line
+    PUTM = 0b10 # Write back a modified line (when it's evicted)
+
+@unique
+class SnoopOp(Enum):
+    """ Request from the directory to a private cache.
+    """
+    INV  = 0b0 # Invalidate a line
+    DOWN = 0b1 # Downgrade a modified line to shared
+
+@unique
+class LineState(Enum):
+    """ State of a line in a private cache (MSI).
+    """
+    I = 0b00
+    S = 0b01
+    M = 0b10
+
+
+class CoherencePort(Layout):
+    """ Connection between a private cache and the directory.
+    Addresses are byte addresses of the first word in a line.
+
+    'req': Request to the directory (held until 'resp' is asserted).
+        'req_data' is the line written back by PUTM.
+    'resp': The request was completed ('resp_data' is the line for GETS/GETM)
+    'snp': Snoop from the directory (held until 'snp_ack' is asserted).
+    'snp_ack': Response to a snoop. 'snp_dirty' is asserted when the line was
+        modified (and 'snp_data' holds the modified line).
+    """
+    def __init__(self, line_bits):
+        super().__init__([
+            ("req",       1),
+            ("req_op",    CohOp),
+            ("req_addr",  32),
+            ("req_data",  line_bits),
+            ("resp",      1),
+            ("resp_data", line_bits),
+            ("snp",       1),
+            ("snp_op",    SnoopOp),
+            ("snp_addr",  32),
+            ("snp_ack",   1),
+            ("snp_dirty", 1),
+            ("snp_data",  line_bits),
+        ])
+
+
+class _Geometry:
+    """ Splits addresses for a direct-mapped cache with 'num_lines' lines of
+    'line_words' words each.
+    """
+    def __init__(self, num_lines, line_words):
+        self.num_lines  = num_lines
+        self.line_words = line_words
+        self.line_bits  = 32 * line_words
+        self.off_bits   = ceil(log2(line_words))
+        self.idx_bits   = ceil(log2(num_lines))
+        self.tag_bits   = 32 - 2 - self.off_bits - self.idx_bits
+
+    def _split(self, addr):
+        """ Split an address into (tag, index, offset) """
+        off = addr[2:2 + self.off_bits]
+        idx = addr[2 + self.off_bits:2 + self.off_bits + self.idx_bits]
+        tag = addr[2 + self.off_bits + self.idx_bits:]
+        return tag, idx, off
+
+    def _line_addr(self, tag, idx):
+        """ Address of the first word in a line """
+        return Cat(C(0, 2 + self.off_bits), idx, tag)
+
+
+class L1Cache(Elaboratable, _Geometry):
+    """ Private, direct-mapped, write-back L1 cache.
+    Lines are kept coherent with other private caches by the directory in
+    the L2 (see 'L2Cache').
+
+    An access is resolved on the cycle after it's sent. Misses are not
+    waited for: the requester must retry the access later (like replayed
+    loads). Only one line is filled at a time: an access that misses starts
+    a fill if the cache is idle, and accesses to the line being replaced 
+    are rejected until the fill is complete. All accesses are rejected while
+    a snoop is being handled.
+
+    Lines can also be filled by a 'prefetcher' (see 'prefetch.py'), which is 
+    trained on every completed access. Prefetched lines are never allowed 
+    to replace a modified line.
+
+    'i_en': Start an access
+    'i_we': The access is a write (of the bytes in 'i_sel')
+    'i_addr'/'i_data'/'i_sel': Address, write data and byte-enables
+    'i_pc': Address of the instruction making the access (only used to 
+        train the prefetcher)
+    'o_vld': The access from the previous cycle has completed (for reads,
+        the data is in 'o_data')
+    'o_data': Data read by the access from the previous cycle
+
+    'o_hit': An access was completed
+    'o_miss': A fill was started
+    'o_snoop': A line was invalidated/downgraded by a snoop
+    'o_prefetch': A fill was started by the prefetcher
+    'o_useful': A prefetched line was used for the first time
+
+    'port': Connection to the directory (see 'CoherencePort')
+    """
+    def __init__(self, num_lines, line_words, prefetcher=None):
+        _Geometry.__init__(self, num_lines, line_words)
+        self.prefetcher = prefetcher
+
+        self.data = Memory(width=self.line_bits, depth=num_lines)
+        self.line_tag = Array(Signal(self.tag_bits, name="line{}_tag".format(i))
+                              for i in range(num_lines))
+        self.line_state = Array(Signal(LineState, name="line{}_state".format(i))
+                                for i in range(num_lines))
+        # The line was prefetched, and hasn't been used yet
+        self.line_pf = Array(Signal(name="line{}_pf".format(i))
+                             for i in range(num_lines))
+
+        self.i_en    = Signal()
+        self.i_we    = Signal()
+        self.i_addr  = Signal(32)
+        self.i_data  = Signal(32)
+        self.i_sel   = Signal(4, reset=0b1111)
+        self.i_pc    = Signal(32)
+        self.o_vld   = Signal()
+        self.o_data  = Signal(32)
+
+        self.o_hit   = Signal()
+        self.o_miss  = Signal()
+        self.o_snoop = Signal()
+        self.o_prefetch = Signal()
+        self.o_useful   = Signal()
+
+        self.port = Record(CoherencePort(self.line_bits))
+
+        # Access from the previous cycle
+        self.r_req  = Signal()
+        self.r_we   = Signal()
+        self.r_addr = Signal(32)
+        self.r_data = Signal(32)
+        self.r_sel  = Signal(4)
+        self.r_pc   = Signal(32)
+
+        # Outstanding request to the directory (and whether it's a prefetch)
+        self.r_pf      = Signal()
+        self.r_op      = Signal(CohOp)
+        self.r_addr_l2 = Signal(32)
+        self.r_wb_addr = Signal(32)
+        self.r_wb_data = Signal(self.line_bits)
+
+        # A snoop is being handled
+        self.r_snp_act = Signal()
+
+    def ports(self):
+        return [
+            self.i_en, self.i_we, self.i_addr, self.i_data, self.i_sel,
+            self.i_pc, self.o_vld, self.o_data, self.o_hit, self.o_miss, 
+            self.o_snoop, self.o_prefetch, self.o_useful,
+            *self.port.fields.values(),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rp  = rp  = self.data.read_port()
+        m.submodules.srp = srp = self.data.read_port(transparent=False)
+        m.submodules.wp  = wp  = self.data.write_port(granularity=8)
+
+        port = self.port
+        # NOTE: Left undriven without a prefetcher
+        pf = (self.prefetcher.port if self.prefetcher is not None 
+              else Record(PrefetchPort()))
+
+        m.d.sync += [
+            self.r_req.eq(self.i_en),
+            self.r_we.eq(self.i_we),
+            self.r_addr.eq(self.i_addr),
+            self.r_data.eq(self.i_data),
+            self.r_sel.eq(self.i_sel),
+            self.r_pc.eq(self.i_pc),
+        ]
+        _, i_idx, _ = self._split(self.i_addr)
+        m.d.comb += rp.addr.eq(i_idx)
+
+        # Resolve the access from the previous cycle
+        tag, idx, off = self._split(self.r_addr)
+        state   = self.line_state[idx]
+        present = Signal()
+        hit     = Signal()
+        blocked = Signal()
+        snp_blocked  = Signal()
+        fill_blocked = Signal()
+        snp_start = Signal()
+        m.d.comb += [
+            blocked.eq(snp_blocked | fill_blocked),
+            present.eq((self.line_tag[idx] == tag) & (state != LineState.I)),
+            hit.eq(present & (~self.r_we | (state == LineState.M))),
+            self.o_vld.eq(self.r_req & hit & ~blocked),
+            self.o_hit.eq(self.o_vld),
+            self.o_data.eq(rp.data.word_select(off, 32)),
+        ]
+        with m.If(self.o_vld & self.r_we):
+            m.d.comb += [
+                wp.addr.eq(idx),
+                wp.data.eq(Repl(self.r_data, self.line_words)),
+                wp.en.eq(self.r_sel << (off * 4)),
+            ]
+        with m.If(self.o_vld & self.line_pf[idx]):
+            m.d.comb += self.o_useful.eq(1)
+            m.d.sync += self.line_pf[idx].eq(0)
+
+        # Handle snoops from the directory
+        stag, sidx, _ = self._split(port.snp_addr)
+        sstate = self.line_state[sidx]
+        spresent = Signal()
+        m.d.comb += [
+            srp.addr.eq(sidx),
+            snp_start.eq(port.snp & ~self.r_snp_act & ~port.resp),
+            snp_blocked.eq(snp_start | self.r_snp_act),
+            spresent.eq((self.line_tag[sidx] == stag) &
+                        (sstate != LineState.I)),
+        ]
+        with m.If(self.r_snp_act):
+            m.d.comb += [
+                port.snp_ack.eq(1),
+                port.snp_dirty.eq(spresent & (sstate == LineState.M)),
+                port.snp_data.eq(srp.data),
+                self.o_snoop.eq(spresent),
+            ]
+            m.d.sync += self.r_snp_act.eq(0)
+            with m.If(spresent):
+                with m.If(port.snp_op == SnoopOp.INV):
+                    m.d.sync += sstate.eq(LineState.I)
+                with m.Else():
+                    m.d.sync += sstate.eq(LineState.S)
+        with m.Elif(snp_start):
+            m.d.sync += self.r_snp_act.eq(1)
+
+        # Fill from the directory, writing back the victim line first if
+        # it was modified
+        ftag, fidx, _ = self._split(self.r_addr_l2)
+        m.d.comb += [
+            port.req_op.eq(self.r_op),
+            port.req_addr.eq(self.r_addr_l2),
+            port.req_data.eq(self.r_wb_data),
+        ]
+
+        # Prefetch requests
+        ptag, pidx, _ = self._split(pf.pf_addr)
+        pstate = self.line_state[pidx]
+        if self.prefetcher is not None:
+            m.submodules.pf = self.prefetcher
+            m.d.comb += [
+                pf.train.eq(self.o_vld),
+                pf.train_pc.eq(self.r_pc),
+                pf.train_addr.eq(self.r_addr),
+                pf.issued.eq(self.o_prefetch),
+                pf.useful.eq(self.o_useful),
+            ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.r_req & ~hit & ~blocked):
+                    m.d.comb += self.o_miss.eq(1)
+                    m.d.sync += [
+                        self.r_pf.eq(0),
+                        self.r_op.eq(Mux(self.r_we, CohOp.GETM, CohOp.GETS)),
+                        self.r_addr_l2.eq(self._line_addr(tag, idx)),
+                    ]
+                    with m.If(~present & (state == LineState.M)):
+                        m.d.sync += [
+                            self.r_wb_addr.eq(
+                                self._line_addr(self.line_tag[idx], idx)),
+                            self.r_wb_data.eq(rp.data),
+                        ]
+                        m.next = "WB"
+                    with m.Else():
+                        m.next = "REQ"
+                # Drop prefetches for lines that are already present (or 
+                # which would replace a modified line)
+                with m.Elif(pf.pf):
+                    m.d.comb += pf.pf_ready.eq(1)
+                    with m.If(pstate == LineState.I):
+                        m.d.comb += self.o_prefetch.eq(1)
+                    with m.Elif((self.line_tag[pidx] != ptag) & 
+                                (pstate == LineState.S)):
+                        m.d.comb += self.o_prefetch.eq(1)
+                    with m.If(self.o_prefetch):
+                        m.d.sync += [
+                            self.r_pf.eq(1),
+                            self.r_op.eq(CohOp.GETS),
+                            self.r_addr_l2.eq(self._line_addr(ptag, pidx)),
+                        ]
+                        m.next = "REQ"
+            with m.State("WB"):
+                m.d.comb += [
+                    fill_blocked.eq(idx == fidx),
+                    port.req.eq(1),
+                    port.req_op.eq(CohOp.PUTM),
+                    port.req_addr.eq(self.r_wb_addr),
+                ]
+                with m.If(port.resp):
+                    _, widx, _ = self._split(self.r_wb_addr)
+                    m.d.sync += self.line_state[widx].eq(LineState.I)
+                    m.next = "REQ"
+            with m.State("REQ"):
+                m.d.comb += [
+                    fill_blocked.eq((idx == fidx) | port.resp),
+                    port.req.eq(1),
+                ]
+                with m.If(port.resp):
+                    m.d.comb += [
+                        wp.addr.eq(fidx),
+                        wp.data.eq(port.resp_data),
+                        wp.en.eq(Repl(1, len(wp.en))),
+                    ]
+                    m.d.sync += [
+                        self.line_tag[fidx].eq(ftag),
+                        self.line_state[fidx].eq(Mux(
+                            self.r_op == CohOp.GETM, LineState.M, LineState.S
+                        )),
+                        self.line_pf[fidx].eq(self.r_pf),
+                    ]
+                    m.next = "FILLED"
+            # The access that was sent during the fill read the old line
+            with m.State("FILLED"):
+                m.d.comb += fill_blocked.eq(idx == fidx)
+                m.next = "IDLE"
+
+        return m
+
+
+class L2Cache(Elaboratable, _Geometry):
+    """ Shared, direct-mapped, inclusive L2 cache, with a directory that
+    keeps the private caches coherent (MSI).
+
+    For each line, the directory keeps a mask of the private caches that
+    may have a copy ('sharers'), and whether the line is modified in one of
+    them ('owned', in which case there's exactly one sharer). Private caches
+    can drop unmodified lines without telling the directory, so the mask
+    may be larger than necessary.
+
+    Requests are handled one at a time (round-robin between the private
+    caches). Lines evicted from the L2 are invalidated in all private caches
+    first, and modified lines are written back to memory over 'bus'.
+
+    'coh': Connection to each private cache (see 'CoherencePort')
+    'bus': Wishbone bus to the backing memory
+    'o_hit': A request hit in the L2
+    'o_miss': A request missed in the L2 (and the line is being filled)
+    """
+    def __init__(self, num_lines, line_words, ports):
+        _Geometry.__init__(self, num_lines, line_words)
+        self.agents = len(ports)
+        self.coh    = ports
+        self.bus    = Record(WishboneBus())
+        self.o_hit  = Signal()
+        self.o_miss = Signal()
+
+        self.data = Memory(width=self.line_bits, depth=num_lines)
+        self.line_vld   = Array(Signal(name="line{}_vld".format(i))
+                                for i in range(num_lines))
+        self.line_tag   = Array(Signal(self.tag_bits,
+                                       name="line{}_tag".format(i))
+                                for i in range(num_lines))
+        self.line_dirty = Array(Signal(name="line{}_dirty".format(i))
+                                for i in range(num_lines))
+        self.line_owned = Array(Signal(name="line{}_owned".format(i))
+                                for i in range(num_lines))
+        self.line_sharers = Array(Signal(self.agents,
+                                         name="line{}_sharers".format(i))
+                                  for i in range(num_lines))
+
+        # Request being handled
+        self.r_agent = Signal(range(self.agents))
+        self.r_last  = Signal(range(self.agents), reset=self.agents - 1)
+        self.r_op    = Signal(CohOp)
+        self.r_addr  = Signal(32)
+        self.r_data  = Signal(self.line_bits)
+        # Line being handled, and the address of the victim line
+        self.r_buf   = Signal(self.line_bits)
+        self.r_vaddr = Signal(32)
+        # Word being transferred over the bus
+        self.r_word  = Signal(range(line_words))
+
+        # Outstanding snoops, and whether a snoop returned modified data
+        self.r_snp      = Signal(self.agents)
+        self.r_snp_op   = Signal(SnoopOp)
+        self.r_snp_addr = Signal(32)
+        self.r_snp_dirty = Signal()
+
+        self.enc = PriorityEncoder(2 * self.agents)
+
+    def ports(self):
+        return [
+            *self.bus.fields.values(), self.o_hit, self.o_miss,
+            *[ f for p in self.coh for f in p.fields.values() ],
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rp  = rp  = self.data.read_port(transparent=False)
+        m.submodules.wp  = wp  = self.data.write_port()
+        m.submodules.enc = enc = self.enc
+
+        n   = self.agents
+        bus = self.bus
+        bit = Signal(n)
+        m.d.comb += bit.eq(1 << self.r_agent)
+
+        tag, idx, _ = self._split(self.r_addr)
+        sharers = self.line_sharers[idx]
+        others  = Signal(n)
+        hit     = Signal()
+        m.d.comb += [
+            rp.addr.eq(idx),
+            wp.addr.eq(idx),
+            wp.data.eq(self.r_buf),
+            others.eq(sharers & ~bit),
+            hit.eq(self.line_vld[idx] & (self.line_tag[idx] == tag)),
+        ]
+
+        # Round-robin arbitration, starting after the last agent that was
+        # chosen
+        reqs  = Signal(n)
+        after = Signal(n)
+        grant = Signal(range(n))
+        m.d.comb += reqs.eq(Cat(p.req for p in self.coh))
+        for i in range(n):
+            m.d.comb += after[i].eq(reqs[i] & (self.r_last < i))
+        m.d.comb += [
+            enc.i.eq(Cat(after, reqs)),
+            grant.eq(Mux(enc.o >= n, enc.o - n, enc.o)),
+        ]
+        gport = Array(self.coh)[grant]
+
+        # Snoops and responses to the private caches
+        acks = Signal(n)
+        m.d.comb += acks.eq(Cat(p.snp_ack for p in self.coh))
+        for i, p in enumerate(self.coh):
+            m.d.comb += [
+                p.snp.eq(self.r_snp[i]),
+                p.snp_op.eq(self.r_snp_op),
+                p.snp_addr.eq(self.r_snp_addr),
+                p.resp_data.eq(self.r_buf),
+            ]
+            with m.If(p.snp_ack & p.snp_dirty):
+                m.d.sync += [
+                    self.r_buf.eq(p.snp_data),
+                    self.r_snp_dirty.eq(1),
+                ]
+        snp_done = Signal()
+        m.d.comb += snp_done.eq((self.r_snp & ~acks) == 0)
+        m.d.sync += self.r_snp.eq(self.r_snp & ~acks)
+
+        def snoop(op, addr, mask):
+            m.d.sync += [
+                self.r_snp.eq(mask),
+                self.r_snp_op.eq(op),
+                self.r_snp_addr.eq(addr),
+            ]
+
+        # Accesses to memory, one word at a time
+        m.d.comb += [
+            bus.sel.eq(0b1111),
+            bus.dat_w.eq(self.r_buf.word_select(self.r_word, 32)),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(~enc.n):
+                    m.d.sync += [
+                        self.r_agent.eq(grant),
+                        self.r_last.eq(grant),
+                        self.r_op.eq(gport.req_op),
+                        self.r_addr.eq(gport.req_addr),
+                        self.r_data.eq(gport.req_data),
+                        self.r_snp_dirty.eq(0),
+                    ]
+                    m.next = "READ"
+            # Wait for the data array
+            with m.State("READ"):
+                m.next = "LOOKUP"
+            with m.State("LOOKUP"):
+                m.d.sync += self.r_buf.eq(rp.data)
+                with m.If(hit):
+                    m.d.comb += self.o_hit.eq(self.r_op != CohOp.PUTM)
+                    m.next = "DIR"
+                # The line was already evicted (and invalidated in the
+                # private cache)
+                with m.Elif(self.r_op == CohOp.PUTM):
+                    m.next = "RESP"
+                with m.Else():
+                    vaddr = self._line_addr(self.line_tag[idx], idx)
+                    m.d.comb += self.o_miss.eq(1)
+                    m.d.sync += [
+                        self.r_vaddr.eq(vaddr),
+                        self.r_word.eq(0),
+                    ]
+                    with m.If(self.line_vld[idx] & (sharers != 0)):
+                        snoop(SnoopOp.INV, vaddr, sharers)
+                        m.next = "EVICT"
+                    with m.Elif(self.line_vld[idx] & self.line_dirty[idx]):
+                        m.next = "WB"
+                    with m.Else():
+                        m.next = "FILL"
+            # Invalidate the victim line in the private caches (inclusion)
+            with m.State("EVICT"):
+                with m.If(snp_done):
+                    with m.If(self.line_dirty[idx] | self.r_snp_dirty |
+                              (acks & Cat(p.snp_dirty for p in self.coh)
+                               ).any()):
+                        m.next = "WB"
+                    with m.Else():
+                        m.next = "FILL"
+            with m.State("WB"):
+                m.d.comb += [
+                    bus.cyc.eq(1),
+                    bus.stb.eq(1),
+                    bus.we.eq(1),
+                    bus.adr.eq((self.r_vaddr >> 2) + self.r_word),
+                ]
+                with m.If(bus.ack):
+                    m.d.sync += self.r_word.eq(self.r_word + 1)
+                    with m.If(self.r_word == self.line_words - 1):
+                        m.next = "FILL"
+            with m.State("FILL"):
+                m.d.comb += [
+                    bus.cyc.eq(1),
+                    bus.stb.eq(1),
+                    bus.adr.eq((self.r_addr >> 2) + self.r_word),
+                ]
+                with m.If(bus.ack):
+                    m.d.sync += [
+                        self.r_buf.word_select(self.r_word, 32).eq(bus.dat_r),
+                        self.r_word.eq(self.r_word + 1),
+                    ]
+                    with m.If(self.r_word == self.line_words - 1):
+                        m.next = "INSTALL"
+            with m.State("INSTALL"):
+                m.d.comb += wp.en.eq(1)
+                m.d.sync += [
+                    self.line_vld[idx].eq(1),
+                    self.line_tag[idx].eq(tag),
+                    self.line_dirty[idx].eq(0),
+                    self.line_owned[idx].eq(0),
+                    self.line_sharers[idx].eq(0),
+                    self.r_snp_dirty.eq(0),
+                ]
+                m.next = "DIR"
+            # Take the line away from other private caches (if necessary)
+            with m.State("DIR"):
+                owned = self.line_owned[idx]
+                with m.If((self.r_op == CohOp.GETS) & owned & (others != 0)):
+                    snoop(SnoopOp.DOWN, self.r_addr, others)
+                    m.next = "SNOOP"
+                with m.Elif((self.r_op == CohOp.GETM) & (others != 0)):
+                    snoop(SnoopOp.INV, self.r_addr, others)
+                    m.next = "SNOOP"
+                with m.Else():
+                    m.next = "RESP"
+            with m.State("SNOOP"):
+                with m.If(snp_done):
+                    m.next = "RESP"
+            with m.State("RESP"):
+                m.d.comb += Array(p.resp for p in self.coh)[self.r_agent].eq(1)
+                with m.Switch(self.r_op):
+                    with m.Case(CohOp.GETS):
+                        m.d.sync += [
+                            sharers.eq(sharers | bit),
+                            self.line_owned[idx].eq(0),
+                        ]
+                    with m.Case(CohOp.GETM):
+                        m.d.sync += [
+                            sharers.eq(bit),
+                            self.line_owned[idx].eq(1),
+                        ]
+                    with m.Case(CohOp.PUTM):
+                        with m.If(hit & self.line_owned[idx] & (sharers == bit)):
+                            m.d.comb += [
+                                wp.data.eq(self.r_data),
+                                wp.en.eq(1),
+                            ]
+                            m.d.sync += [
+                                self.line_dirty[idx].eq(1),
+                                self.line_owned[idx].eq(0),
+                                sharers.eq(0),
+                            ]
+                        with m.Elif(hit):
+                            m.d.sync += sharers.eq(sharers & ~bit)
+                # Keep modified data from a snoop
+                with m.If((self.r_op != CohOp.PUTM) & self.r_snp_dirty):
+                    m.d.comb += wp.en.eq(1)
+                    m.d.sync += self.line_dirty[idx].eq(1)
+                m.next = "IDLE"
+
+        return m
@@ -14,11 +14,22 @@ __all__ = [
     "Instruction",
     "InstFormat", "Opcode", "Funct3", "Funct7",
 
-    "ALUOp", "LSUOp", "BRUOp",
-    "PhysReg", "ArchReg", 
-    "Uop",
+    "ALUOp", "LSUOp", "BRUOp", "FuseOp", "FUClass",
+    "PhysReg", "ArchReg", "RobId", "ThreadId",
+    "DecodedUop", "Uop", "UopPayload",
+    "flatten", "rob_age",
 ]
 
+def flatten(rec):
+    """ Return a list of all signals in a (possibly nested) record. """
+    res = []
+    for field in rec.fields.values():
+        if isinstance(field, Record):
+            res.extend(flatten(field))
+        else:
+            res.append(field)
+    return res
+
 class Instruction(Signal):
     """ Wrapper for easily slicing a 32-bit RISC-V instruction. """
     def __init__(self):
@@ -105,7 +116,7 @@ class Funct7:
 @unique
 class ALUOp(Enum):
     """ Constant identifier for an ALU operation.
-    Formed by taking 'Cat( Funct3, Funct7[1] )'.
+    Formed by taking 'Cat( Funct7[5], Funct3 )'.
     """
     ADD  = 0b0000
     SUB  = 0b0001
@@ -146,8 +157,54 @@ class BRUOp(Enum):
     BLTU = 0b110
     BGEU = 0b111
 
+@unique
+class FuseOp(Enum):
+    """ Constant identifier for a pair of instructions fused into one uop.
+    """
+    NONE       = 0b000
+    LUI_ADDI   = 0b001 # rd = imm
+    AUIPC_ADDI = 0b010 # rd = pc + imm
+    AUIPC_JALR = 0b011 # rd = pc + 8, jump to (pc + imm)
+    SLLI_ADD   = 0b100 # rd = (rs1 << imm) + rs2
+
+@unique
+class FUClass(Enum):
+    """ Class of functional unit that performs a uop.
+    """
+    ALU = 0b00
+    BRU = 0b01
+    LSU = 0b10
+
 PhysReg = ceil(log2(PARAM.prf_size))
 ArchReg = ceil(log2(PARAM.arf_size))
+RobId   = ceil(log2(PARAM.rob_size))
+ThreadId = max(1, ceil(log2(PARAM.smt_threads)))
+
+def rob_age(rob, head):
+    """ Age of a ROB entry relative to the oldest entry (larger is younger) """
+    return (rob - head)[0:RobId]
+
+class DecodedUop(Layout):
+    """ Internal representation of an instruction (pre-rename).
+    'rvc': The instruction was 16 bits (RV32C), so its fall-through (and 
+    link) address is 'pc + 2' instead of 'pc + 4'.
+    """
+    def __init__(self):
+        super().__init__([
+            ('op',     Opcode),
+            ('alu_op', ALUOp), 
+            ('lsu_op', LSUOp),
+            ('bru_op', BRUOp),
+            ('rd',     ArchReg),
+            ('rs1',    ArchReg),
+            ('rs2',    ArchReg),
+            ('rd_en',  1),
+            ('rs1_en', 1),
+            ('rs2_en', 1),
+            ('imm',    32),
+            ('fuse',   FuseOp),
+            ('rvc',    1),
+        ])
 
 class Uop(Layout):
     """ Internal representation of an instruction (post-rename).
@@ -162,6 +219,19 @@ class Uop(Layout):
             ('alu_op', ALUOp), 
             ('lsu_op', LSUOp),
             ('bru_op', BRUOp),
+            ('imm',    32),
+            ('pc',     32),
+            ('fuse',   FuseOp),
+            ('elim',   1),
+            ('rvc',    1),
         ])
 
-
+class UopPayload(Layout):
+    """ The parts of a renamed uop that aren't needed for scheduling.
+    These are kept in a RAM (indexed by ROB entry) instead of the issue queue.
+    """
+    def __init__(self):
+        super().__init__([
+            (name, shape) for (name, (shape, _)) in Uop().fields.items()
+            if name not in ('ps1', 'ps2')
+        ])
@@ -9,88 +9,535 @@ from .param import *
 from .fetch import *
 from .decode import *
 from .rename import *
+from .rf import *
+from .uopcache import *
+from .rvc import *
 
 
 class RVRECore(Elaboratable):
-    """ Representing an RV32I hardware thread.
+    """ Representing an RV32I core with 'RVREParams.smt_threads' hardware 
+    threads.
+
+    Each thread has its own program counter, RAT, and partition of the ROB.
+    The front-end fetches from one thread each cycle (see 'ICountSelect'), 
+    and everything else is shared. 'reset_vector' is either a single address
+    (used for all threads), or a list with an address for each thread.
+
+    Instructions are fetched from a ROM (with 'rom_data'), or from 'icache' 
+    (see 'L1Cache'). When a fetch misses in the cache, the fetch on the 
+    following cycle is discarded and the missing instruction is fetched again.
+    Jumps and backward branches redirect fetch at decode, and the younger 
+    instructions from the same thread are discarded.
+
+    'load': Loads the value of an architectural register (one per cycle).
+        While this is asserted, the pipeline is held at the reset vector
+        and nothing is renamed. This is only meant to be used right after 
+        reset (i.e. to start from a checkpoint in sampled simulation).
     """
 
-    def __init__(self, reset_vector=0x00000000, rom_data=None):
+    def __init__(self, reset_vector=0x00000000, rom_data=None, icache=None):
         self._rom_data = rom_data
-        self.reset = reset_vector
+        self.threads = PARAM.smt_threads
+        if isinstance(reset_vector, int):
+            reset_vector = [ reset_vector ] * self.threads
+        self.resets = reset_vector
+        self.reset  = reset_vector[0]
+        if PARAM.rvc and self.threads > 1:
+            raise ValueError("RV32C isn't supported with more than one thread")
+        if PARAM.rvc and icache is not None:
+            raise ValueError("RV32C isn't supported with an instruction cache")
+        # Each thread needs at least one free register to rename anything
+        mapped = self.threads * (PARAM.arf_size - 1) + 1
+        if PARAM.prf_size - mapped < self.threads:
+            raise ValueError("prf_size ({}) leaves {} free registers after "
+                "mapping the architectural registers for {} thread(s)".format(
+                PARAM.prf_size, PARAM.prf_size - mapped, self.threads))
 
-        self.ifu = FetchUnit(rom_data=rom_data)
+        self.icache = icache
+        self.ifu = FetchUnit(rom_data=rom_data) if icache is None else None
+        self.uc  = UopCache(PARAM.uop_cache_lines, PARAM.uop_cache_width)
         self.idu = DecodeUnit()
-        self.rat = RegisterAliasTable(PARAM.arf_size, PARAM.prf_size)
+        # Decodes the next instruction (for macro-op fusion)
+        self.idu1 = DecodeUnit()
+        self.fus = FusionUnit()
+        # Each thread's architectural registers (except the zero register, 
+        # which is shared) are initially mapped to a separate block of 
+        # physical registers.
+        self.rats = [ 
+            RegisterAliasTable(PARAM.arf_size, PARAM.prf_size, 
+                               base=tid * (PARAM.arf_size - 1))
+            for tid in range(self.threads)
+        ]
+        self.rat = self.rats[0]
         self.rbt = RegisterBusyTable(PARAM.prf_size)
-        self.rft = RegisterFreeTable(PARAM.prf_size)
+        self.rft = RegisterFreeTable(PARAM.prf_size, mapped)
+        self.rrt = RegisterRefTable(PARAM.prf_size, mapped, PARAM.rob_size)
+        self.mve = MoveEliminator()
+        self.prf = PhysicalRegisterFile(PARAM.prf_size)
+
+        if PARAM.rvc:
+            # Fetch is always word-aligned; the aligner extracts instructions
+            self.aln = FetchAligner(reset_pc=self.reset)
+            self.exp = CompressedExpander()
+            self.r_pcs = [ Signal(32, reset=self.reset & ~3, name="r_pc") ]
+        else:
+            self.r_pcs = [ 
+                Signal(32, reset=reset, 
+                       name="r_pc{}".format(t) if self.threads > 1 else "r_pc")
+                for t, reset in enumerate(self.resets) 
+            ]
+        self.r_pc = self.r_pcs[0]
+
+        # Thread selected for fetch, and its program counter
+        if self.threads > 1:
+            self.tsel = ICountSelect(self.threads, 3)
+        self.fetch_tid = Signal(ThreadId)
+        self.fetch_pc  = Signal(32)
+        # Read from the ROM/instruction cache, and the word that was read
+        self.fetch_en   = Signal()
+        self.fetch_inst = Signal(32)
+        # A word was read from the fetch unit on the previous cycle
+        self.r_word_vld = Signal()
 
+        # Fetch address for the output of the fetch unit/uop cache
+        self.r_fetch_pc = Signal(32)
+        self.r_fetch_tid = Signal(ThreadId)
+        self.r_uc_hit = Signal()
+        self.r_uc_uop = Record(DecodedUop())
+
+        self.r_inst = Signal(32)
+        self.r_inst_vld = Signal()
+        self.r_inst_pc = Signal(32)
+        # The instruction in 'r_inst' was 16 bits (only with RV32C)
+        self.r_inst_rvc = Signal()
+        self.r_inst_tid = Signal(ThreadId)
+        self.r_inst_uc_hit = Signal()
+        self.r_inst_uc_uop = Record(DecodedUop())
+        self.r_uop  = Record(Uop())
+        self.r_uop_vld = Signal()
+        self.r_uop_tid = Signal(ThreadId)
+        self.r_uop_rob = Signal(RobId)
+
+        # Sequence numbers (only used for tracing, see 'PipeTracer').
+        # An instruction is numbered when it's fetched (or with RV32C, when 
+        # it comes out of the aligner), and the number follows it through 
+        # the pipeline. Zero is never used.
+        self.r_seq  = Signal(32, reset=1)
+        self.seq_en = Signal()
+        self.seq_pc = Signal(32)
+        self.r_fetch_seq = Signal(32)
+        self.r_inst_seq  = Signal(32)
+        self.r_uop_seq   = Signal(32)
+        # The fetch from the previous cycle is valid, or must be repeated
+        self.fetch_vld    = Signal()
+        self.fetch_replay = Signal()
+        # The instruction in 'r_inst' is being renamed
+        self.inst_vld = Signal()
+        # The instruction in 'r_inst' was fused with the next instruction
+        self.inst_fused = Signal()
+        # The instruction in 'r_inst' redirects fetch to 'redirect_pc'
+        self.redirect    = Signal()
+        self.redirect_pc = Signal(32)
+
+        # Next ROB entry for each thread (within its own partition)
+        self.rob_part = PARAM.rob_size // self.threads
+        self.r_rob_tail = Array(
+            Signal(RobId, reset=tid * self.rob_part, 
+                   name="r_rob_tail{}".format(tid))
+            for tid in range(self.threads)
+        )
+
+        self.load = Record([ 
+            ("en", 1), ("tid", ThreadId), ("areg", ArchReg), ("data", 32) 
+        ])
 
     def ports(self):
-        return []
+        return [ 
+            self.fetch_pc, self.r_uop_vld, self.r_uop_tid, self.r_uop_rob,
+            *self.r_uop.fields.values(), *self.load.fields.values(),
+        ]
+
+    def trace_signals(self, *groups, preg=()):
+        """ Return a dictionary of named signals for use with a tracer.
+        'groups': Any of "fetch", "decode", "rename", or "issue"
+        'preg': Physical register indexes whose busy/free bits are traced
+        """
+        sigs = {
+            "fetch": {
+                "tid":      self.fetch_tid,
+                "pc":       self.fetch_pc,
+                "inst":     self.fetch_inst,
+                "uc_hit":   self.r_uc_hit,
+            },
+            "decode": {
+                "inst":     self.r_inst,
+                "inst_vld": self.r_inst_vld,
+                "inst_pc":  self.r_inst_pc,
+                "tid":      self.r_inst_tid,
+                "uc_hit":   self.r_inst_uc_hit,
+                "fused":    self.fus.o_fused,
+                "illegal":  self.idu.o_illegal,
+                "op":       self.idu.o_op,
+                "rd":       self.idu.o_rd,
+                "rs1":      self.idu.o_rs1,
+                "rs2":      self.idu.o_rs2,
+                "imm":      self.idu.o_imm,
+                "redirect": self.redirect,
+                "redirect_pc": self.redirect_pc,
+            },
+            "rename": {
+                "alloc_en": self.rft.alloc.en,
+                "alloc_ok": self.rft.alloc.ok,
+                "alloc_prd":self.rft.alloc.prd,
+                "rat_wen":  self.rat.wp1.en,
+                "rat_areg": self.rat.wp1.areg,
+                "rat_preg": self.rat.wp1.preg,
+                "elim":     self.mve.o_elim,
+                "elim_src": self.mve.o_src,
+                "ps1":      self.rat.rp1.preg,
+                "ps2":      self.rat.rp2.preg,
+            },
+            "issue": { 
+                "uop_vld":  self.r_uop_vld,
+                "uop_seq":  self.r_uop_seq,
+                "uop_tid":  self.r_uop_tid,
+                "uop_rob":  self.r_uop_rob,
+                **{ name: field for name, field in self.r_uop.fields.items() }
+            },
+        }
+        res = {}
+        for group in groups:
+            if group not in sigs:
+                raise ValueError("Unknown trace group '{}'".format(group))
+            for name, sig in sigs[group].items():
+                res["{}.{}".format(group, name)] = sig
+        for idx in preg:
+            res["prf.p{}.busy".format(idx)] = self.rbt.busytbl[idx]
+            res["prf.p{}.free".format(idx)] = self.rft.freetbl[idx]
+        return res
 
     def elaborate(self, platform):
         m = Module()
 
-        r_pc   = Signal(32, reset=self.reset - 4)
-        r_inst = Signal(32)
-        r_uop  = Record(Uop())
+        r_inst = self.r_inst
+        r_inst_vld = self.r_inst_vld
+        load = self.load
+        r_uop  = self.r_uop
+        r_uop_vld = self.r_uop_vld
 
-        m.submodules.ifu = ifu = self.ifu
+        fetch_en   = self.fetch_en
+        fetch_inst = self.fetch_inst
+        # The word read on the previous cycle is valid
+        fetch_ok   = Signal()
+        replay     = self.fetch_replay
+        if self.icache is None:
+            m.submodules.ifu = ifu = self.ifu
+            m.d.comb += [
+                ifu.i_pc.eq(self.fetch_pc),
+                ifu.i_en.eq(fetch_en),
+                fetch_inst.eq(ifu.o_inst),
+                fetch_ok.eq(self.r_word_vld),
+            ]
+        else:
+            m.submodules.icache = ic = self.icache
+            m.d.comb += [
+                ic.i_addr.eq(self.fetch_pc),
+                ic.i_en.eq(fetch_en),
+                fetch_inst.eq(ic.o_data),
+                fetch_ok.eq(self.r_word_vld & ic.o_vld),
+                replay.eq(self.r_word_vld & ~ic.o_vld),
+            ]
+        m.submodules.uc  = uc  = self.uc
         m.submodules.idu = idu = self.idu
-        m.submodules.rat = rat = self.rat
+        m.submodules.idu1 = idu1 = self.idu1
+        m.submodules.fus = fus = self.fus
+        for tid, rat in enumerate(self.rats):
+            m.submodules["rat{}".format(tid) if tid else "rat"] = rat
         m.submodules.rbt = rbt = self.rbt
         m.submodules.rft = rft = self.rft
+        m.submodules.rrt = rrt = self.rrt
+        m.submodules.mve = mve = self.mve
+        m.submodules.prf = prf = self.prf
+
+        # Architectural state is loaded into the physical registers that the 
+        # thread's architectural registers are initially mapped to (and the 
+        # RAT is restored to the initial mapping)
+        inst_vld = self.inst_vld
+        m.d.comb += [
+            inst_vld.eq(r_inst_vld & ~load.en),
+            prf.load.en.eq(load.en),
+            prf.load.addr.eq(load.tid * (PARAM.arf_size - 1) + load.areg),
+            prf.load.data.eq(load.data),
+        ]
+        for tid, rat in enumerate(self.rats):
+            m.d.comb += rat.i_load.eq(load.en & (load.tid == tid))
 
-        # Fetch unit buffered inputs
-        m.d.comb += ifu.i_pc.eq(r_pc)
+        # Choose a thread to fetch from
+        ftid = self.fetch_tid
+        if self.threads > 1:
+            m.submodules.tsel = tsel = self.tsel
+            # Instructions from each thread that haven't been issued yet
+            fetched = self.r_word_vld | self.r_uc_hit
+            for t in range(self.threads):
+                m.d.comb += tsel.i_count[t].eq(
+                    (fetched & (self.r_fetch_tid == t)) +
+                    (r_inst_vld & (self.r_inst_tid == t)) +
+                    (r_uop_vld & (self.r_uop_tid == t))
+                )
+            m.d.comb += [
+                tsel.i_active.eq(Repl(1, self.threads)),
+                ftid.eq(tsel.o_tid),
+            ]
+        else:
+            m.d.comb += ftid.eq(0)
+        r_pcs = Array(self.r_pcs)
+        m.d.comb += self.fetch_pc.eq(r_pcs[ftid])
+
+        # Fetch unit buffered inputs.
+        # The fetch unit is idle when the uop cache already has this uop. 
+        uc_hit = Signal()
+        m.d.comb += [
+            uc.i_pc.eq(self.fetch_pc),
+        ]
+
+        # The next instruction (sent to decode on the next cycle)
+        next_inst = Signal(32)
+        next_vld  = Signal()
+        next_rvc  = Signal()
+        if PARAM.rvc:
+            # NOTE: The uop cache is indexed by word, and is not used when 
+            # compressed instructions are enabled.
+            m.submodules.aln = aln = self.aln
+            m.submodules.exp = exp = self.exp
+            m.d.comb += [
+                uc_hit.eq(0),
+                fetch_en.eq(aln.o_ready),
+                aln.i_word.eq(fetch_inst),
+                aln.i_word_vld.eq(self.r_word_vld),
+                aln.i_ack.eq(1),
+                # NOTE: Should also be driven by the BRU (which doesn't exist yet)
+                aln.i_redirect.eq(load.en | self.redirect),
+                aln.i_pc.eq(Mux(load.en, self.reset, self.redirect_pc)),
+                exp.i_inst.eq(aln.o_inst),
+                next_inst.eq(exp.o_inst),
+                next_vld.eq(aln.o_vld),
+                next_rvc.eq(aln.o_rvc),
+            ]
+        else:
+            m.d.comb += [
+                uc_hit.eq(uc.o_hit & uc.o_vld[0] & ~replay),
+                next_inst.eq(fetch_inst),
+                next_vld.eq(self.r_uc_hit | fetch_ok),
+                fetch_en.eq(~uc_hit & ~replay),
+            ]
 
         # Decode unit buffered inputs
         m.d.comb += idu.i_inst.eq(r_inst)
 
-        # Destination register rename (physical register allocation)
-        prd = Signal(PhysReg)
+        # Macro-op fusion with the next instruction.
+        # The next instruction is not available when it hit in the uop cache.
+        # NOTE: With more than one thread, the next instruction may be from
+        # some other thread; fusion is disabled in that case.
+        # NOTE: Fused uops assume two 32-bit instructions (i.e. 'auipc'/'jalr'
+        # links 'pc + 8'), so pairs with a 16-bit instruction aren't fused.
         m.d.comb += [
-            rft.alloc.en.eq(idu.o_rd_en),
-            prd.eq(rft.alloc.prd),
+            idu1.i_inst.eq(next_inst),
+            fus.i_head.eq(idu.o_duop),
+            fus.i_head.rvc.eq(self.r_inst_rvc),
+            fus.i_tail.eq(idu1.o_duop),
+            fus.i_tail.rvc.eq(next_rvc),
+            fus.i_en.eq(inst_vld & next_vld & 
+                        ~idu.o_illegal & ~idu1.o_illegal &
+                        ~self.r_inst_uc_hit & ~self.r_uc_hit &
+                        ~self.r_inst_rvc & ~next_rvc &
+                        C(self.threads == 1)),
+        ]
 
-            rat.wp1.en.eq(idu.o_rd_en & rft.alloc.ok),
-            rat.wp1.areg.eq(idu.o_rd),
-            rat.wp1.preg.eq(prd),
+        # Use the cached uop instead of the decoder output
+        duop  = Record(DecodedUop())
+        fused = self.inst_fused
+        with m.If(self.r_inst_uc_hit):
+            m.d.comb += [
+                duop.eq(self.r_inst_uc_uop),
+                fused.eq(self.r_inst_uc_uop.fuse != FuseOp.NONE),
+            ]
+        with m.Else():
+            m.d.comb += [
+                duop.eq(fus.o_uop),
+                fused.eq(fus.o_fused),
+            ]
 
-            rbt.alloc.en.eq(idu.o_rd_en & rft.alloc.ok),
-            rbt.alloc.prd.eq(prd),
+        # Fill the uop cache with decoder output
+        m.d.comb += [
+            uc.fill.en.eq(inst_vld & ~self.r_inst_uc_hit & ~idu.o_illegal &
+                          ~C(PARAM.rvc)),
+            uc.fill.pc.eq(self.r_inst_pc),
+            uc.fill.uop.eq(fus.o_uop),
+            # NOTE: Should be asserted by 'fence.i'
+            uc.i_flush.eq(0),
+        ]
+
+        # Moves and zero idioms are completed by renaming 'rd' to the 
+        # physical register that is already bound to the source
+        elim = Signal()
+        m.d.comb += [
+            mve.i_uop.eq(duop),
+            elim.eq(mve.o_elim & inst_vld),
         ]
 
         # Source register rename (physical register resolution)
         ps1 = Signal(PhysReg)
         ps2 = Signal(PhysReg)
+        for rat in self.rats:
+            m.d.comb += [
+                rat.rp1.areg.eq(Mux(elim, mve.o_src, duop.rs1)),
+                rat.rp2.areg.eq(duop.rs2),
+            ]
         m.d.comb += [
-            rat.rp1.areg.eq(idu.o_rs1),
-            rat.rp2.areg.eq(idu.o_rs2),
-            ps1.eq(rat.rp1.preg),
-            ps2.eq(rat.rp2.preg),
+            ps1.eq(Array(rat.rp1.preg for rat in self.rats)[self.r_inst_tid]),
+            ps2.eq(Array(rat.rp2.preg for rat in self.rats)[self.r_inst_tid]),
         ]
 
+        # Destination register rename (physical register allocation)
+        prd = Signal(PhysReg)
+        rd_en = Signal()
+        m.d.comb += [
+            rd_en.eq(duop.rd_en & inst_vld & ~elim),
+            rft.alloc.en.eq(rd_en),
+            prd.eq(Mux(elim, ps1, rft.alloc.prd)),
+
+            rbt.alloc.en.eq(rd_en & rft.alloc.ok),
+            rbt.alloc.prd.eq(prd),
+
+            rrt.alloc.en.eq(rd_en & rft.alloc.ok),
+            rrt.alloc.prd.eq(prd),
+            rrt.inc.en.eq(elim),
+            rrt.inc.prd.eq(prd),
+
+            # NOTE: References are dropped at retire (which doesn't exist yet)
+            rft.free.eq(rrt.free),
+        ]
+        for tid, rat in enumerate(self.rats):
+            m.d.comb += [
+                rat.wp1.en.eq(((rd_en & rft.alloc.ok) | elim) & 
+                              (self.r_inst_tid == tid)),
+                rat.wp1.areg.eq(duop.rd),
+                rat.wp1.preg.eq(prd),
+            ]
+
         uop = Record(Uop())
         m.d.comb += [
-            uop.op.eq(idu.o_op),
-            uop.alu_op.eq(idu.o_alu_op),
-            uop.lsu_op.eq(idu.o_lsu_op),
-            uop.bru_op.eq(idu.o_bru_op),
-            uop.rd.eq(idu.o_rd),
+            uop.op.eq(duop.op),
+            uop.alu_op.eq(duop.alu_op),
+            uop.lsu_op.eq(duop.lsu_op),
+            uop.bru_op.eq(duop.bru_op),
+            uop.rd.eq(duop.rd),
             uop.prd.eq(prd),
             uop.ps1.eq(ps1),
             uop.ps2.eq(ps2),
+            uop.imm.eq(duop.imm),
+            uop.pc.eq(self.r_inst_pc),
+            uop.fuse.eq(duop.fuse),
+            uop.elim.eq(elim),
+            uop.rvc.eq(duop.rvc),
         ]
 
+        # Redirect fetch at decode when the target is PC-relative.
+        # Direct jumps (and 'auipc'/'jalr' pairs, which are fused into a 
+        # single 'jal' uop) are always taken. Backward branches are predicted
+        # taken, and forward branches are predicted not-taken.
+        # NOTE: There's no BTB yet (every branch misses). Mispredicted branches
+        # are supposed to be repaired by the BRU (which doesn't exist yet).
+        m.d.comb += [
+            self.redirect.eq(inst_vld & 
+                ~(idu.o_illegal & ~self.r_inst_uc_hit) &
+                ((duop.op == Opcode.JAL) |
+                 ((duop.op == Opcode.BRANCH) & duop.imm[31]))),
+            self.redirect_pc.eq((self.r_inst_pc + duop.imm) & ~1),
+        ]
 
         # Latch next program counter
-        m.d.sync += r_pc.eq(r_pc + 4)
-        # Latch next instruction
-        m.d.sync += r_inst.eq(ifu.o_inst)
+        with m.If(fetch_en | uc_hit):
+            m.d.sync += r_pcs[ftid].eq(self.fetch_pc + 4)
+        # Fetch the instruction that missed in the cache again
+        with m.If(replay):
+            m.d.sync += r_pcs[self.r_fetch_tid].eq(self.r_fetch_pc)
+        # Latch fetch unit/uop cache output
+        m.d.sync += [
+            self.r_word_vld.eq(fetch_en),
+            self.r_fetch_pc.eq(self.fetch_pc),
+            self.r_fetch_tid.eq(ftid),
+            self.r_uc_hit.eq(uc_hit),
+            self.r_uc_uop.eq(uc.o_uops[0]),
+        ]
+        # Latch next instruction (which is discarded if it was fused).
+        # The decoders aren't used when the uop cache hits, so their input is
+        # held (and they don't switch).
+        with m.If(~self.r_uc_hit):
+            m.d.sync += r_inst.eq(next_inst)
+        m.d.sync += [
+            r_inst_vld.eq(next_vld & ~fused),
+            self.r_inst_pc.eq(aln.o_pc if PARAM.rvc else self.r_fetch_pc),
+            self.r_inst_rvc.eq(next_rvc),
+            self.r_inst_tid.eq(self.r_fetch_tid),
+            self.r_inst_uc_hit.eq(self.r_uc_hit),
+            self.r_inst_uc_uop.eq(self.r_uc_uop),
+        ]
+        # Restart fetch at the target, and squash anything younger from the 
+        # same thread (the next instruction, and the word being fetched)
+        with m.If(self.redirect):
+            m.d.sync += r_pcs[self.r_inst_tid].eq(
+                self.redirect_pc & ~3 if PARAM.rvc else self.redirect_pc)
+            with m.If(self.r_fetch_tid == self.r_inst_tid):
+                m.d.sync += r_inst_vld.eq(0)
+            with m.If(ftid == self.r_inst_tid):
+                m.d.sync += [
+                    self.r_word_vld.eq(0),
+                    self.r_uc_hit.eq(0),
+                ]
         # Latch next uop
         m.d.sync += r_uop.eq(uop)
+        m.d.sync += r_uop_vld.eq(inst_vld)
+        m.d.sync += self.r_uop_tid.eq(self.r_inst_tid)
+
+        # Sequence numbers
+        if PARAM.rvc:
+            m.d.comb += [
+                self.seq_en.eq(next_vld),
+                self.seq_pc.eq(aln.o_pc),
+            ]
+            m.d.sync += self.r_inst_seq.eq(self.r_seq)
+        else:
+            m.d.comb += [
+                self.seq_en.eq(fetch_en | uc_hit),
+                self.seq_pc.eq(self.fetch_pc),
+                self.fetch_vld.eq((self.r_word_vld | self.r_uc_hit) & ~replay),
+            ]
+            m.d.sync += [
+                self.r_fetch_seq.eq(self.r_seq),
+                self.r_inst_seq.eq(self.r_fetch_seq),
+            ]
+        with m.If(self.seq_en):
+            m.d.sync += self.r_seq.eq(self.r_seq + 1)
+        m.d.sync += self.r_uop_seq.eq(self.r_inst_seq)
+
+        # Allocate a ROB entry from the thread's partition
+        # NOTE: Entries are released at retire (which doesn't exist yet)
+        m.d.sync += self.r_uop_rob.eq(self.r_rob_tail[self.r_inst_tid])
+        for tid in range(self.threads):
+            tail  = self.r_rob_tail[tid]
+            first = tid * self.rob_part
+            last  = first + self.rob_part - 1
+            with m.If(inst_vld & (self.r_inst_tid == tid)):
+                m.d.sync += tail.eq(Mux(tail == last, first, tail + 1))
+
+        # Hold the pipeline at the reset vector while loading state
+        with m.If(load.en):
+            m.d.sync += [ r_pc.eq(r_pc.reset) for r_pc in self.r_pcs ]
+            m.d.sync += [
+                self.r_word_vld.eq(0),
+                r_inst_vld.eq(0),
+            ]
 
         return m
 
@@ -34,6 +34,9 @@ class DecodeUnit(Elaboratable):
         self.o_rs2_en  = Signal()
         self.o_imm     = Signal(32)
 
+        # The same set of control signals, packed into a record
+        self.o_duop    = Record(DecodedUop())
+
     def ports(self):
         return [ 
             self.i_inst,
@@ -75,9 +78,11 @@ class DecodeUnit(Elaboratable):
                     self.o_alu_op.eq(ALUOp.ADD) 
                 ]
             with m.Case(Opcode.OP_IMM):
+                # NOTE: 'funct7' only exists for shift-immediates; otherwise,
+                # these bits are part of the immediate
                 m.d.comb += [ 
                     ifmt.eq(InstFormat.I),
-                    self.o_alu_op.eq(Cat(f3, f7[1]))
+                    self.o_alu_op.eq(Cat(f7[5] & (f3 == Funct3.SRx), f3))
                 ]
             with m.Case(Opcode.AUIPC):
                 m.d.comb += [ 
@@ -92,7 +97,7 @@ class DecodeUnit(Elaboratable):
             with m.Case(Opcode.OP):
                 m.d.comb += [ 
                     ifmt.eq(InstFormat.R),
-                    self.o_alu_op.eq(Cat(f3, f7[1]))
+                    self.o_alu_op.eq(Cat(f7[5], f3))
                 ]
             with m.Case(Opcode.LUI):
                 m.d.comb += [ 
@@ -102,7 +107,7 @@ class DecodeUnit(Elaboratable):
             with m.Case(Opcode.BRANCH):
                 m.d.comb += [ 
                     ifmt.eq(InstFormat.B),
-                    #self.o_alu_op.eq(Cat(f3, f7[1]))
+                    #self.o_alu_op.eq(Cat(f7[5], f3))
                 ]
             with m.Case(Opcode.JALR):
                 m.d.comb += [ 
@@ -141,10 +146,126 @@ class DecodeUnit(Elaboratable):
             self.o_rs1.eq(self.i_inst.rs1()),
             self.o_rs2.eq(self.i_inst.rs2()),
 
-            self.o_rd_en.eq( reduce(or_, (ifmt == F for F in FMT_RD))),
+            # NOTE: Writes to 'x0' are discarded, so they never need to 
+            # allocate a physical register
+            self.o_rd_en.eq( reduce(or_, (ifmt == F for F in FMT_RD)) & 
+                             (self.o_rd != 0)),
             self.o_rs1_en.eq(reduce(or_, (ifmt == F for F in FMT_RS1))),
             self.o_rs2_en.eq(reduce(or_, (ifmt == F for F in FMT_RS2))),
         ]
 
+        m.d.comb += [
+            self.o_duop.op.eq(self.o_op),
+            self.o_duop.alu_op.eq(self.o_alu_op),
+            self.o_duop.lsu_op.eq(self.o_lsu_op),
+            self.o_duop.bru_op.eq(self.o_bru_op),
+            self.o_duop.rd.eq(self.o_rd),
+            self.o_duop.rs1.eq(self.o_rs1),
+            self.o_duop.rs2.eq(self.o_rs2),
+            self.o_duop.rd_en.eq(self.o_rd_en),
+            self.o_duop.rs1_en.eq(self.o_rs1_en),
+            self.o_duop.rs2_en.eq(self.o_rs2_en),
+            self.o_duop.imm.eq(self.o_imm),
+            self.o_duop.fuse.eq(FuseOp.NONE),
+        ]
+
+        return m
+
+
+class FusionUnit(Elaboratable):
+    """ Macro-op fusion for pairs of adjacent decoded instructions.
+    'i_head': The older instruction
+    'i_tail': The next-youngest instruction
+    'o_fused': Asserted when the pair has been fused into 'o_uop'
+    'o_uop': The fused uop (or 'i_head', when the pair cannot be fused)
+
+    The following pairs are fused, but only when they both write the same
+    architectural register 'rX' (so that the intermediate value is dead):
+
+    - 'lui rX, hi; addi rX, rX, lo' becomes 'lui rX, (hi + lo)'
+    - 'auipc rX, hi; addi rX, rX, lo' becomes 'auipc rX, (hi + lo)'
+    - 'auipc rX, hi; jalr rX, lo(rX)' becomes a jump to 'pc + (hi + lo)'
+      which links 'pc + 8' into 'rX'
+    - 'slli rX, rY, sh; add rX, rX, rZ' becomes 'rX = (rY << sh) + rZ'
+
+    When the pair is fused, the tail instruction must be discarded.
+    """
+    def __init__(self):
+        self.i_head  = Record(DecodedUop())
+        self.i_tail  = Record(DecodedUop())
+        self.i_en    = Signal()
+        self.o_fused = Signal()
+        self.o_uop   = Record(DecodedUop())
+
+    def ports(self):
+        return [
+            *self.i_head.fields.values(),
+            *self.i_tail.fields.values(),
+            self.i_en,
+            self.o_fused,
+            *self.o_uop.fields.values(),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        head = self.i_head
+        tail = self.i_tail
+        fuse = Signal(FuseOp)
+        imm  = Signal(32)
+
+        head_is_slli  = (head.op == Opcode.OP_IMM) & (head.alu_op == ALUOp.SLL)
+        tail_is_addi  = (tail.op == Opcode.OP_IMM) & (tail.alu_op == ALUOp.ADD)
+        tail_is_add   = (tail.op == Opcode.OP) & (tail.alu_op == ALUOp.ADD)
+
+        # Both instructions must target the same (non-zero) register, and
+        # the tail must consume the result of the head 
+        same_rd  = (head.rd == tail.rd) & (head.rd != 0)
+        dep_rs1  = same_rd & (tail.rs1 == head.rd)
+        dep_rs2  = same_rd & (tail.rs2 == head.rd)
+
+        # The other source operand of the 'add', which cannot be 'rX'
+        add_rs   = Signal(ArchReg)
+        m.d.comb += add_rs.eq(Mux(dep_rs1, tail.rs2, tail.rs1))
+
+        with m.If(self.i_en):
+            with m.If((head.op == Opcode.LUI) & tail_is_addi & dep_rs1):
+                m.d.comb += fuse.eq(FuseOp.LUI_ADDI)
+            with m.Elif((head.op == Opcode.AUIPC) & tail_is_addi & dep_rs1):
+                m.d.comb += fuse.eq(FuseOp.AUIPC_ADDI)
+            with m.Elif((head.op == Opcode.AUIPC) & 
+                        (tail.op == Opcode.JALR) & dep_rs1):
+                m.d.comb += fuse.eq(FuseOp.AUIPC_JALR)
+            with m.Elif(head_is_slli & tail_is_add & (dep_rs1 ^ dep_rs2)):
+                m.d.comb += fuse.eq(FuseOp.SLLI_ADD)
+
+        m.d.comb += [
+            imm.eq(head.imm + tail.imm),
+            self.o_fused.eq(fuse != FuseOp.NONE),
+            self.o_uop.eq(head),
+        ]
+
+        with m.Switch(fuse):
+            with m.Case(FuseOp.LUI_ADDI, FuseOp.AUIPC_ADDI):
+                m.d.comb += [
+                    self.o_uop.imm.eq(imm),
+                    self.o_uop.fuse.eq(fuse),
+                ]
+            with m.Case(FuseOp.AUIPC_JALR):
+                m.d.comb += [
+                    self.o_uop.op.eq(Opcode.JAL),
+                    self.o_uop.imm.eq(imm),
+                    self.o_uop.fuse.eq(fuse),
+                ]
+            with m.Case(FuseOp.SLLI_ADD):
+                m.d.comb += [
+                    self.o_uop.op.eq(Opcode.OP),
+                    self.o_uop.alu_op.eq(ALUOp.ADD),
+                    self.o_uop.rs2.eq(add_rs),
+                    self.o_uop.rs2_en.eq(1),
+                    self.o_uop.imm.eq(head.imm[0:5]),
+                    self.o_uop.fuse.eq(fuse),
+                ]
+
         return m
 
@@ -3,30 +3,195 @@ from amaranth import *
 from amaranth.sim import *
 from amaranth.hdl.rec import *
 
+from amaranth.lib.coding import PriorityEncoder
+
 from math import ceil, log2
 
 class FetchUnit(Elaboratable):
-    """ Instruction fetch unit """
+    """ Instruction fetch unit.
+    The ROM has at least 'ROM_SIZE' words (and is rounded up to a power of two
+    when 'rom_data' is larger than that).
+    """
     ROM_SIZE = 32
 
     def __init__(self, rom_data=None):
-        self.rom    = Memory(width=32, depth=self.ROM_SIZE, init=rom_data)
-        self.addr   = Signal(ceil(log2(self.ROM_SIZE)))
+        depth = self.ROM_SIZE
+        if rom_data is not None and len(rom_data) > depth:
+            depth = 1 << ceil(log2(len(rom_data)))
+        self.rom    = Memory(width=32, depth=depth, init=rom_data)
+        self.addr   = Signal(ceil(log2(depth)))
         self.i_pc   = Signal(32)
+        self.i_en   = Signal(reset=1)
         self.o_inst = Signal(32)
         pass
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.rp = rp = self.rom.read_port()
+        # NOTE: Transparent read ports have no enable
+        m.submodules.rp = rp = self.rom.read_port(transparent=False)
 
         # NOTE: This ROM is word-addressible (hence the left-shift).
         m.d.comb += [
-            self.addr.eq((self.i_pc >> 2)[0:5]),
+            self.addr.eq((self.i_pc >> 2)[0:len(self.addr)]),
             rp.addr.eq(self.addr),
+            rp.en.eq(self.i_en),
             self.o_inst.eq(rp.data),
         ]
 
         return m
 
+
+class FetchAligner(Elaboratable):
+    """ Extracts (mixed 16-bit and 32-bit) instructions from fetched words.
+
+    Fetched halfwords are kept in a small buffer. A 32-bit instruction may 
+    straddle two fetched words; it is only sent out after both halves are
+    in the buffer.
+
+    'i_word': Fetched 32-bit (word-aligned) block
+    'i_word_vld': Asserted when 'i_word' is valid (a read was requested on
+                  the previous cycle)
+    'o_ready': Asserted when the buffer has room for another word, taking any
+               word that is already in-flight into account. A new read 
+               should only be requested when this is asserted.
+    'o_vld': Asserted when 'o_inst' holds a complete instruction
+    'o_inst': Instruction (16-bit instructions are zero-extended)
+    'o_rvc': Asserted when 'o_inst' is a 16-bit instruction
+    'o_pc': Address of 'o_inst'
+    'i_ack': The instruction in 'o_inst' was consumed
+    'i_redirect': Flush the buffer and restart at 'i_pc'. The next word must
+                  be the one containing 'i_pc'.
+    """
+    # Buffer capacity (in halfwords)
+    CAPACITY = 6
+
+    def __init__(self, reset_pc=0):
+        self.buf    = Signal(16 * self.CAPACITY)
+        self.cnt    = Signal(range(self.CAPACITY + 1))
+        self.pc     = Signal(32, reset=reset_pc)
+        self.skip   = Signal(reset=(reset_pc >> 1) & 1)
+
+        self.i_word     = Signal(32)
+        self.i_word_vld = Signal()
+        self.o_ready    = Signal()
+        self.o_vld      = Signal()
+        self.o_inst     = Signal(32)
+        self.o_rvc      = Signal()
+        self.o_pc       = Signal(32)
+        self.i_ack      = Signal()
+        self.i_redirect = Signal()
+        self.i_pc       = Signal(32)
+
+    def ports(self):
+        return [
+            self.i_word, self.i_word_vld, self.o_ready, self.o_vld,
+            self.o_inst, self.o_rvc, self.o_pc, self.i_ack, self.i_redirect,
+            self.i_pc,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rvc  = Signal()
+        used = Signal(2)
+        m.d.comb += [
+            rvc.eq(self.buf[0:2] != 0b11),
+            self.o_rvc.eq(rvc),
+            self.o_pc.eq(self.pc),
+            self.o_vld.eq(Mux(rvc, self.cnt >= 1, self.cnt >= 2)),
+            self.o_inst.eq(Mux(rvc, self.buf[0:16], self.buf[0:32])),
+            self.o_ready.eq(self.cnt + 2 * self.i_word_vld + 2 <= self.CAPACITY),
+            used.eq(Mux(self.o_vld & self.i_ack, Mux(rvc, 1, 2), 0)),
+        ]
+
+        # Halfwords from the incoming word (skipping the first halfword when
+        # we've been redirected into the middle of a word)
+        new_bits = Signal(32)
+        new_cnt  = Signal(2)
+        m.d.comb += [
+            new_bits.eq(Mux(self.skip, self.i_word[16:32], self.i_word)),
+            new_cnt.eq(Mux(self.i_word_vld, Mux(self.skip, 1, 2), 0)),
+        ]
+
+        remain = Signal(range(self.CAPACITY + 1))
+        m.d.comb += remain.eq(self.cnt - used)
+
+        # NOTE: Halfwords above 'cnt' must be zero (new halfwords are ORed in)
+        with m.If(self.i_redirect):
+            m.d.sync += [
+                self.buf.eq(0),
+                self.cnt.eq(0),
+                self.pc.eq(self.i_pc),
+                self.skip.eq(self.i_pc[1]),
+            ]
+        with m.Else():
+            m.d.sync += [
+                self.buf.eq((self.buf >> (used * 16)) | 
+                    (Mux(self.i_word_vld, new_bits, 0) << (remain * 16))),
+                self.cnt.eq(remain + new_cnt),
+                self.pc.eq(self.pc + (used * 2)),
+            ]
+            with m.If(self.i_word_vld):
+                m.d.sync += self.skip.eq(0)
+
+        return m
+
+
+class ICountSelect(Elaboratable):
+    """ Chooses a thread to fetch from (with the ICOUNT policy).
+
+    The thread with the fewest instructions in the front-end (which haven't
+    been issued yet) is chosen, so that a thread that isn't making progress
+    can't fill up the machine. Ties are broken round-robin.
+
+    'i_count': Number of instructions in the front-end for each thread
+    'i_active': Mask of threads that can be fetched from
+    'o_vld': Asserted when some thread was chosen
+    'o_tid': The chosen thread
+    """
+    def __init__(self, threads, max_count):
+        self.threads  = threads
+        self.i_count  = Array(Signal(range(max_count + 1), 
+                                     name="i_count{}".format(t))
+                              for t in range(threads))
+        self.i_active = Signal(threads)
+        self.o_vld    = Signal()
+        self.o_tid    = Signal(range(threads))
+        self.r_last   = Signal(range(threads), reset=threads - 1)
+
+        self.enc = PriorityEncoder(threads)
+
+    def ports(self):
+        return [ *self.i_count, self.i_active, self.o_vld, self.o_tid ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.enc = enc = self.enc
+
+        # Round-robin priority (lower is better), starting after the last
+        # thread that was chosen
+        prio = [ Signal(range(self.threads), name="prio{}".format(t))
+                 for t in range(self.threads) ]
+        for t in range(self.threads):
+            m.d.comb += prio[t].eq(Mux(t > self.r_last, 
+                t - self.r_last - 1, t + self.threads - self.r_last - 1))
+
+        wins = Signal(self.threads)
+        for t in range(self.threads):
+            beats = [ ~self.i_active[u] | 
+                      (self.i_count[t] < self.i_count[u]) |
+                      ((self.i_count[t] == self.i_count[u]) & 
+                       (prio[t] < prio[u]))
+                      for u in range(self.threads) if u != t ]
+            m.d.comb += wins[t].eq(self.i_active[t] & Cat(*beats).all())
+
+        m.d.comb += [
+            enc.i.eq(wins),
+            self.o_vld.eq(~enc.n),
+            self.o_tid.eq(enc.o),
+        ]
+        with m.If(self.o_vld):
+            m.d.sync += self.r_last.eq(self.o_tid)
+
+        return m
@@ -0,0 +1,173 @@
+""" iss.py
+Functional (instruction-set) simulator for RV32I.
+
+This doesn't model anything about the machine; it's only used to quickly
+compute the architectural state at some point in a program (for sampled
+simulation, see 'sample.py').
+"""
+
+from collections import namedtuple
+
+from .common import Opcode, Funct3, BRUOp
+
+__all__ = [ "ISS", "Retired", "Checkpoint" ]
+
+# An instruction retired by the functional simulator.
+# 'addr' is the effective address for loads/stores (otherwise, None).
+Retired = namedtuple("Retired", [ "pc", "inst", "next_pc", "addr" ])
+
+# Architectural state
+Checkpoint = namedtuple("Checkpoint", [ "pc", "regs", "mem", "icount" ])
+
+MASK = 0xffffffff
+
+def _sext(value, bits):
+    sign = 1 << (bits - 1)
+    return ((value & ((1 << bits) - 1)) ^ sign) - sign
+
+def _signed(value):
+    return _sext(value, 32)
+
+
+class ISS:
+    """ RV32I functional simulator.
+    'mem' is a sparse, word-addressed memory (a map from word address to
+    value). 'icount' is the number of retired instructions.
+    """
+    def __init__(self, image=(), base=0, pc=0):
+        self.pc     = pc
+        self.regs   = [ 0 ] * 32
+        self.mem    = {}
+        self.icount = 0
+        self.halted = False
+        for idx, word in enumerate(image):
+            self.mem[(base >> 2) + idx] = word
+
+    def checkpoint(self):
+        return Checkpoint(self.pc, list(self.regs), dict(self.mem),
+                          self.icount)
+
+    def restore(self, ckpt):
+        self.pc     = ckpt.pc
+        self.regs   = list(ckpt.regs)
+        self.mem    = dict(ckpt.mem)
+        self.icount = ckpt.icount
+        self.halted = False
+
+    def _load(self, addr, size, signed):
+        word  = self.mem.get(addr >> 2, 0)
+        shift = (addr & 3) * 8
+        value = (word >> shift) & ((1 << (size * 8)) - 1)
+        return _sext(value, size * 8) & MASK if signed else value
+
+    def _store(self, addr, size, value):
+        shift = (addr & 3) * 8
+        mask  = ((1 << (size * 8)) - 1) << shift
+        word  = self.mem.get(addr >> 2, 0)
+        self.mem[addr >> 2] = (word & ~mask) | ((value << shift) & mask)
+
+    def step(self):
+        """ Execute a single instruction, returning a 'Retired' tuple. """
+        pc   = self.pc
+        inst = self.mem.get(pc >> 2, 0)
+        op   = (inst >> 2) & 0x1f
+        rd   = (inst >> 7) & 0x1f
+        f3   = (inst >> 12) & 0x7
+        rs1  = self.regs[(inst >> 15) & 0x1f]
+        rs2  = self.regs[(inst >> 20) & 0x1f]
+        f7   = (inst >> 25) & 0x7f
+
+        imm_i = _sext(inst >> 20, 12)
+        imm_s = _sext(((inst >> 25) << 5) | ((inst >> 7) & 0x1f), 12)
+        imm_b = _sext(((inst >> 31) << 12) | (((inst >> 7) & 1) << 11) |
+                      (((inst >> 25) & 0x3f) << 5) |
+                      (((inst >> 8) & 0xf) << 1), 13)
+        imm_u = inst & 0xfffff000
+        imm_j = _sext(((inst >> 31) << 20) | (((inst >> 12) & 0xff) << 12) |
+                      (((inst >> 20) & 1) << 11) |
+                      (((inst >> 21) & 0x3ff) << 1), 21)
+
+        next_pc = (pc + 4) & MASK
+        res  = None
+        addr = None
+
+        if op == Opcode.LUI.value:
+            res = imm_u
+        elif op == Opcode.AUIPC.value:
+            res = (pc + imm_u) & MASK
+        elif op == Opcode.JAL.value:
+            res, next_pc = next_pc, (pc + imm_j) & MASK
+        elif op == Opcode.JALR.value:
+            res, next_pc = next_pc, (rs1 + imm_i) & MASK & ~1
+        elif op == Opcode.BRANCH.value:
+            taken = {
+                BRUOp.BEQ.value:  rs1 == rs2,
+                BRUOp.BNE.value:  rs1 != rs2,
+                BRUOp.BLT.value:  _signed(rs1) < _signed(rs2),
+                BRUOp.BGE.value:  _signed(rs1) >= _signed(rs2),
+                BRUOp.BLTU.value: rs1 < rs2,
+                BRUOp.BGEU.value: rs1 >= rs2,
+            }.get(f3, False)
+            if taken:
+                next_pc = (pc + imm_b) & MASK
+        elif op == Opcode.LOAD.value:
+            addr = (rs1 + imm_i) & MASK
+            size, signed = {
+                Funct3.B:  (1, True),  Funct3.H:  (2, True),
+                Funct3.W:  (4, False), Funct3.BU: (1, False),
+                Funct3.HU: (2, False),
+            }.get(f3, (4, False))
+            res = self._load(addr, size, signed)
+        elif op == Opcode.STORE.value:
+            addr = (rs1 + imm_s) & MASK
+            size = { Funct3.B: 1, Funct3.H: 2 }.get(f3, 4)
+            self._store(addr, size, rs2)
+        elif op in (Opcode.OP_IMM.value, Opcode.OP.value):
+            y = imm_i & MASK if op == Opcode.OP_IMM.value else rs2
+            alt = (f7 & 0x20) != 0
+            shamt = y & 0x1f
+            if f3 == Funct3.ADD:
+                if op == Opcode.OP.value and alt:
+                    res = (rs1 - y) & MASK
+                else:
+                    res = (rs1 + y) & MASK
+            elif f3 == Funct3.SLL:
+                res = (rs1 << shamt) & MASK
+            elif f3 == Funct3.SLT:
+                res = int(_signed(rs1) < _signed(y))
+            elif f3 == Funct3.SLTU:
+                res = int(rs1 < y)
+            elif f3 == Funct3.XOR:
+                res = rs1 ^ y
+            elif f3 == Funct3.SRx:
+                if alt:
+                    res = (_signed(rs1) >> shamt) & MASK
+                else:
+                    res = rs1 >> shamt
+            elif f3 == Funct3.OR:
+                res = rs1 | y
+            elif f3 == Funct3.AND:
+                res = rs1 & y
+        # NOTE: 'fence' and 'ecall'/'ebreak' are treated as a no-op
+
+        if res is not None and rd != 0:
+            self.regs[rd] = res
+        self.pc = next_pc
+        self.icount += 1
+        # A jump to itself is the end of the program
+        if next_pc == pc:
+            self.halted = True
+        return Retired(pc, inst, next_pc, addr)
+
+    def run(self, count, trace=None):
+        """ Execute up to 'count' instructions (or until the program halts).
+        Retired instructions are appended to the list 'trace' (if provided).
+        Returns the number of instructions that were executed.
+        """
+        for idx in range(count):
+            if self.halted:
+                return idx
+            ret = self.step()
+            if trace is not None:
+                trace.append(ret)
+        return count
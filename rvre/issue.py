@@ -2,30 +2,453 @@
 from amaranth import *
 from amaranth.hdl.rec import *
 from amaranth.lib.fifo import *
+from amaranth.lib.coding import PriorityEncoder
 
 from .common import *
+from .param import *
 
 class IssueQueueEntry(Layout):
+    """ An entry in the issue queue.
+    Only the parts of a uop needed for wakeup/select are kept here (the rest 
+    of the uop is kept in the payload RAM, and read after it's selected).
+    'prsN_rdy': Source operand N is available (or will be, when issued)
+    'prsN_dep': Mask of speculative loads that source operand N depends on
+    'issued': The uop has been issued, but may still need to be replayed
+    'rob': ROB entry (the index into the payload RAM, and the age of the uop)
+    'prsN_data': Value of source operand N (only in data-capture mode)
+    """
     def __init__(self):
         super().__init__([
-            ("alu_op", ALUOp), 
-            ("lsu_op", LSUOp), 
-            ("bru_op", BRUOp), 
-            ("rd", ArchReg),
-            ("prd", PhysReg),
-            ("prs1", PhysReg),
-            ("prs2", PhysReg),
-        ])
+            ("vld", 1),
+            ("issued", 1),
+            ("prs1_rdy", 1),
+            ("prs2_rdy", 1),
+            ("prs1_dep", PARAM.spec_load_slots),
+            ("prs2_dep", PARAM.spec_load_slots),
+            ("ps1", PhysReg),
+            ("ps2", PhysReg),
+            ("fu", FUClass),
+            ("rob", RobId),
+        ] + _operand_data_layout("prs"))
+
+def _operand_data_layout(prefix):
+    """ Fields for operand values (only used in data-capture mode) """
+    if not PARAM.operand_capture:
+        return []
+    return [ (prefix + "1_data", 32), (prefix + "2_data", 32) ]
+
+def _fu_class(m, op, fu):
+    """ Drive 'fu' with the class of functional unit used by opcode 'op' """
+    with m.Switch(op):
+        with m.Case(Opcode.BRANCH, Opcode.JAL, Opcode.JALR):
+            m.d.comb += fu.eq(FUClass.BRU)
+        with m.Case(Opcode.LOAD, Opcode.STORE):
+            m.d.comb += fu.eq(FUClass.LSU)
+        with m.Default():
+            m.d.comb += fu.eq(FUClass.ALU)
+
+def _dispatch_layout():
+    return Layout([
+        ("en", 1), ("rob", RobId), ("uop", Uop()), ("ps1_rdy", 1), 
+        ("ps2_rdy", 1), ("ok", 1),
+    ] + _operand_data_layout("ps"))
+
+def _issue_layout():
+    return Layout([
+        ("vld", 1), ("rob", RobId), ("fu", FUClass), ("uop", Uop()), 
+        ("dep", PARAM.spec_load_slots),
+    ] + _operand_data_layout("ps"))
+
+def _writeback_layout():
+    return Layout([ ("en", 1), ("prd", PhysReg), ("data", 32) ])
+
+def _payload_write(m, wp, dispatch):
+    """ Write the payload of a dispatched uop into the payload RAM """
+    payload = Record(UopPayload())
+    m.d.comb += [ payload[name].eq(dispatch.uop[name]) 
+                  for name in payload.fields ]
+    m.d.comb += [
+        wp.en.eq(dispatch.ok),
+        wp.addr.eq(dispatch.rob),
+        wp.data.eq(payload),
+    ]
+
+def _payload_read(m, rp, sel, issue):
+    """ Read the payload for the selected uop 'sel' from the payload RAM.
+    The selected tags are registered, so that 'issue' is valid on the 
+    cycle after select (along with the data from the RAM).
+    """
+    payload = Record(UopPayload())
+    m.d.comb += [
+        rp.addr.eq(sel.rob),
+        payload.eq(rp.data),
+    ]
+    m.d.comb += [ issue.uop[name].eq(payload[name])
+                  for name in payload.fields ]
+    m.d.sync += [
+        issue.vld.eq(sel.vld),
+        issue.rob.eq(sel.rob),
+        issue.fu.eq(sel.fu),
+        issue.dep.eq(sel.dep),
+        issue.uop.ps1.eq(sel.uop.ps1),
+        issue.uop.ps2.eq(sel.uop.ps2),
+    ]
+    if PARAM.operand_capture:
+        m.d.sync += [
+            issue.ps1_data.eq(sel.ps1_data),
+            issue.ps2_data.eq(sel.ps2_data),
+        ]
 
 class IssueUnit(Elaboratable):
-    def __init__(self, queue_size):
+    """ Out-of-order issue queue (scheduler).
+
+    'dispatch': Renamed uop (in ROB entry 'rob') entering the queue ('ok' 
+        when there is space). 'ps1_rdy'/'ps2_rdy' indicate that the source 
+        operands are not busy.
+    'wakeup': Broadcast of a physical register that will be written.
+        'dep' is the set of speculative loads the producer depends on.
+    'spec_wakeup': Speculative broadcast for the destination of a load that
+        is predicted to hit in the L1 cache (in speculative load slot 'slot')
+    'confirm': The load in 'slot' hit; its dependents no longer need to be
+        kept around for replay
+    'replay': The load in 'slot' missed; dependents issued speculatively are
+        made un-ready again (and re-issued after the data actually arrives)
+    'select': The selected uop (only the tags; 'dep' is the set of 
+        speculative loads that the result depends on, and should be sent 
+        back along with the wakeup)
+    'issue': The selected uop, on the cycle after select (with the rest of 
+        the uop from the payload RAM)
+    'i_stall': Don't issue anything on this cycle
+    'i_rob_head': Oldest ROB entry (the oldest ready uop is selected first)
+    'o_free': Number of free entries
+
+    A uop with speculatively-ready operands stays in the queue after issue
+    until all of the loads it depends on have been confirmed.
+
+    When 'RVREParams.operand_capture' is set, entries also hold the values
+    of source operands. These are captured at dispatch ('ps1_data' and 
+    'ps2_data', for operands that are already available), or from the
+    'writeback' bus, and are sent out with the issued uop. Otherwise, 
+    operands are read from the physical register file after issue.
+    NOTE: An operand that was woken up before its value is written back 
+    has to be forwarded from the bypass network.
+
+    The payload RAM is only used when 'payload' is set. Otherwise, the owner 
+    is expected to read the payload for 'select' (see 'DistributedIssueUnit').
+    """
+    def __init__(self, queue_size, payload=True):
         self.queue_size = queue_size
-        self.q = Array(Record(IssueQueueEntry) for _ in range(queue_size))
+        self.q = Array(Record(IssueQueueEntry()) for _ in range(queue_size))
+        self.payload = None
+        if payload:
+            self.payload = Memory(width=len(Record(UopPayload())), 
+                                  depth=PARAM.rob_size)
+
+        slots = PARAM.spec_load_slots
+        self.dispatch = Record(_dispatch_layout())
+        self.wakeup = Record([ ("en", 1), ("prd", PhysReg), ("dep", slots) ])
+        self.spec_wakeup = Record([
+            ("en", 1), ("prd", PhysReg), ("slot", range(slots)),
+        ])
+        self.confirm = Record([ ("en", 1), ("slot", range(slots)) ])
+        self.replay  = Record([ ("en", 1), ("slot", range(slots)) ])
+        self.select  = Record([
+            ("vld", 1), ("rob", RobId), ("fu", FUClass), 
+            ("uop", [ ("ps1", PhysReg), ("ps2", PhysReg) ]), ("dep", slots),
+        ] + _operand_data_layout("ps"))
+        self.issue   = Record(_issue_layout())
+        if PARAM.operand_capture:
+            self.writeback = Record(_writeback_layout())
+        self.i_stall = Signal()
+        self.i_rob_head = Signal(RobId)
+        self.o_free  = Signal(range(queue_size + 1))
+
+        self.free_enc = PriorityEncoder(queue_size)
+        self.sel_enc  = PriorityEncoder(queue_size)
+
+    def ports(self):
+        return [
+            *flatten(self.dispatch),
+            *self.wakeup.fields.values(),
+            *self.spec_wakeup.fields.values(),
+            *self.confirm.fields.values(),
+            *self.replay.fields.values(),
+            *flatten(self.select),
+            *flatten(self.issue),
+            *(self.writeback.fields.values() if PARAM.operand_capture else []),
+            self.i_stall,
+            self.i_rob_head,
+            self.o_free,
+        ]
+
+    def _wakeup(self, m, tag, rdy_next, dep_next):
+        """ Drive the next state of a source operand when 'tag' is woken up
+        on this cycle. A wakeup that depends on a load which is replayed on 
+        the same cycle is ignored.
+        """
+        wk   = self.wakeup.en & (self.wakeup.prd == tag)
+        swk  = self.spec_wakeup.en & (self.spec_wakeup.prd == tag)
+        cmask = Mux(self.confirm.en, 1 << self.confirm.slot, 0)
+        rmask = Mux(self.replay.en, 1 << self.replay.slot, 0)
+        with m.If(wk & ((self.wakeup.dep & rmask) == 0)):
+            m.d.comb += [
+                rdy_next.eq(1),
+                dep_next.eq(self.wakeup.dep & ~cmask),
+            ]
+        with m.Elif(swk & (((1 << self.spec_wakeup.slot) & rmask) == 0)):
+            m.d.comb += [
+                rdy_next.eq(1),
+                dep_next.eq(1 << self.spec_wakeup.slot),
+            ]
+
+    def _operand(self, m, rdy, dep, tag, rdy_next, dep_next):
+        """ Compute the next state of a source operand """
+        cmask = Mux(self.confirm.en, 1 << self.confirm.slot, 0)
+        rmask = Mux(self.replay.en, 1 << self.replay.slot, 0)
+        killed = (dep & rmask) != 0
+        m.d.comb += [
+            rdy_next.eq(rdy & ~killed),
+            dep_next.eq(dep & ~cmask & ~rmask),
+        ]
+        self._wakeup(m, tag, rdy_next, dep_next)
+        return killed
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.free_enc = free_enc = self.free_enc
+        m.submodules.sel_enc  = sel_enc  = self.sel_enc
+
+        slots = PARAM.spec_load_slots
+
+        # Select the oldest ready entry. An entry with an operand that is 
+        # being replayed on this cycle isn't ready.
+        rmask = Mux(self.replay.en, 1 << self.replay.slot, 0)
+        ready = Signal(self.queue_size)
+        free  = Signal(self.queue_size)
+        for i in range(self.queue_size):
+            e = self.q[i]
+            m.d.comb += [
+                ready[i].eq(e.vld & ~e.issued & e.prs1_rdy & e.prs2_rdy &
+                            (((e.prs1_dep | e.prs2_dep) & rmask) == 0)),
+                free[i].eq(~e.vld),
+            ]
+        age = [ rob_age(self.q[i].rob, self.i_rob_head)
+                for i in range(self.queue_size) ]
+        oldest = Signal(self.queue_size)
+        for i in range(self.queue_size):
+            older = [ ~ready[j] | (age[i] < age[j])
+                      for j in range(self.queue_size) if j != i ]
+            m.d.comb += oldest[i].eq(ready[i] & Cat(*older).all())
+        m.d.comb += [
+            sel_enc.i.eq(oldest),
+            free_enc.i.eq(free),
+            self.o_free.eq(sum(free[i] for i in range(self.queue_size))),
+        ]
+        sel = self.q[sel_enc.o]
+        do_issue = Signal()
+        m.d.comb += [
+            do_issue.eq(~sel_enc.n & ~self.i_stall),
+            self.select.vld.eq(do_issue),
+            self.select.rob.eq(sel.rob),
+            self.select.fu.eq(sel.fu),
+            self.select.uop.ps1.eq(sel.ps1),
+            self.select.uop.ps2.eq(sel.ps2),
+            self.select.dep.eq(sel.prs1_dep | sel.prs2_dep),
+        ]
+        if PARAM.operand_capture:
+            m.d.comb += [
+                self.select.ps1_data.eq(sel.prs1_data),
+                self.select.ps2_data.eq(sel.prs2_data),
+            ]
+
+        # Wakeup, confirm, and replay for each entry
+        for i in range(self.queue_size):
+            e = self.q[i]
+            rdy1 = Signal(name="rdy1_{}".format(i))
+            rdy2 = Signal(name="rdy2_{}".format(i))
+            dep1 = Signal(slots, name="dep1_{}".format(i))
+            dep2 = Signal(slots, name="dep2_{}".format(i))
+            kill1 = self._operand(m, e.prs1_rdy, e.prs1_dep, e.ps1, rdy1, dep1)
+            kill2 = self._operand(m, e.prs2_rdy, e.prs2_dep, e.ps2, rdy2, dep2)
+            issued = Signal(name="issued_{}".format(i))
+            m.d.comb += issued.eq(e.issued | (do_issue & (sel_enc.o == i)))
+
+            m.d.sync += [
+                e.prs1_rdy.eq(rdy1), e.prs1_dep.eq(dep1),
+                e.prs2_rdy.eq(rdy2), e.prs2_dep.eq(dep2),
+            ]
+            if PARAM.operand_capture:
+                wb = self.writeback
+                with m.If(wb.en & (wb.prd == e.ps1)):
+                    m.d.sync += e.prs1_data.eq(wb.data)
+                with m.If(wb.en & (wb.prd == e.ps2)):
+                    m.d.sync += e.prs2_data.eq(wb.data)
+            with m.If(e.vld):
+                with m.If(kill1 | kill2):
+                    # Replay: this must be issued again
+                    m.d.sync += e.issued.eq(0)
+                with m.Elif(issued & (dep1 == 0) & (dep2 == 0)):
+                    # Not speculative (or all loads confirmed): free the entry
+                    m.d.sync += [ e.vld.eq(0), e.issued.eq(0) ]
+                with m.Else():
+                    m.d.sync += e.issued.eq(issued)
+
+        # Dispatch into the first free entry
+        d = self.dispatch
+        fu = Signal(FUClass)
+        _fu_class(m, d.uop.op, fu)
+        m.d.comb += d.ok.eq(d.en & ~free_enc.n)
+        rdy1 = Signal()
+        rdy2 = Signal()
+        dep1 = Signal(slots)
+        dep2 = Signal(slots)
+        m.d.comb += [ 
+            rdy1.eq(d.ps1_rdy), rdy2.eq(d.ps2_rdy), dep1.eq(0), dep2.eq(0),
+        ]
+        self._wakeup(m, d.uop.ps1, rdy1, dep1)
+        self._wakeup(m, d.uop.ps2, rdy2, dep2)
+        with m.If(d.ok):
+            e = self.q[free_enc.o]
+            m.d.sync += [
+                e.vld.eq(1),
+                e.issued.eq(0),
+                e.ps1.eq(d.uop.ps1),
+                e.ps2.eq(d.uop.ps2),
+                e.fu.eq(fu),
+                e.rob.eq(d.rob),
+                e.prs1_rdy.eq(rdy1),
+                e.prs2_rdy.eq(rdy2),
+                e.prs1_dep.eq(dep1),
+                e.prs2_dep.eq(dep2),
+            ]
+            if PARAM.operand_capture:
+                wb  = self.writeback
+                wb1 = wb.en & (wb.prd == d.uop.ps1)
+                wb2 = wb.en & (wb.prd == d.uop.ps2)
+                m.d.sync += [
+                    e.prs1_data.eq(Mux(wb1, wb.data, d.ps1_data)),
+                    e.prs2_data.eq(Mux(wb2, wb.data, d.ps2_data)),
+                ]
+
+        if self.payload is not None:
+            m.submodules.payload_wp = wp = self.payload.write_port()
+            m.submodules.payload_rp = rp = self.payload.read_port()
+            _payload_write(m, wp, d)
+            _payload_read(m, rp, self.select, self.issue)
+
+        return m
+
+class DistributedIssueUnit(Elaboratable):
+    """ Separate reservation stations for each class of functional unit.
+
+    Each station is an 'IssueUnit', and only compares wakeup tags against
+    its own entries. Uops are steered to a station by 'FUClass' (from the 
+    opcode), and ALU uops go to whichever ALU station has the most free 
+    entries. All of the stations share a single payload RAM.
+
+    'dispatch', 'wakeup', 'spec_wakeup', 'confirm', 'replay', 'writeback': 
+        Same as for 'IssueUnit' (everything except 'dispatch' is sent to all 
+        stations)
+    'o_class': Class of the uop being dispatched
+    'issue': Issue port for each station (the ALU stations, then the BRU 
+        and LSU stations), on the cycle after select
+    'i_stall': Don't issue from a station on this cycle (one bit per station)
+    'i_rob_head': Oldest ROB entry
+    """
+    def __init__(self, alu_count, alu_size, bru_size, lsu_size):
+        self.alu = [ IssueUnit(alu_size, payload=False) 
+                     for _ in range(alu_count) ]
+        self.bru = IssueUnit(bru_size, payload=False)
+        self.lsu = IssueUnit(lsu_size, payload=False)
+        self.stations = [ *self.alu, self.bru, self.lsu ]
+        self.payload  = Memory(width=len(Record(UopPayload())), 
+                               depth=PARAM.rob_size)
+
+        slots = PARAM.spec_load_slots
+        self.dispatch = Record(_dispatch_layout())
+        self.wakeup = Record([ ("en", 1), ("prd", PhysReg), ("dep", slots) ])
+        self.spec_wakeup = Record([
+            ("en", 1), ("prd", PhysReg), ("slot", range(slots)),
+        ])
+        self.confirm = Record([ ("en", 1), ("slot", range(slots)) ])
+        self.replay  = Record([ ("en", 1), ("slot", range(slots)) ])
+        if PARAM.operand_capture:
+            self.writeback = Record(_writeback_layout())
+        self.o_class = Signal(FUClass)
+        self.issue   = [
+            Record(_issue_layout(), name="issue{}".format(i))
+            for i in range(len(self.stations))
+        ]
+        self.i_stall = Signal(len(self.stations))
+        self.i_rob_head = Signal(RobId)
+
+    def ports(self):
+        return [
+            *flatten(self.dispatch),
+            *self.wakeup.fields.values(),
+            *self.spec_wakeup.fields.values(),
+            *self.confirm.fields.values(),
+            *self.replay.fields.values(),
+            *(self.writeback.fields.values() if PARAM.operand_capture else []),
+            self.o_class,
+            *[ sig for issue in self.issue for sig in flatten(issue) ],
+            self.i_stall,
+            self.i_rob_head,
+        ]
 
     def elaborate(self, platform):
         m = Module()
+        for i, rs in enumerate(self.alu):
+            m.submodules["alu_rs{}".format(i)] = rs
+        m.submodules.bru_rs = self.bru
+        m.submodules.lsu_rs = self.lsu
+
+        d = self.dispatch
+        _fu_class(m, d.uop.op, self.o_class)
 
-        #for i in queue_size:
+        # Pick the ALU station with the most free entries
+        alu_sel  = Signal(range(len(self.alu)))
+        best_idx = 0
+        best     = self.alu[0].o_free
+        for i, rs in enumerate(self.alu[1:], start=1):
+            more = rs.o_free > best
+            best_idx = Mux(more, i, best_idx)
+            best     = Mux(more, rs.o_free, best)
+        m.d.comb += alu_sel.eq(best_idx)
+
+        m.submodules.payload_wp = wp = self.payload.write_port()
+        _payload_write(m, wp, d)
+
+        for i, rs in enumerate(self.stations):
+            if i < len(self.alu):
+                steer = (self.o_class == FUClass.ALU) & (alu_sel == i)
+            elif rs is self.bru:
+                steer = (self.o_class == FUClass.BRU)
+            else:
+                steer = (self.o_class == FUClass.LSU)
+            m.d.comb += [
+                rs.dispatch.en.eq(d.en & steer),
+                rs.dispatch.rob.eq(d.rob),
+                rs.dispatch.uop.eq(d.uop),
+                rs.dispatch.ps1_rdy.eq(d.ps1_rdy),
+                rs.dispatch.ps2_rdy.eq(d.ps2_rdy),
+                rs.wakeup.eq(self.wakeup),
+                rs.spec_wakeup.eq(self.spec_wakeup),
+                rs.confirm.eq(self.confirm),
+                rs.replay.eq(self.replay),
+                rs.i_stall.eq(self.i_stall[i]),
+                rs.i_rob_head.eq(self.i_rob_head),
+            ]
+            if PARAM.operand_capture:
+                m.d.comb += [
+                    rs.dispatch.ps1_data.eq(d.ps1_data),
+                    rs.dispatch.ps2_data.eq(d.ps2_data),
+                    rs.writeback.eq(self.writeback),
+                ]
+            rp = self.payload.read_port()
+            m.submodules["payload_rp{}".format(i)] = rp
+            _payload_read(m, rp, rs.select, self.issue[i])
+        m.d.comb += d.ok.eq(Cat(rs.dispatch.ok for rs in self.stations).any())
 
         return m
 
@@ -56,4 +479,3 @@ class IssueQueue(Elaboratable):
 
         return m
 
-
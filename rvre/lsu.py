@@ -1,3 +1,403 @@
+""" lsu.py
+Load/store unit logic.
+"""
+
 from enum import Enum, unique
+from math import ceil, log2
+
+from amaranth import *
+from amaranth.hdl.rec import *
+from amaranth.lib.coding import PriorityEncoder
+
+from .common import *
+from .param import *
+
+__all__ = [ "StoreSetPredictor", "LoadQueue", "LoadHitPredictor" ]
+
+class StoreSetPredictor(Elaboratable):
+    """ Store-set memory dependence predictor.
+
+    A load is allowed to issue before older stores with unknown addresses,
+    unless it previously caused an ordering violation with one of them.
+    Loads and stores that have conflicted are placed in the same "store set."
+
+    - The store set ID table (SSIT) maps the PC of a load/store to its store
+      set ID (SSID)
+    - The last fetched store table (LFST) maps an SSID to the ROB entry of the
+      most-recently dispatched store in the set
+
+    'dispatch': A load/store is being dispatched (in program order).
+        'dep_vld'/'dep_rob' indicate a store which must issue first.
+        'ssid_vld'/'ssid' must be kept with a store until it issues.
+    'store_issue': A store has issued (and may leave its store set)
+    'violation': A load was found to have executed before an older store
+        to the same address. Both are placed into the same store set, and
+        'flush' is asserted on the next cycle.
+    'flush': Machine state must be flushed starting from the violating load
+        (which is then re-fetched from 'pc')
+    'i_squash': Uops in the pipeline are being flushed
+
+    The SSIT is periodically cleared (every 'clear_interval' cycles) so that
+    stale dependences don't serialize memory operations forever.
+    """
+    def __init__(self, ssit_size, lfst_size, clear_interval):
+        self.ssit_size = ssit_size
+        self.lfst_size = lfst_size
+        self.clear_interval = clear_interval
+        self.ssit_bits = ceil(log2(ssit_size))
+        self.ssid_bits = ceil(log2(lfst_size))
+
+        self._dispatch_layout = Layout([
+            ("en", 1), ("pc", 32), ("store", 1), ("rob", RobId),
+            ("ssid_vld", 1), ("ssid", self.ssid_bits),
+            ("dep_vld", 1), ("dep_rob", RobId),
+        ])
+        self._store_issue_layout = Layout([
+            ("en", 1), ("ssid", self.ssid_bits), ("rob", RobId),
+        ])
+        self._violation_layout = Layout([
+            ("en", 1), ("load_pc", 32), ("load_rob", RobId), ("store_pc", 32),
+        ])
+        self._flush_layout = Layout([
+            ("en", 1), ("pc", 32), ("rob", RobId),
+        ])
+
+        self.ssit_vld = Array(Signal() for _ in range(ssit_size))
+        self.ssit_id  = Array(Signal(self.ssid_bits) for _ in range(ssit_size))
+        self.lfst_vld = Array(Signal() for _ in range(lfst_size))
+        self.lfst_rob = Array(Signal(RobId) for _ in range(lfst_size))
+
+        self.dispatch    = Record(self._dispatch_layout)
+        self.store_issue = Record(self._store_issue_layout)
+        self.violation   = Record(self._violation_layout)
+        self.flush       = Record(self._flush_layout)
+        self.i_squash    = Signal()
+
+    def ports(self):
+        return [
+            *self.dispatch.fields.values(),
+            *self.store_issue.fields.values(),
+            *self.violation.fields.values(),
+            *self.flush.fields.values(),
+            self.i_squash,
+        ]
+
+    def _ssit_idx(self, pc):
+        return pc[2:2 + self.ssit_bits]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Dispatch: look up the store set, and the last store in the set
+        d    = self.dispatch
+        didx = self._ssit_idx(d.pc)
+        m.d.comb += [
+            d.ssid_vld.eq(d.en & self.ssit_vld[didx]),
+            d.ssid.eq(self.ssit_id[didx]),
+            d.dep_vld.eq(d.ssid_vld & self.lfst_vld[d.ssid]),
+            d.dep_rob.eq(self.lfst_rob[d.ssid]),
+        ]
+
+        # A store leaves its store set after issuing, unless some younger
+        # store in the same set has been dispatched
+        si = self.store_issue
+        with m.If(si.en & (self.lfst_rob[si.ssid] == si.rob)):
+            m.d.sync += self.lfst_vld[si.ssid].eq(0)
+
+        # Dispatched stores become the last store in their set
+        with m.If(d.store & d.ssid_vld):
+            m.d.sync += [
+                self.lfst_vld[d.ssid].eq(1),
+                self.lfst_rob[d.ssid].eq(d.rob),
+            ]
+
+        # Periodically forget all store sets
+        clear_ctr = Signal(range(self.clear_interval))
+        clear = Signal()
+        m.d.comb += clear.eq(clear_ctr == self.clear_interval - 1)
+        m.d.sync += clear_ctr.eq(Mux(clear, 0, clear_ctr + 1))
+        with m.If(clear):
+            m.d.sync += [ self.ssit_vld[i].eq(0) for i in range(self.ssit_size) ]
+
+        # Violation: put the load and store into the same set.
+        # If both already belong to a set, they both use the smaller SSID.
+        v = self.violation
+        lidx = self._ssit_idx(v.load_pc)
+        sidx = self._ssit_idx(v.store_pc)
+        lvld, lid = self.ssit_vld[lidx], self.ssit_id[lidx]
+        svld, sid = self.ssit_vld[sidx], self.ssit_id[sidx]
+        new_id = Signal(self.ssid_bits)
+        with m.If(lvld & svld):
+            m.d.comb += new_id.eq(Mux(lid < sid, lid, sid))
+        with m.Elif(lvld):
+            m.d.comb += new_id.eq(lid)
+        with m.Elif(svld):
+            m.d.comb += new_id.eq(sid)
+        with m.Else():
+            m.d.comb += new_id.eq(v.load_pc[2:2 + self.ssid_bits])
+
+        with m.If(v.en):
+            m.d.sync += [
+                self.ssit_vld[lidx].eq(1),
+                self.ssit_id[lidx].eq(new_id),
+                self.ssit_vld[sidx].eq(1),
+                self.ssit_id[sidx].eq(new_id),
+            ]
+
+        m.d.sync += [
+            self.flush.en.eq(v.en),
+            self.flush.pc.eq(v.load_pc),
+            self.flush.rob.eq(v.load_rob),
+        ]
+
+        # Stores in the LFST may be squashed, so forget about all of them
+        with m.If(self.i_squash | v.en):
+            m.d.sync += [ self.lfst_vld[i].eq(0) for i in range(self.lfst_size) ]
+
+        return m
+
+
+class LoadQueueEntry(Layout):
+    def __init__(self):
+        super().__init__([
+            ("vld",  1),
+            ("done", 1),
+            ("rob",  RobId),
+            ("pc",   32),
+            ("addr", 32),
+        ])
+
+class LoadQueue(Elaboratable):
+    """ Circular queue of in-flight loads (in program order).
+
+    'alloc': A load is being dispatched ('idx' is kept with the load)
+    'execute': A load has computed its address and read memory
+    'retire': The oldest load is retiring
+    'check': A store has computed its address; checks for younger loads to
+        the same (word) address that have already executed
+    'violation': The oldest load that executed before the store in 'check'
+    'squash': Removes all loads that are not older than ROB entry 'rob'
+        (including a load allocated on the same cycle)
+    'i_rob_head': Oldest ROB entry (for comparing the age of uops)
+    """
+    def __init__(self, size):
+        self.size = size
+        self.q = Array(Record(LoadQueueEntry()) for _ in range(size))
+
+        self.alloc = Record([
+            ("en", 1), ("rob", RobId), ("pc", 32),
+            ("ok", 1), ("idx", range(size)),
+        ])
+        self.execute = Record([
+            ("en", 1), ("idx", range(size)), ("addr", 32),
+        ])
+        self.retire = Record([ ("en", 1) ])
+        self.check = Record([
+            ("en", 1), ("rob", RobId), ("pc", 32), ("addr", 32),
+        ])
+        self.violation = Record([
+            ("en", 1), ("load_pc", 32), ("load_rob", RobId), ("store_pc", 32),
+        ])
+        self.squash = Record([ ("en", 1), ("rob", RobId) ])
+        self.i_rob_head = Signal(RobId)
+
+        self.enc = PriorityEncoder(size)
+
+    def ports(self):
+        return [
+            *self.alloc.fields.values(),
+            *self.execute.fields.values(),
+            *self.retire.fields.values(),
+            *self.check.fields.values(),
+            *self.violation.fields.values(),
+            *self.squash.fields.values(),
+            self.i_rob_head,
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.enc = enc = self.enc
+
+        head  = Signal(range(self.size))
+        tail  = Signal(range(self.size))
+        count = Signal(range(self.size + 1))
+
+        def wrap(x):
+            return Mux(x >= self.size, x - self.size, x)[0:len(head)]
+
+        # Allocate/retire
+        m.d.comb += [
+            self.alloc.ok.eq(self.alloc.en & (count != self.size)),
+            self.alloc.idx.eq(tail),
+        ]
+        with m.If(self.alloc.ok):
+            m.d.sync += [
+                self.q[tail].vld.eq(1),
+                self.q[tail].done.eq(0),
+                self.q[tail].rob.eq(self.alloc.rob),
+                self.q[tail].pc.eq(self.alloc.pc),
+                tail.eq(wrap(tail + 1)),
+            ]
+        with m.If(self.retire.en):
+            m.d.sync += [
+                self.q[head].vld.eq(0),
+                head.eq(wrap(head + 1)),
+            ]
+        m.d.sync += count.eq(count + self.alloc.ok - self.retire.en)
+
+        with m.If(self.execute.en):
+            m.d.sync += [
+                self.q[self.execute.idx].done.eq(1),
+                self.q[self.execute.idx].addr.eq(self.execute.addr),
+            ]
+
+        # Find the oldest (closest to the head) load that violates ordering
+        st_age = rob_age(self.check.rob, self.i_rob_head)
+        match  = Signal(self.size)
+        for k in range(self.size):
+            e = self.q[wrap(head + k)]
+            m.d.comb += match[k].eq(e.vld & e.done &
+                (e.addr[2:] == self.check.addr[2:]) &
+                (rob_age(e.rob, self.i_rob_head) > st_age)
+            )
+        oldest = self.q[wrap(head + enc.o)]
+        m.d.comb += [
+            enc.i.eq(match),
+            self.violation.en.eq(self.check.en & ~enc.n),
+            self.violation.load_pc.eq(oldest.pc),
+            self.violation.load_rob.eq(oldest.rob),
+            self.violation.store_pc.eq(self.check.pc),
+        ]
+
+        # Squash loads that are not older than the flushed ROB entry.
+        # The remaining loads are contiguous from the head (or from the 
+        # entry after it, when the head is retiring on the same cycle).
+        sq_age = rob_age(self.squash.rob, self.i_rob_head)
+        keep   = Signal(self.size)
+        for i in range(self.size):
+            e = self.q[i]
+            m.d.comb += keep[i].eq(e.vld &
+                (rob_age(e.rob, self.i_rob_head) < sq_age) &
+                ~(self.retire.en & (head == i)))
+        num_kept = Signal(range(self.size + 1))
+        m.d.comb += num_kept.eq(sum(keep[i] for i in range(self.size)))
+        with m.If(self.squash.en):
+            m.d.sync += [ self.q[i].vld.eq(keep[i]) for i in range(self.size) ]
+            m.d.sync += [
+                tail.eq(wrap(head + self.retire.en + num_kept)),
+                count.eq(num_kept),
+            ]
+
+        return m
+
+
+class LoadHitPredictor(Elaboratable):
+    """ Predicts whether or not a load will hit in the L1 cache.
+
+    When a load that is predicted to hit is issued, it takes one of the 
+    speculative load slots. After 'latency' cycles, dependents of the load are
+    woken up (with 'spec_wakeup') before the data is known to be available.
+    When the load resolves, the slot is released and dependents are either
+    confirmed or replayed (with 'confirm' and 'replay').
+
+    'issue': A load is being issued. 'spec' indicates that the load has a
+        speculative load slot (and must be resolved later).
+    'resolve': The load in 'slot' has either hit or missed
+    'spec_wakeup'/'confirm'/'replay': Signals for the issue queue (when 
+        more than one slot is due on the same cycle, the others are woken 
+        up on the following cycles)
+
+    Each entry is a 2-bit saturating counter indexed by the load PC.
+    """
+    def __init__(self, size, latency, slots):
+        self.size    = size
+        self.latency = latency
+        self.slots   = slots
+        self.idx_bits = ceil(log2(size))
+
+        self.ctr = Array(Signal(2, reset=0b11) for _ in range(size))
+        self.slot_vld = Array(Signal() for _ in range(slots))
+        self.slot_pc  = Array(Signal(self.idx_bits) for _ in range(slots))
+        self.slot_prd = Array(Signal(PhysReg) for _ in range(slots))
+        self.slot_tmr = Array(Signal(range(latency + 1)) for _ in range(slots))
+
+        self.issue = Record([
+            ("en", 1), ("pc", 32), ("prd", PhysReg),
+            ("spec", 1), ("slot", range(slots)),
+        ])
+        self.resolve = Record([ ("en", 1), ("slot", range(slots)), ("hit", 1) ])
+        self.spec_wakeup = Record([
+            ("en", 1), ("prd", PhysReg), ("slot", range(slots)),
+        ])
+        self.confirm = Record([ ("en", 1), ("slot", range(slots)) ])
+        self.replay  = Record([ ("en", 1), ("slot", range(slots)) ])
+
+        self.free_enc = PriorityEncoder(slots)
+        self.wake_enc = PriorityEncoder(slots)
+
+    def ports(self):
+        return [
+            *self.issue.fields.values(),
+            *self.resolve.fields.values(),
+            *self.spec_wakeup.fields.values(),
+            *self.confirm.fields.values(),
+            *self.replay.fields.values(),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.free_enc = free_enc = self.free_enc
+        m.submodules.wake_enc = wake_enc = self.wake_enc
+
+        free = Signal(self.slots)
+        fire = Signal(self.slots)
+        for s in range(self.slots):
+            m.d.comb += [
+                free[s].eq(~self.slot_vld[s]),
+                fire[s].eq(self.slot_vld[s] & (self.slot_tmr[s] == 1)),
+            ]
+            # Only one slot can be woken up per cycle; the others wait
+            lost = fire[s] & (wake_enc.o != s)
+            with m.If((self.slot_tmr[s] != 0) & ~lost):
+                m.d.sync += self.slot_tmr[s].eq(self.slot_tmr[s] - 1)
+
+        # Speculatively wake up dependents after the expected hit latency
+        m.d.comb += [
+            wake_enc.i.eq(fire),
+            self.spec_wakeup.en.eq(~wake_enc.n),
+            self.spec_wakeup.slot.eq(wake_enc.o),
+            self.spec_wakeup.prd.eq(self.slot_prd[wake_enc.o]),
+        ]
+
+        # Predict and allocate a slot
+        iidx = self.issue.pc[2:2 + self.idx_bits]
+        m.d.comb += [
+            free_enc.i.eq(free),
+            self.issue.slot.eq(free_enc.o),
+            self.issue.spec.eq(self.issue.en & self.ctr[iidx][1] & ~free_enc.n),
+        ]
+        with m.If(self.issue.spec):
+            m.d.sync += [
+                self.slot_vld[free_enc.o].eq(1),
+                self.slot_pc[free_enc.o].eq(iidx),
+                self.slot_prd[free_enc.o].eq(self.issue.prd),
+                self.slot_tmr[free_enc.o].eq(self.latency),
+            ]
 
+        # Resolve, release the slot, and train the predictor
+        r = self.resolve
+        ctr = self.ctr[self.slot_pc[r.slot]]
+        m.d.comb += [
+            self.confirm.en.eq(r.en & r.hit),
+            self.confirm.slot.eq(r.slot),
+            self.replay.en.eq(r.en & ~r.hit),
+            self.replay.slot.eq(r.slot),
+        ]
+        with m.If(r.en):
+            m.d.sync += self.slot_vld[r.slot].eq(0)
+            with m.If(r.hit & (ctr != 0b11)):
+                m.d.sync += ctr.eq(ctr + 1)
+            with m.Elif(~r.hit & (ctr != 0b00)):
+                m.d.sync += ctr.eq(ctr - 1)
 
+        return m
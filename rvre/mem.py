@@ -0,0 +1,72 @@
+""" mem.py
+Wishbone bus, and a model of the backing memory.
+"""
+
+from math import ceil, log2
+
+from amaranth import *
+from amaranth.hdl.rec import *
+
+__all__ = [ "WishboneBus", "BackingMemory" ]
+
+class WishboneBus(Layout):
+    """ Wishbone (classic cycles) bus with a 32-bit data path.
+    'adr' is a word address. The master holds 'cyc'/'stb' (and the address
+    and data) until the slave asserts 'ack'.
+    """
+    def __init__(self):
+        super().__init__([
+            ("cyc",   1),
+            ("stb",   1),
+            ("we",    1),
+            ("adr",   30),
+            ("sel",   4),
+            ("dat_w", 32),
+            ("dat_r", 32),
+            ("ack",   1),
+        ])
+
+
+class BackingMemory(Elaboratable):
+    """ Model of the main memory, with a Wishbone slave interface.
+    Each access is acknowledged 'latency' cycles after it starts.
+
+    'bus': Wishbone bus (only the low bits of the address are used)
+    """
+    def __init__(self, depth, init=None, latency=1):
+        assert latency >= 1
+        self.depth   = depth
+        self.latency = latency
+        self.mem = Memory(width=32, depth=depth, init=init)
+        self.bus = Record(WishboneBus())
+        self.ctr = Signal(range(latency))
+
+    def ports(self):
+        return [ *self.bus.fields.values() ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rp = rp = self.mem.read_port(transparent=False)
+        m.submodules.wp = wp = self.mem.write_port(granularity=8)
+
+        bus = self.bus
+        idx = bus.adr[0:ceil(log2(self.depth))]
+        m.d.comb += [
+            rp.addr.eq(idx),
+            wp.addr.eq(idx),
+            wp.data.eq(bus.dat_w),
+            wp.en.eq(Mux(bus.ack & bus.we, bus.sel, 0)),
+            bus.dat_r.eq(rp.data),
+        ]
+
+        m.d.sync += bus.ack.eq(0)
+        with m.If(bus.cyc & bus.stb & ~bus.ack):
+            with m.If(self.ctr == self.latency - 1):
+                m.d.sync += [
+                    bus.ack.eq(1),
+                    self.ctr.eq(0),
+                ]
+            with m.Else():
+                m.d.sync += self.ctr.eq(self.ctr + 1)
+
+        return m
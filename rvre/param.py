@@ -2,8 +2,87 @@
 """
 
 class RVREParams():
-    def __init__(self, arf_size=32, prf_size=64):
+    def __init__(self, arf_size=32, prf_size=64, rob_size=32, iq_size=16,
+                 uop_cache_lines=16, uop_cache_width=4,
+                 lq_size=8, ssit_size=64, lfst_size=16, 
+                 ssit_clear_interval=16384, 
+                 spec_load_slots=2, l1_hit_latency=2, lhp_size=64,
+                 rvc=False,
+                 rs_alu_count=2, rs_alu_size=8, rs_bru_size=4, 
+                 rs_lsu_size=8, operand_capture=False, smt_threads=1,
+                 cores=2, l1i_lines=16, l1d_lines=16, l2_lines=64, 
+                 line_words=4, mem_latency=8,
+                 l1i_prefetch=False, l1d_prefetch=False, pf_degree=2,
+                 pf_distance=1, pf_interval=64, rpt_size=16):
         self.arf_size = arf_size
         self.prf_size = prf_size
+        self.rob_size = rob_size
+        self.iq_size  = iq_size
+
+        # Number of lines in the uop cache, and the number of uops per line
+        self.uop_cache_lines = uop_cache_lines
+        self.uop_cache_width = uop_cache_width
+
+        # Load queue size
+        self.lq_size = lq_size
+
+        # Store-set predictor: number of store set ID table (SSIT) entries, 
+        # number of last fetched store table (LFST) entries, and the number
+        # of cycles between clearing the SSIT
+        self.ssit_size = ssit_size
+        self.lfst_size = lfst_size
+        self.ssit_clear_interval = ssit_clear_interval
+
+        # Speculative wakeup for dependents of loads: the number of loads 
+        # that can be in-flight speculatively, the expected latency of a load 
+        # that hits in the L1 cache, and the size of the load hit predictor
+        self.spec_load_slots = spec_load_slots
+        self.l1_hit_latency = l1_hit_latency
+        self.lhp_size = lhp_size
+
+        # Support for the RV32C compressed instructions
+        self.rvc = rvc
+
+        # Separate reservation stations for each class of functional unit
+        # (instead of a single issue queue with 'iq_size' entries): the 
+        # number of ALU stations, and the size of each kind of station
+        self.rs_alu_count = rs_alu_count
+        self.rs_alu_size  = rs_alu_size
+        self.rs_bru_size  = rs_bru_size
+        self.rs_lsu_size  = rs_lsu_size
+
+        # Keep operand values in the issue queue (captured at dispatch and 
+        # from the writeback bus), instead of reading them from the physical
+        # register file after issue
+        self.operand_capture = operand_capture
+
+        # Number of hardware threads (simultaneous multithreading). 
+        # Each thread has its own architectural registers mapped onto the 
+        # physical register file, so 'prf_size' should be increased with it.
+        self.smt_threads = smt_threads
+
+        # Multi-core system (see 'soc.py'): the number of cores, the number
+        # of lines in each private L1 instruction/data cache and in the 
+        # shared L2, the number of words in a cache line, and the latency 
+        # of the backing memory (in cycles, for each word)
+        self.cores       = cores
+        self.l1i_lines   = l1i_lines
+        self.l1d_lines   = l1d_lines
+        self.l2_lines    = l2_lines
+        self.line_words  = line_words
+        self.mem_latency = mem_latency
+
+        # Prefetchers for the L1 caches (see 'prefetch.py'): next-N-line 
+        # prefetching for instructions, and stride prefetching (with a 
+        # 'rpt_size'-entry table) for data. Each trigger prefetches up to 
+        # 'pf_degree' lines (which is throttled by the number of useful 
+        # prefetches every 'pf_interval' triggers), starting 'pf_distance' 
+        # lines/strides ahead.
+        self.l1i_prefetch = l1i_prefetch
+        self.l1d_prefetch = l1d_prefetch
+        self.pf_degree    = pf_degree
+        self.pf_distance  = pf_distance
+        self.pf_interval  = pf_interval
+        self.rpt_size     = rpt_size
 
 PARAM = RVREParams()
@@ -0,0 +1,247 @@
+""" prefetch.py
+Hardware prefetchers for the L1 caches.
+"""
+
+from math import ceil, log2
+
+from amaranth import *
+from amaranth.hdl.rec import *
+
+__all__ = [
+    "PrefetchPort", "PrefetchThrottle", "NextLinePrefetcher",
+    "StridePrefetcher",
+]
+
+class PrefetchPort(Layout):
+    """ Connection between a prefetcher and an L1 cache.
+    'train': An access to the cache completed ('pc' is the address of the
+        instruction that made the access, if there is one)
+    'pf': Prefetch the line containing 'pf_addr' (held until 'pf_ready')
+    'issued': A prefetch was sent to the L2 (the line wasn't present)
+    'useful': A prefetched line was used for the first time
+    """
+    def __init__(self):
+        super().__init__([
+            ("train",      1),
+            ("train_pc",   32),
+            ("train_addr", 32),
+            ("pf",         1),
+            ("pf_addr",    32),
+            ("pf_ready",   1),
+            ("issued",     1),
+            ("useful",     1),
+        ])
+
+
+class PrefetchThrottle(Elaboratable):
+    """ Adjusts the degree of a prefetcher by how many prefetches were useful.
+
+    After every 'interval' triggers, the accuracy (useful/issued) of the
+    prefetches since the last adjustment is checked. The degree is decreased
+    when less than a quarter were useful, and increased when at least three
+    quarters were useful. A prefetcher that was throttled down to zero is
+    turned back on (with degree 1) after the next interval.
+
+    'i_trigger': The prefetcher was triggered
+    'i_issued': A prefetch was issued
+    'i_useful': A prefetch was useful
+    'o_degree': Number of lines to prefetch for each trigger
+    """
+    def __init__(self, max_degree, interval):
+        self.max_degree = max_degree
+        self.interval   = interval
+        self.i_trigger  = Signal()
+        self.i_issued   = Signal()
+        self.i_useful   = Signal()
+        self.o_degree   = Signal(range(max_degree + 1), reset=max_degree)
+
+        self.r_triggers = Signal(range(interval))
+        self.r_issued   = Signal(range(interval * max_degree + 1))
+        self.r_useful   = Signal(range(interval * max_degree + 1))
+
+    def ports(self):
+        return [ self.i_trigger, self.i_issued, self.i_useful, self.o_degree ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # NOTE: Saturates (prefetches that were issued during the previous
+        # interval may become useful during this one)
+        full = 2 ** len(self.r_issued) - 1
+        with m.If(self.i_issued & (self.r_issued != full)):
+            m.d.sync += self.r_issued.eq(self.r_issued + 1)
+        with m.If(self.i_useful & (self.r_useful != full)):
+            m.d.sync += self.r_useful.eq(self.r_useful + 1)
+
+        with m.If(self.i_trigger):
+            m.d.sync += self.r_triggers.eq(self.r_triggers + 1)
+            with m.If(self.r_triggers == self.interval - 1):
+                issued = self.r_issued
+                useful = self.r_useful
+                m.d.sync += [
+                    self.r_triggers.eq(0),
+                    self.r_issued.eq(0),
+                    self.r_useful.eq(0),
+                ]
+                with m.If(self.o_degree == 0):
+                    m.d.sync += self.o_degree.eq(1)
+                with m.Elif((useful << 2) < issued):
+                    m.d.sync += self.o_degree.eq(self.o_degree - 1)
+                with m.Elif(((useful << 2) >= (issued << 1) + issued) &
+                            (self.o_degree != self.max_degree)):
+                    m.d.sync += self.o_degree.eq(self.o_degree + 1)
+
+        return m
+
+
+class NextLinePrefetcher(Elaboratable):
+    """ Next-N-line prefetcher (for the instruction cache).
+
+    When the stream of accesses moves into a new line, the 'degree' lines
+    starting 'distance' lines after it are prefetched (one per cycle).
+
+    'port': Connection to the cache (see 'PrefetchPort')
+    'o_degree': Current degree (see 'PrefetchThrottle')
+    """
+    def __init__(self, line_words, max_degree, distance, interval):
+        self.line_bits = ceil(log2(line_words)) + 2
+        self.distance  = distance
+        self.port      = Record(PrefetchPort())
+        self.throttle  = PrefetchThrottle(max_degree, interval)
+        self.o_degree  = self.throttle.o_degree
+
+        self.r_line = Signal(32 - self.line_bits)
+        self.r_next = Signal(32 - self.line_bits)
+        self.r_left = Signal(range(max_degree + 1))
+
+    def ports(self):
+        return [ *self.port.fields.values(), self.o_degree ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.throttle = throttle = self.throttle
+
+        port = self.port
+        line = port.train_addr[self.line_bits:]
+        trigger = Signal()
+        m.d.comb += [
+            trigger.eq(port.train & (line != self.r_line)),
+            throttle.i_trigger.eq(trigger),
+            throttle.i_issued.eq(port.issued),
+            throttle.i_useful.eq(port.useful),
+            port.pf.eq(self.r_left != 0),
+            port.pf_addr.eq(Cat(C(0, self.line_bits), self.r_next)),
+        ]
+
+        with m.If(port.pf & port.pf_ready):
+            m.d.sync += [
+                self.r_next.eq(self.r_next + 1),
+                self.r_left.eq(self.r_left - 1),
+            ]
+        # A new line replaces any prefetches that weren't sent yet
+        with m.If(trigger):
+            m.d.sync += [
+                self.r_line.eq(line),
+                self.r_next.eq(line + self.distance),
+                self.r_left.eq(throttle.o_degree),
+            ]
+
+        return m
+
+
+class StridePrefetcher(Elaboratable):
+    """ PC-indexed stride prefetcher (for the data cache).
+
+    A direct-mapped table (indexed by the PC of a load/store) tracks the
+    last address used by each instruction, the stride between the last two
+    addresses, and a saturating confidence counter. When an instruction
+    repeats the same (nonzero) stride and the confidence is high enough,
+    'degree' strides starting 'distance' strides ahead are prefetched.
+
+    'port': Connection to the cache (see 'PrefetchPort')
+    'o_degree': Current degree (see 'PrefetchThrottle')
+    """
+    def __init__(self, num_entries, max_degree, distance, interval):
+        self.num_entries = num_entries
+        self.distance    = distance
+        self.idx_bits    = ceil(log2(num_entries))
+        self.tag_bits    = 32 - 2 - self.idx_bits
+        self.port        = Record(PrefetchPort())
+        self.throttle    = PrefetchThrottle(max_degree, interval)
+        self.o_degree    = self.throttle.o_degree
+
+        self.ent_vld    = Array(Signal(name="rpt{}_vld".format(i))
+                                for i in range(num_entries))
+        self.ent_tag    = Array(Signal(self.tag_bits, name="rpt{}_tag".format(i))
+                                for i in range(num_entries))
+        self.ent_last   = Array(Signal(32, name="rpt{}_last".format(i))
+                                for i in range(num_entries))
+        self.ent_stride = Array(Signal(32, name="rpt{}_stride".format(i))
+                                for i in range(num_entries))
+        self.ent_conf   = Array(Signal(2, name="rpt{}_conf".format(i))
+                                for i in range(num_entries))
+
+        self.r_next   = Signal(32)
+        self.r_stride = Signal(32)
+        self.r_left   = Signal(range(max_degree + 1))
+
+    def ports(self):
+        return [ *self.port.fields.values(), self.o_degree ]
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.throttle = throttle = self.throttle
+
+        port = self.port
+        idx  = port.train_pc[2:2 + self.idx_bits]
+        tag  = port.train_pc[2 + self.idx_bits:]
+        conf   = self.ent_conf[idx]
+        stride = self.ent_stride[idx]
+        delta  = Signal(32)
+        same   = Signal()
+        trigger = Signal()
+        m.d.comb += [
+            delta.eq(port.train_addr - self.ent_last[idx]),
+            same.eq(self.ent_vld[idx] & (self.ent_tag[idx] == tag) &
+                    (delta == stride)),
+            trigger.eq(port.train & same & (conf >= 1) & (delta != 0)),
+            throttle.i_trigger.eq(trigger),
+            throttle.i_issued.eq(port.issued),
+            throttle.i_useful.eq(port.useful),
+            port.pf.eq(self.r_left != 0),
+            port.pf_addr.eq(self.r_next),
+        ]
+
+        with m.If(port.pf & port.pf_ready):
+            m.d.sync += [
+                self.r_next.eq(self.r_next + self.r_stride),
+                self.r_left.eq(self.r_left - 1),
+            ]
+        with m.If(trigger):
+            m.d.sync += [
+                self.r_next.eq(port.train_addr + stride * self.distance),
+                self.r_stride.eq(stride),
+                self.r_left.eq(throttle.o_degree),
+            ]
+
+        # Train the table
+        with m.If(port.train):
+            m.d.sync += self.ent_last[idx].eq(port.train_addr)
+            with m.If(~self.ent_vld[idx] | (self.ent_tag[idx] != tag)):
+                m.d.sync += [
+                    self.ent_vld[idx].eq(1),
+                    self.ent_tag[idx].eq(tag),
+                    stride.eq(0),
+                    conf.eq(0),
+                ]
+            with m.Elif(same):
+                with m.If(conf != 3):
+                    m.d.sync += conf.eq(conf + 1)
+            with m.Else():
+                with m.If(conf != 0):
+                    m.d.sync += conf.eq(conf - 1)
+                # Only replace the stride after it stopped being useful
+                with m.If(conf <= 1):
+                    m.d.sync += stride.eq(delta)
+
+        return m
@@ -8,10 +8,20 @@ from amaranth.lib.coding import Encoder, Decoder, PriorityEncoder
 from .param import *
 from .common import *
 
-__all__ = [ "RegisterAliasTable", "RegisterBusyTable", "RegisterFreeTable" ]
+__all__ = [ 
+    "RegisterAliasTable", "RegisterBusyTable", "RegisterFreeTable",
+    "RegisterRefTable", "MoveEliminator",
+]
 
 class RegisterAliasTable(Elaboratable):
-    """ Map from architectural registers to physical registers. """
+    """ Map from architectural registers to physical registers.
+    'i_load': Restore the initial mapping (where architectural register N is 
+              mapped to physical register 'base' + N), i.e. when loading a 
+              new architectural state into the physical register file
+
+    The zero register is always initially mapped to physical register 0 
+    (which is shared by all threads).
+    """
     _rd_port_layout = Layout([ 
         ("areg", ArchReg), ("preg", PhysReg) 
     ])
@@ -19,13 +29,27 @@ class RegisterAliasTable(Elaboratable):
         ("en", 1), ("areg", ArchReg), ("preg", PhysReg)
     ])
 
-    def __init__(self, arf_size, prf_size):
+    def __init__(self, arf_size, prf_size, base=0):
         self.arf_size = arf_size
         self.prf_size = prf_size
-        self.rat = Array(Signal(PhysReg, reset=idx) for idx in range(arf_size))
+        self.base = base
+        self.rat = Array(Signal(PhysReg, reset=self._initial(idx)) 
+                         for idx in range(arf_size))
         self.rp1 = Record(self._rd_port_layout)
         self.rp2 = Record(self._rd_port_layout)
         self.wp1 = Record(self._wr_port_layout)
+        self.i_load = Signal()
+
+    def ports(self):
+        return [
+            *self.rp1.fields.values(),
+            *self.rp2.fields.values(),
+            *self.wp1.fields.values(),
+            self.i_load,
+        ]
+
+    def _initial(self, idx):
+        return self.base + idx if idx != 0 else 0
 
     def elaborate(self, platform):
         m = Module()
@@ -33,7 +57,10 @@ class RegisterAliasTable(Elaboratable):
             self.rp1.preg.eq(self.rat[self.rp1.areg]),
             self.rp2.preg.eq(self.rat[self.rp2.areg])
         ]
-        with m.If(self.wp1.en):
+        with m.If(self.i_load):
+            m.d.sync += [ self.rat[idx].eq(self._initial(idx)) 
+                          for idx in range(self.arf_size) ]
+        with m.Elif(self.wp1.en):
             m.d.sync += self.rat[self.wp1.areg].eq(self.wp1.preg)
         return m
 
@@ -64,6 +91,13 @@ class RegisterBusyTable(Elaboratable):
         self.alloc  = Record(self._alloca_layout)
         self.wakeup = Record(self._wakeup_layout)
 
+    def ports(self):
+        return [
+            *self.commit.fields.values(),
+            *self.alloc.fields.values(),
+            *self.wakeup.fields.values(),
+        ]
+
     def elaborate(self, platform):
         m = Module()
 
@@ -104,21 +138,37 @@ class RegisterBusyTable(Elaboratable):
         return m
 
 class RegisterFreeTable(Elaboratable):
-    """ Free table for physical registers.
+    """ Free table for physical registers (one bit per register).
+    The 'free' bit for a physical register is cleared after being allocated,
+    then set again after it has been released.
+
+    Physical registers [0, arf_size) are bound to the architectural registers
+    by the reset state of the RATs, so they begin in use. With more than one
+    thread, 'arf_size' counts the registers mapped for all threads (each 
+    thread has its own, except for the shared zero register).
     """
     _allocate_layout = Layout([ ("en", 1), ("prd", PhysReg), ("ok", 1) ])
     _free_layout = Layout([ ("prd", PhysReg), ("en", 1) ])
 
-    def __init__(self, prf_size):
+    def __init__(self, prf_size, arf_size):
         self.prf_size = prf_size
-        self.freetbl = Signal(prf_size, reset=~1)
+        self.arf_size = arf_size
+        self.freetbl = Signal(prf_size, 
+            reset=((1 << prf_size) - 1) & ~((1 << arf_size) - 1)
+        )
 
         self.enc = PriorityEncoder(prf_size)
         self.dec0 = Decoder(prf_size)
         self.dec1 = Decoder(prf_size)
 
         self.alloc = Record(self._allocate_layout)
-        self.free  = Record(self._allocate_layout)
+        self.free  = Record(self._free_layout)
+
+    def ports(self):
+        return [
+            *self.alloc.fields.values(),
+            *self.free.fields.values(),
+        ]
 
     def elaborate(self, platform):
         m = Module()
@@ -131,8 +181,8 @@ class RegisterFreeTable(Elaboratable):
         alloc_valid = Signal()
         alloc_ok = Signal()
 
-        alloc_bits = Signal(self.prf_size)
-        free_mask  = Signal(self.prf_size)
+        alloc_mask = Signal(self.prf_size)
+        free_bits  = Signal(self.prf_size)
 
         m.d.comb += [
             enc.i.eq(self.freetbl),
@@ -145,18 +195,158 @@ class RegisterFreeTable(Elaboratable):
 
             dec0.i.eq(alloc_res),
             dec0.n.eq(~alloc_ok),
-            alloc_bits.eq(dec0.o),
+            alloc_mask.eq(~dec0.o),
 
             dec1.i.eq(self.free.prd),
             dec1.n.eq(~self.free.en),
-            free_mask.eq(~dec1.o),
+            free_bits.eq(dec1.o),
         ]
 
         m.d.sync += self.freetbl.eq(
-            (self.freetbl & free_mask) | alloc_bits
+            (self.freetbl & alloc_mask) | free_bits
         )
 
         return m
 
+class RegisterRefTable(Elaboratable):
+    """ Reference counts for physical registers.
+    A physical register may be bound to more than one architectural register 
+    when moves are eliminated during rename. A physical register is only
+    released to the free table after its last reference has been dropped.
 
+    'alloc': A physical register was allocated (with one reference)
+    'inc': A new reference to a physical register was created
+    'dec': A reference to a physical register was dropped
+    'free': Asserted when a physical register can be released
 
+    Physical register 0 is always bound to the zero register, and is never 
+    released. Physical registers [1, arf_size) begin with one reference (see
+    'RegisterFreeTable').
+    """
+    _ref_layout  = Layout([ ("prd", PhysReg), ("en", 1) ])
+    _free_layout = Layout([ ("prd", PhysReg), ("en", 1) ])
+
+    def __init__(self, prf_size, arf_size, rob_size):
+        self.prf_size = prf_size
+        self.arf_size = arf_size
+        self.rob_size = rob_size
+
+        # NOTE: Each architectural register (other than the zero register)
+        # holds one reference, and each in-flight uop that overwrote an 
+        # architectural register holds one more until it retires. A single
+        # physical register can't have more references than that.
+        self.max_refs = (arf_size - 1) + rob_size
+        self.refcnt = Array(
+            Signal(range(self.max_refs + 1), reset=int(0 < idx < arf_size))
+            for idx in range(prf_size)
+        )
+
+        self.alloc = Record(self._ref_layout)
+        self.inc   = Record(self._ref_layout)
+        self.dec   = Record(self._ref_layout)
+        self.free  = Record(self._free_layout)
+
+    def ports(self):
+        return [
+            *self.alloc.fields.values(),
+            *self.inc.fields.values(),
+            *self.dec.fields.values(),
+            *self.free.fields.values(),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for idx in range(1, self.prf_size):
+            up = Signal(name="refcnt{}_up".format(idx))
+            dn = Signal(name="refcnt{}_dn".format(idx))
+            m.d.comb += [
+                up.eq((self.alloc.en & (self.alloc.prd == idx)) | 
+                      (self.inc.en & (self.inc.prd == idx))),
+                dn.eq(self.dec.en & (self.dec.prd == idx)),
+            ]
+            with m.If(up & ~dn):
+                m.d.sync += self.refcnt[idx].eq(self.refcnt[idx] + 1)
+            with m.Elif(dn & ~up):
+                m.d.sync += self.refcnt[idx].eq(self.refcnt[idx] - 1)
+
+        # The last reference is being dropped (and not replaced)
+        m.d.comb += [
+            self.free.prd.eq(self.dec.prd),
+            self.free.en.eq(self.dec.en & (self.dec.prd != 0) &
+                (self.refcnt[self.dec.prd] == 1) &
+                ~(self.inc.en & (self.inc.prd == self.dec.prd))
+            ),
+        ]
+
+        return m
+
+class MoveEliminator(Elaboratable):
+    """ Detects uops that can be completed during rename.
+    'o_elim': Asserted when the uop only copies the value of 'o_src' to 'rd'
+
+    This covers register moves (i.e. 'addi rd, rs, 0' or 'add rd, rs, x0') 
+    and zero idioms (i.e. 'xor rd, rs, rs' or 'lui rd, 0'), which are treated
+    as a move from 'x0'. The destination is renamed to the physical register
+    already bound to 'o_src', and the uop never needs to be executed.
+    """
+    def __init__(self):
+        self.i_uop  = Record(DecodedUop())
+        self.o_elim = Signal()
+        self.o_src  = Signal(ArchReg)
+
+    def ports(self):
+        return [ *self.i_uop.fields.values(), self.o_elim, self.o_src ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        uop    = self.i_uop
+        zero   = Signal()
+        mov    = Signal()
+        # 'add', 'or', and 'xor' with 'x0' or zero just pass the other value
+        passop = Signal()
+        m.d.comb += passop.eq((uop.alu_op == ALUOp.ADD) | 
+            (uop.alu_op == ALUOp.OR) | (uop.alu_op == ALUOp.XOR))
+
+        with m.Switch(uop.op):
+            with m.Case(Opcode.LUI):
+                m.d.comb += zero.eq(uop.imm == 0)
+            with m.Case(Opcode.OP_IMM):
+                with m.If(uop.fuse == FuseOp.NONE):
+                    with m.If(passop & (uop.imm == 0)):
+                        m.d.comb += [
+                            mov.eq(1),
+                            self.o_src.eq(uop.rs1),
+                        ]
+                    with m.If((uop.alu_op == ALUOp.AND) & (uop.imm == 0)):
+                        m.d.comb += zero.eq(1)
+            with m.Case(Opcode.OP):
+                with m.If(uop.fuse == FuseOp.NONE):
+                    with m.If(((uop.alu_op == ALUOp.SUB) | 
+                               (uop.alu_op == ALUOp.XOR)) & 
+                              (uop.rs1 == uop.rs2)):
+                        m.d.comb += zero.eq(1)
+                    with m.Elif((uop.alu_op == ALUOp.AND) & 
+                                ((uop.rs1 == 0) | (uop.rs2 == 0))):
+                        m.d.comb += zero.eq(1)
+                    with m.Elif(passop & (uop.rs2 == 0)):
+                        m.d.comb += [
+                            mov.eq(1),
+                            self.o_src.eq(uop.rs1),
+                        ]
+                    with m.Elif(passop & (uop.rs1 == 0)):
+                        m.d.comb += [
+                            mov.eq(1),
+                            self.o_src.eq(uop.rs2),
+                        ]
+                    with m.Elif((uop.alu_op == ALUOp.SUB) & (uop.rs2 == 0)):
+                        m.d.comb += [
+                            mov.eq(1),
+                            self.o_src.eq(uop.rs1),
+                        ]
+
+        # NOTE: Zero idioms leave 'o_src' as zero
+        m.d.comb += self.o_elim.eq(uop.rd_en & (zero | mov))
+
+        return m
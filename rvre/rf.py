@@ -20,20 +20,51 @@ class PhysRegEntry(Layout):
 
 class PhysicalRegisterFile(Elaboratable):
     """ Unified physical register file.
+    'rp': Read ports ('rp1' and 'rp2' are the first two)
+    'wp1': Write port (for results)
+    'load': Write port used to load architectural state (this takes priority
+            over 'wp1')
     """
-    def __init__(self, size):
+    def __init__(self, size, num_read=2):
         self.size = size
         self.mem  = Memory(width=32, depth=size)
-        self.rp1  = self.mem.read_port()
-        self.rp2  = self.mem.read_port()
-        self.wp1  = self.mem.write_port()
+        self.rp   = [ self.mem.read_port() for _ in range(num_read) ]
+        self.rp1  = self.rp[0]
+        self.rp2  = self.rp[1]
+        self.wp   = self.mem.write_port()
+
+        wr_port_layout = Layout([
+            ("en", 1), ("addr", range(size)), ("data", 32),
+        ])
+        self.wp1  = Record(wr_port_layout)
+        self.load = Record(wr_port_layout)
+
+    def ports(self):
+        return [
+            *[ sig for rp in self.rp for sig in (rp.addr, rp.data) ],
+            *self.wp1.fields.values(),
+            *self.load.fields.values(),
+        ]
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.rp1 = rp1 = self.rp1
-        m.submodules.rp2 = rp2 = self.rp2
-        m.submodules.wp1 = wp1 = self.wp1
+        for idx, rp in enumerate(self.rp):
+            m.submodules["rp{}".format(idx)] = rp
+        m.submodules.wp  = wp  = self.wp
+
+        with m.If(self.load.en):
+            m.d.comb += [
+                wp.en.eq(1),
+                wp.addr.eq(self.load.addr),
+                wp.data.eq(self.load.data),
+            ]
+        with m.Else():
+            m.d.comb += [
+                wp.en.eq(self.wp1.en),
+                wp.addr.eq(self.wp1.addr),
+                wp.data.eq(self.wp1.data),
+            ]
 
         return m
 
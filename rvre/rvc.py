@@ -0,0 +1,217 @@
+""" rvc.py
+Support for the RV32C compressed instruction extension.
+"""
+
+from amaranth import *
+from amaranth.hdl.rec import *
+
+from .common import *
+
+__all__ = [ "CompressedExpander" ]
+
+def _op7(op):
+    return C((op.value << 2) | 0b11, 7)
+
+def _sext(width, *parts):
+    """ Sign-extend the concatenation of 'parts' to 'width' bits """
+    v = Cat(*parts)
+    return Cat(v, Repl(v[-1], width - len(v)))
+
+def _zext(width, *parts):
+    v = Cat(*parts)
+    return Cat(v, C(0, width - len(v)))
+
+def enc_r(op, rd, f3, rs1, rs2, f7):
+    return Cat(_op7(op), rd, C(f3, 3), rs1, rs2, C(f7, 7))
+
+def enc_i(op, rd, f3, rs1, imm):
+    return Cat(_op7(op), rd, C(f3, 3), rs1, imm[0:12])
+
+def enc_s(op, f3, rs1, rs2, imm):
+    return Cat(_op7(op), imm[0:5], C(f3, 3), rs1, rs2, imm[5:12])
+
+def enc_b(op, f3, rs1, rs2, imm):
+    return Cat(_op7(op), imm[11], imm[1:5], C(f3, 3), rs1, rs2, imm[5:11],
+               imm[12])
+
+def enc_u(op, rd, imm):
+    return Cat(_op7(op), rd, imm[12:32])
+
+def enc_j(op, rd, imm):
+    return Cat(_op7(op), rd, imm[12:20], imm[11], imm[1:11], imm[20])
+
+
+class CompressedExpander(Elaboratable):
+    """ Expands a 16-bit compressed instruction into its 32-bit equivalent.
+    'i_inst': Instruction (if the low bits are '0b11', this is not a
+              compressed instruction and is passed through unchanged)
+    'o_inst': Expanded 32-bit instruction
+    'o_rvc': Asserted when 'i_inst' is a compressed instruction
+    'o_illegal': Asserted for illegal/reserved compressed encodings
+
+    Illegal compressed instructions are expanded to an all-zero instruction
+    (which the decoder also treats as illegal).
+    """
+    def __init__(self):
+        self.i_inst    = Signal(32)
+        self.o_inst    = Signal(32)
+        self.o_rvc     = Signal()
+        self.o_illegal = Signal()
+
+    def ports(self):
+        return [ self.i_inst, self.o_inst, self.o_rvc, self.o_illegal ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        c   = self.i_inst[0:16]
+        out = Signal(32)
+        ill = Signal()
+
+        # Register fields
+        rd   = c[7:12]
+        rs2  = c[2:7]
+        rdp  = Cat(c[2:5], C(0b01, 2))  # rd'/rs2' in [2:5]
+        rs1p = Cat(c[7:10], C(0b01, 2)) # rs1'/rd' in [7:10]
+        x0   = C(0, 5)
+        x1   = C(1, 5)
+        x2   = C(2, 5)
+
+        # Immediates
+        imm6    = _sext(32, c[2:7], c[12])
+        shamt   = _zext(32, c[2:7], c[12])
+        addi4sp = _zext(32, C(0, 2), c[6], c[5], c[11:13], c[7:11])
+        lw_off  = _zext(32, C(0, 2), c[6], c[10:13], c[5])
+        lwsp    = _zext(32, C(0, 2), c[4:7], c[12], c[2:4])
+        swsp    = _zext(32, C(0, 2), c[9:13], c[7:9])
+        addi16  = _sext(32, C(0, 4), c[6], c[2], c[5], c[3:5], c[12])
+        lui     = _sext(32, C(0, 12), c[2:7], c[12])
+        j_off   = _sext(32, C(0, 1), c[3:6], c[11], c[2], c[7], c[6],
+                        c[9:11], c[8], c[12])
+        b_off   = _sext(32, C(0, 1), c[3:5], c[10:12], c[2], c[5:7], c[12])
+
+        f3 = c[13:16]
+        with m.Switch(Cat(c[0:2], f3)):
+            # Quadrant 0
+            with m.Case("00000"): # c.addi4spn
+                m.d.comb += [
+                    out.eq(enc_i(Opcode.OP_IMM, rdp, Funct3.ADD, x2, addi4sp)),
+                    ill.eq(addi4sp == 0),
+                ]
+            with m.Case("01000"): # c.lw
+                m.d.comb += out.eq(enc_i(Opcode.LOAD, rdp, Funct3.W, rs1p,
+                                         lw_off))
+            with m.Case("11000"): # c.sw
+                m.d.comb += out.eq(enc_s(Opcode.STORE, Funct3.W, rs1p, rdp,
+                                         lw_off))
+
+            # Quadrant 1
+            with m.Case("00001"): # c.addi (c.nop)
+                m.d.comb += out.eq(enc_i(Opcode.OP_IMM, rd, Funct3.ADD, rd,
+                                         imm6))
+            with m.Case("00101"): # c.jal
+                m.d.comb += out.eq(enc_j(Opcode.JAL, x1, j_off))
+            with m.Case("01001"): # c.li
+                m.d.comb += out.eq(enc_i(Opcode.OP_IMM, rd, Funct3.ADD, x0,
+                                         imm6))
+            with m.Case("01101"):
+                with m.If(rd == 2): # c.addi16sp
+                    m.d.comb += [
+                        out.eq(enc_i(Opcode.OP_IMM, x2, Funct3.ADD, x2,
+                                     addi16)),
+                        ill.eq(addi16 == 0),
+                    ]
+                with m.Else(): # c.lui
+                    m.d.comb += [
+                        out.eq(enc_u(Opcode.LUI, rd, lui)),
+                        ill.eq(lui == 0),
+                    ]
+            with m.Case("10001"):
+                with m.Switch(c[10:12]):
+                    with m.Case(0b00): # c.srli
+                        m.d.comb += [
+                            out.eq(enc_i(Opcode.OP_IMM, rs1p, Funct3.SRx,
+                                         rs1p, shamt)),
+                            ill.eq(c[12]),
+                        ]
+                    with m.Case(0b01): # c.srai
+                        m.d.comb += [
+                            out.eq(enc_i(Opcode.OP_IMM, rs1p, Funct3.SRx,
+                                         rs1p, shamt | (Funct7.SRA << 5))),
+                            ill.eq(c[12]),
+                        ]
+                    with m.Case(0b10): # c.andi
+                        m.d.comb += out.eq(enc_i(Opcode.OP_IMM, rs1p,
+                                                 Funct3.AND, rs1p, imm6))
+                    with m.Case(0b11):
+                        with m.Switch(Cat(c[5:7], c[12])):
+                            with m.Case(0b000): # c.sub
+                                m.d.comb += out.eq(enc_r(Opcode.OP, rs1p,
+                                    Funct3.ADD, rs1p, rdp, Funct7.SUB))
+                            with m.Case(0b001): # c.xor
+                                m.d.comb += out.eq(enc_r(Opcode.OP, rs1p,
+                                    Funct3.XOR, rs1p, rdp, 0))
+                            with m.Case(0b010): # c.or
+                                m.d.comb += out.eq(enc_r(Opcode.OP, rs1p,
+                                    Funct3.OR, rs1p, rdp, 0))
+                            with m.Case(0b011): # c.and
+                                m.d.comb += out.eq(enc_r(Opcode.OP, rs1p,
+                                    Funct3.AND, rs1p, rdp, 0))
+                            with m.Default(): # c.subw, c.addw (RV64)
+                                m.d.comb += ill.eq(1)
+            with m.Case("10101"): # c.j
+                m.d.comb += out.eq(enc_j(Opcode.JAL, x0, j_off))
+            with m.Case("11001"): # c.beqz
+                m.d.comb += out.eq(enc_b(Opcode.BRANCH, Funct3.BEQ, rs1p, x0,
+                                         b_off))
+            with m.Case("11101"): # c.bnez
+                m.d.comb += out.eq(enc_b(Opcode.BRANCH, Funct3.BNE, rs1p, x0,
+                                         b_off))
+
+            # Quadrant 2
+            with m.Case("00010"): # c.slli
+                m.d.comb += [
+                    out.eq(enc_i(Opcode.OP_IMM, rd, Funct3.SLL, rd, shamt)),
+                    ill.eq(c[12]),
+                ]
+            with m.Case("01010"): # c.lwsp
+                m.d.comb += [
+                    out.eq(enc_i(Opcode.LOAD, rd, Funct3.W, x2, lwsp)),
+                    ill.eq(rd == 0),
+                ]
+            with m.Case("10010"):
+                with m.If(~c[12]):
+                    with m.If(rs2 == 0): # c.jr
+                        m.d.comb += [
+                            out.eq(enc_i(Opcode.JALR, x0, 0, rd, C(0, 32))),
+                            ill.eq(rd == 0),
+                        ]
+                    with m.Else(): # c.mv
+                        m.d.comb += out.eq(enc_r(Opcode.OP, rd, Funct3.ADD,
+                                                 x0, rs2, Funct7.ADD))
+                with m.Else():
+                    with m.If((rd == 0) & (rs2 == 0)): # c.ebreak
+                        m.d.comb += out.eq(0x00100073)
+                    with m.Elif(rs2 == 0): # c.jalr
+                        m.d.comb += out.eq(enc_i(Opcode.JALR, x1, 0, rd,
+                                                 C(0, 32)))
+                    with m.Else(): # c.add
+                        m.d.comb += out.eq(enc_r(Opcode.OP, rd, Funct3.ADD,
+                                                 rd, rs2, Funct7.ADD))
+            with m.Case("11010"): # c.swsp
+                m.d.comb += out.eq(enc_s(Opcode.STORE, Funct3.W, x2, rs2,
+                                         swsp))
+
+            # Floating-point loads/stores, and reserved encodings
+            with m.Default():
+                m.d.comb += ill.eq(1)
+
+        m.d.comb += self.o_rvc.eq(self.i_inst[0:2] != 0b11)
+        with m.If(~self.o_rvc):
+            m.d.comb += self.o_inst.eq(self.i_inst)
+        with m.Elif(~ill):
+            m.d.comb += self.o_inst.eq(out)
+        with m.Else():
+            m.d.comb += self.o_illegal.eq(1)
+
+        return m
@@ -0,0 +1,119 @@
+""" soc.py
+Multi-core system with private L1 caches and a shared L2.
+"""
+
+from amaranth import *
+from amaranth.hdl.rec import *
+
+from .param import *
+from .core import *
+from .cache import *
+from .mem import *
+from .prefetch import *
+
+__all__ = [ "PerfCounters", "RVRESoC" ]
+
+class PerfCounters(Layout):
+    """ Performance counters for a single core.
+    """
+    def __init__(self):
+        super().__init__([
+            ("cycles",   32), # Cycles since reset
+            ("uops",     32), # Uops renamed
+            ("l1i_hit",  32), # Completed instruction fetches
+            ("l1i_miss", 32), # Instruction cache fills
+            ("l1d_hit",  32), # Completed data accesses
+            ("l1d_miss", 32), # Data cache fills
+            ("snoops",   32), # Lines invalidated/downgraded by the directory
+            ("prefetch", 32), # Fills started by the prefetchers
+            ("useful",   32), # Prefetched lines that were used
+        ])
+
+
+class RVRESoC(Elaboratable):
+    """ A system with 'RVREParams.cores' cores.
+
+    Each core has a private L1 instruction cache and data cache. The private
+    caches are kept coherent by the directory in a shared L2 (see 'L2Cache'),
+    which is connected to the backing memory over a Wishbone bus.
+
+    'image' is loaded into the backing memory (with 'mem_depth' words) at
+    address 0. 'reset_vector' is either a single address (used for all
+    cores), or a list with an address for each core.
+
+    'counters': Performance counters for each core (see 'PerfCounters')
+    'dcache': The data cache for each core.
+
+    NOTE: The core doesn't have a load/store unit yet, so nothing in the
+    core is connected to the data caches (i.e. they're driven by a testbench).
+    """
+    def __init__(self, image=None, reset_vector=0x00000000, mem_depth=4096):
+        if isinstance(reset_vector, int):
+            reset_vector = [ reset_vector ] * PARAM.cores
+
+        self.icache = [ L1Cache(PARAM.l1i_lines, PARAM.line_words, 
+                                NextLinePrefetcher(PARAM.line_words, 
+                                    PARAM.pf_degree, PARAM.pf_distance, 
+                                    PARAM.pf_interval)
+                                if PARAM.l1i_prefetch else None)
+                        for _ in range(PARAM.cores) ]
+        self.dcache = [ L1Cache(PARAM.l1d_lines, PARAM.line_words,
+                                StridePrefetcher(PARAM.rpt_size, 
+                                    PARAM.pf_degree, PARAM.pf_distance,
+                                    PARAM.pf_interval)
+                                if PARAM.l1d_prefetch else None)
+                        for _ in range(PARAM.cores) ]
+        self.cores  = [ RVRECore(reset_vector=reset, icache=ic)
+                        for reset, ic in zip(reset_vector, self.icache) ]
+        self.l2  = L2Cache(PARAM.l2_lines, PARAM.line_words, [
+            c.port for ic, dc in zip(self.icache, self.dcache) for c in (ic, dc)
+        ])
+        self.mem = BackingMemory(mem_depth, init=image,
+                                 latency=PARAM.mem_latency)
+
+        self.counters = [ Record(PerfCounters(), name="core{}_ctr".format(i))
+                          for i in range(PARAM.cores) ]
+
+    def ports(self):
+        return [
+            *[ f for ctr in self.counters for f in ctr.fields.values() ],
+            *[ sig for dc in self.dcache for sig in (dc.i_en, dc.i_we, 
+               dc.i_addr, dc.i_data, dc.i_sel, dc.i_pc, dc.o_vld, 
+               dc.o_data) ],
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        for i, (core, dc) in enumerate(zip(self.cores, self.dcache)):
+            m.submodules["core{}".format(i)] = core
+            m.submodules["dcache{}".format(i)] = dc
+        m.submodules.l2  = l2  = self.l2
+        m.submodules.mem = mem = self.mem
+
+        # Wishbone interconnect (the L2 is the only master)
+        m.d.comb += [
+            mem.bus.cyc.eq(l2.bus.cyc),
+            mem.bus.stb.eq(l2.bus.stb),
+            mem.bus.we.eq(l2.bus.we),
+            mem.bus.adr.eq(l2.bus.adr),
+            mem.bus.sel.eq(l2.bus.sel),
+            mem.bus.dat_w.eq(l2.bus.dat_w),
+            l2.bus.dat_r.eq(mem.bus.dat_r),
+            l2.bus.ack.eq(mem.bus.ack),
+        ]
+
+        for core, ic, dc, ctr in zip(self.cores, self.icache, self.dcache,
+                                     self.counters):
+            m.d.sync += [
+                ctr.cycles.eq(ctr.cycles + 1),
+                ctr.uops.eq(ctr.uops + core.r_uop_vld),
+                ctr.l1i_hit.eq(ctr.l1i_hit + ic.o_hit),
+                ctr.l1i_miss.eq(ctr.l1i_miss + ic.o_miss),
+                ctr.l1d_hit.eq(ctr.l1d_hit + dc.o_hit),
+                ctr.l1d_miss.eq(ctr.l1d_miss + dc.o_miss),
+                ctr.snoops.eq(ctr.snoops + ic.o_snoop + dc.o_snoop),
+                ctr.prefetch.eq(ctr.prefetch + ic.o_prefetch + dc.o_prefetch),
+                ctr.useful.eq(ctr.useful + ic.o_useful + dc.o_useful),
+            ]
+
+        return m
@@ -0,0 +1,375 @@
+""" trace.py
+Filtered, windowed waveform capture for simulation, and per-instruction
+pipeline traces.
+
+'Simulator.write_vcd()' dumps every signal in the design on every cycle, which
+makes long runs painfully slow and produces huge files. The tracer here only
+samples a selected set of signals, and only while a capture window is open.
+
+Waveforms are also a bad way to look at how instructions flow through the
+pipeline. 'PipeTracer' writes a log that can be opened with the Konata
+pipeline viewer (or gem5's 'o3-pipeview.py').
+"""
+
+import os
+import shutil
+import subprocess
+import warnings
+
+from amaranth import *
+from amaranth.sim import *
+from vcd import VCDWriter
+
+from .common import *
+
+__all__ = [ "WaveformTracer", "PipeTracer" ]
+
+class WaveformTracer:
+    """ Record a selected set of signals to a VCD (or FST) file.
+
+    'path': Output file. If this ends with '.fst', a VCD is written and then
+            converted with GTKWave's 'vcd2fst' when the tracer is closed 
+            (which must be installed). If the conversion fails, the VCD is
+            kept.
+    'signals': Dictionary mapping a (dotted) trace name to an Amaranth value
+    'start': First cycle where capture is allowed
+    'stop': First cycle where capture is no longer allowed (optional)
+    'trigger': Amaranth value; capture begins on the first cycle in the window
+               where this is non-zero (optional)
+    'length': Number of cycles to capture after the trigger fires (optional)
+
+    Values are sampled once per cycle, and timestamps in the output are cycle
+    numbers. Before the window opens, the tracer only counts clock edges.
+    Outside the window, nothing is sampled or written.
+
+    Usage:
+
+        with WaveformTracer("/tmp/core.fst", core.trace_signals("rename"),
+                            start=1000, trigger=(core.r_pc == 0x40)) as tr:
+            sim.add_process(tr.process)
+            sim.run()
+
+    NOTE: This is not a sync process, so that cycle 0 is the first cycle 
+    after reset (as with 'PipeTracer').
+    """
+    def __init__(self, path, signals, start=0, stop=None, trigger=None,
+                 length=None):
+        if stop is not None and stop <= start:
+            raise ValueError("Trace window stop ({}) must be after start ({})"
+                             .format(stop, start))
+        self._vcd2fst = None
+        if path.endswith(".fst"):
+            self._vcd2fst = shutil.which("vcd2fst")
+            if self._vcd2fst is None:
+                raise FileNotFoundError("Can't find 'vcd2fst' (from GTKWave) "
+                                        "to write {}".format(path))
+        self.path    = path
+        self.signals = dict(signals)
+        self.start   = start
+        self.stop    = stop
+        self.trigger = trigger
+        self.length  = length
+
+        # Cycle on which the trigger fired (or None)
+        self.triggered_at = None
+
+        self._file   = None
+        self._writer = None
+        self._vars   = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _vcd_path(self):
+        if self.path.endswith(".fst"):
+            return self.path[:-len(".fst")] + ".vcd"
+        return self.path
+
+    def open(self):
+        self._file   = open(self._vcd_path(), "w")
+        self._writer = VCDWriter(self._file, timescale="1 ns")
+        for name, value in self.signals.items():
+            scope, _, var = name.rpartition(".")
+            self._vars[name] = self._writer.register_var(
+                scope or "top", var, "wire", size=len(value)
+            )
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._file.close()
+        self._writer = None
+        self._file   = None
+        if self._vcd2fst is not None:
+            # NOTE: This may run while an exception is escaping a 'with' 
+            # block, so a failed conversion only warns
+            try:
+                subprocess.run([self._vcd2fst, self._vcd_path(), self.path],
+                               check=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                warnings.warn("Couldn't convert to FST ({}), leaving VCD at {}"
+                              .format(e, self._vcd_path()))
+                return
+            os.remove(self._vcd_path())
+
+    def _capturing(self, cycle):
+        """ Returns whether or not a triggered capture is still running """
+        if self.stop is not None and cycle >= self.stop:
+            return False
+        if self.length is not None:
+            return cycle < (self.triggered_at + self.length)
+        return True
+
+    def process(self):
+        """ Simulator process (for use with 'Simulator.add_process()').
+        """
+        yield Passive()
+
+        # Skip over all cycles before the window opens
+        for _ in range(self.start):
+            yield Tick()
+        cycle = self.start
+
+        # Wait for the trigger condition
+        while self.triggered_at is None:
+            if self.stop is not None and cycle >= self.stop:
+                return
+            yield Settle()
+            if self.trigger is None or (yield self.trigger):
+                self.triggered_at = cycle
+                break
+            yield Tick()
+            cycle += 1
+
+        # Capture until the window closes
+        while self._capturing(cycle):
+            yield Settle()
+            for name, value in self.signals.items():
+                self._writer.change(self._vars[name], cycle, (yield value))
+            yield Tick()
+            cycle += 1
+
+
+class _PipeRecord:
+    """ State kept by 'PipeTracer' for an instruction in flight. """
+    def __init__(self, kid, seq, tid, pc):
+        self.kid    = kid  # Kanata ID
+        self.seq    = seq
+        self.tid    = tid
+        self.pc     = pc
+        self.label  = "{:08x}".format(pc)
+        self.stages = {}   # Stage name -> first cycle
+        self.renamed = False
+        self.tail   = None # Fused with the next instruction
+
+
+class PipeTracer:
+    """ Record the pipeline stages of each instruction in an 'RVRECore'.
+
+    'path': Output file
+    'core': The core being simulated (instructions are identified by the 
+            sequence numbers assigned in 'RVRECore.r_seq')
+    'fmt': Either "kanata" (for Konata), or "o3" (gem5 O3PipeView)
+    'start', 'stop': Cycles where tracing begins/ends (see 'WaveformTracer')
+    'cycle_time': Ticks per cycle (only used with "o3")
+
+    The stages are:
+
+        'F'  - Fetch (or with RV32C, the aligner output)
+        'F2' - The fetched word returns (not used with RV32C)
+        'Rn' - Decode and rename
+        'Ds' - Dispatch (the renamed uop is in 'r_uop')
+
+    An instruction is flushed when its fetch is replayed, when an older 
+    instruction redirects fetch at decode, or when a younger instruction is 
+    renamed before it (i.e. it was discarded after a reset or a load). The 
+    tail of a fused pair retires with its head.
+
+    NOTE: There's no issue, execute, or retire yet, so uops "retire" on the 
+    cycle after they're dispatched. The 'issue'/'complete' stages in an "o3" 
+    log are always zero.
+
+    Records are written as soon as each instruction retires or is flushed, 
+    so the output can be viewed while a simulation is still running.
+    Usage:
+
+        with PipeTracer("/tmp/core.log", core) as pt:
+            sim.add_process(pt.process)
+            sim.run_until(1e-6)
+
+    NOTE: This is not a sync process (which would only start after the first
+    clock edge, and miss the instruction fetched on the first cycle).
+    """
+    def __init__(self, path, core, fmt="kanata", start=0, stop=None,
+                 cycle_time=1000):
+        if fmt not in ("kanata", "o3"):
+            raise ValueError("Unknown pipeline trace format '{}'".format(fmt))
+        if stop is not None and stop <= start:
+            raise ValueError("Trace window stop ({}) must be after start ({})"
+                             .format(stop, start))
+        self.path  = path
+        self.core  = core
+        self.fmt   = fmt
+        self.start = start
+        self.stop  = stop
+        self.cycle_time = cycle_time
+
+        self._file  = None
+        self._live  = {}   # Sequence number -> '_PipeRecord'
+        self._kid   = 0    # Next Kanata ID
+        self._rid   = 0    # Next Kanata retire ID
+        self._cycle = 0    # Last cycle written to a Kanata log
+        self._retiring = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self._file = open(self.path, "w")
+        if self.fmt == "kanata":
+            self._file.write("Kanata\t0004\nC=\t{}\n".format(self.start))
+            self._cycle = self.start
+
+    def close(self):
+        if self._file is None:
+            return
+        # Anything still in the pipeline never completed
+        for rec in list(self._live.values()):
+            self._end(rec, self._cycle, flush=True)
+        self._file.close()
+        self._file = None
+
+    def _emit(self, cycle, *fields):
+        """ Write a line to a Kanata log """
+        if cycle != self._cycle:
+            self._file.write("C\t{}\n".format(cycle - self._cycle))
+            self._cycle = cycle
+        self._file.write("\t".join(str(f) for f in fields) + "\n")
+
+    def _begin(self, cycle, seq, tid, pc):
+        rec = _PipeRecord(self._kid, seq, tid, pc)
+        self._kid += 1
+        self._live[seq] = rec
+        if self.fmt == "kanata":
+            self._emit(cycle, "I", rec.kid, seq, tid)
+            self._emit(cycle, "L", rec.kid, 0, rec.label)
+        self._stage(cycle, seq, "F")
+
+    def _stage(self, cycle, seq, stage):
+        rec = self._live.get(seq)
+        if rec is None or stage in rec.stages:
+            return None
+        rec.stages[stage] = cycle
+        if self.fmt == "kanata":
+            self._emit(cycle, "S", rec.kid, 0, stage)
+        return rec
+
+    def _label(self, cycle, rec, text):
+        rec.label += " " + text
+        if self.fmt == "kanata":
+            self._emit(cycle, "L", rec.kid, 0, " " + text)
+
+    def _end(self, rec, cycle, flush=False):
+        del self._live[rec.seq]
+        if self.fmt == "kanata":
+            self._emit(cycle, "R", rec.kid, self._rid, 1 if flush else 0)
+            if not flush:
+                self._rid += 1
+            return
+
+        def tick(stage):
+            if stage not in rec.stages:
+                return 0
+            return rec.stages[stage] * self.cycle_time
+        retire = 0 if flush else cycle * self.cycle_time
+        self._file.write("".join([
+            "O3PipeView:fetch:{}:0x{:08x}:0:{}:{}\n".format(tick("F"), rec.pc,
+                                                           rec.seq, rec.label),
+            "O3PipeView:decode:{}\n".format(tick("F2") or tick("Rn")),
+            "O3PipeView:rename:{}\n".format(tick("Rn")),
+            "O3PipeView:dispatch:{}\n".format(tick("Ds")),
+            "O3PipeView:issue:0\n",
+            "O3PipeView:complete:0\n",
+            "O3PipeView:retire:{}:store:0\n".format(retire),
+        ]))
+
+    def _sample(self, cycle):
+        """ Update the records for a single cycle """
+        core = self.core
+
+        # Uops dispatched on the previous cycle retire (with any fused tail)
+        for rec in self._retiring:
+            self._end(rec, cycle)
+        self._retiring = []
+
+        # NOTE: With RV32C, the next instruction leaves the aligner on the
+        # same cycle that a fused instruction is renamed
+        if (yield core.seq_en):
+            self._begin(cycle, (yield core.r_seq), (yield core.fetch_tid),
+                        (yield core.seq_pc))
+
+        if (yield core.r_uop_vld):
+            rec = self._stage(cycle, (yield core.r_uop_seq), "Ds")
+            if rec is not None:
+                uop = core.r_uop
+                op  = Opcode((yield uop.op)).name
+                if (yield uop.fuse):
+                    op = FuseOp((yield uop.fuse)).name
+                if (yield uop.elim):
+                    op += "(elim)"
+                self._label(cycle, rec, "{} x{}:p{} p{} p{} rob{}".format(op,
+                    (yield uop.rd), (yield uop.prd), (yield uop.ps1),
+                    (yield uop.ps2), (yield core.r_uop_rob)))
+                self._retiring.append(rec)
+                if rec.tail is not None:
+                    self._label(cycle, rec.tail, "(fused)")
+                    self._retiring.append(rec.tail)
+
+        if (yield core.inst_vld):
+            seq = (yield core.r_inst_seq)
+            rec = self._stage(cycle, seq, "Rn")
+            if rec is not None:
+                rec.renamed = True
+                if (yield core.inst_fused):
+                    rec.tail = self._live.get(seq + 1)
+                    if rec.tail is not None:
+                        rec.tail.renamed = True
+                # Anything older that wasn't renamed was discarded
+                for old in list(self._live.values()):
+                    if old.seq < seq and not old.renamed:
+                        self._end(old, cycle, flush=True)
+                # Anything younger from the same thread is squashed
+                if (yield core.redirect):
+                    for new in list(self._live.values()):
+                        if (new.seq > seq and new.tid == rec.tid and 
+                            not new.renamed):
+                            self._end(new, cycle, flush=True)
+
+        if (yield core.fetch_replay):
+            rec = self._live.get((yield core.r_fetch_seq))
+            if rec is not None:
+                self._end(rec, cycle, flush=True)
+        if (yield core.fetch_vld):
+            self._stage(cycle, (yield core.r_fetch_seq), "F2")
+
+    def process(self):
+        """ Simulator process (for use with 'Simulator.add_process()').
+        """
+        yield Passive()
+        for _ in range(self.start):
+            yield Tick()
+        cycle = self.start
+        while self.stop is None or cycle < self.stop:
+            yield Settle()
+            yield from self._sample(cycle)
+            yield Tick()
+            cycle += 1
@@ -0,0 +1,139 @@
+""" uopcache.py
+Cache of decoded uops, indexed by fetch address.
+"""
+
+from amaranth import *
+from amaranth.hdl.rec import *
+
+from math import ceil, log2
+
+from .common import *
+
+__all__ = [ "UopCache" ]
+
+class UopCacheSlot(Layout):
+    """ A single uop stored in the cache.
+    'skip' marks the second instruction of a fused pair (which is part of the
+    uop in the previous slot).
+    """
+    def __init__(self):
+        super().__init__([
+            ("vld",  1),
+            ("skip", 1),
+            ("uop",  DecodedUop()),
+        ])
+
+class UopCache(Elaboratable):
+    """ Direct-mapped cache of decoded uops.
+
+    Each line holds the uops for 'width' sequential instructions, starting at
+    an address aligned to 'width * 4' bytes.
+
+    'i_pc': Fetch address used for lookup (combinational)
+    'o_hit': Asserted when the uop at 'i_pc' is present
+    'o_count': Number of instructions (starting at 'i_pc') covered by 'o_uops'
+    'o_uops': Up to 'width' uops (starting at 'i_pc')
+    'o_vld': Asserted for each element of 'o_uops' that should be renamed
+             (the second instruction of a fused pair is not)
+
+    'fill': Writes a uop produced by the decoder. A fused uop covers two
+            instructions, and is only filled when both are in the same line.
+    'i_flush': Invalidates all lines
+    """
+    _fill_layout = Layout([
+        ("en", 1), ("pc", 32), ("uop", DecodedUop()),
+    ])
+
+    def __init__(self, num_lines, width):
+        self.num_lines = num_lines
+        self.width     = width
+        self.off_bits  = ceil(log2(width))
+        self.idx_bits  = ceil(log2(num_lines))
+        self.tag_bits  = 32 - 2 - self.off_bits - self.idx_bits
+
+        self.line_vld = Array(Signal(name="line{}_vld".format(i))
+                              for i in range(num_lines))
+        self.line_tag = Array(Signal(self.tag_bits, name="line{}_tag".format(i))
+                              for i in range(num_lines))
+        self.line = Array(
+            Array(Record(UopCacheSlot()) for _ in range(width))
+            for _ in range(num_lines)
+        )
+
+        self.i_pc    = Signal(32)
+        self.o_hit   = Signal()
+        self.o_count = Signal(range(width + 1))
+        self.o_uops  = Array(Record(DecodedUop()) for _ in range(width))
+        self.o_vld   = Signal(width)
+
+        self.fill    = Record(self._fill_layout)
+        self.i_flush = Signal()
+
+    def _split(self, pc):
+        """ Split an address into (tag, index, offset) """
+        off = pc[2:2 + self.off_bits]
+        idx = pc[2 + self.off_bits:2 + self.off_bits + self.idx_bits]
+        tag = pc[2 + self.off_bits + self.idx_bits:]
+        return tag, idx, off
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Lookup
+        tag, idx, off = self._split(self.i_pc)
+        line = self.line[idx]
+        line_hit = Signal()
+        m.d.comb += line_hit.eq(self.line_vld[idx] & (self.line_tag[idx] == tag))
+
+        # Count the run of valid slots starting from the offset
+        run = Signal(self.width)
+        for j in range(self.width):
+            pos = Signal(self.off_bits + 1, name="pos{}".format(j))
+            m.d.comb += pos.eq(off + j)
+            slot = line[pos[:self.off_bits]]
+            in_line = pos < self.width
+            prev = run[j - 1] if j > 0 else line_hit
+            m.d.comb += [
+                run[j].eq(prev & in_line & slot.vld),
+                self.o_uops[j].eq(slot.uop),
+                self.o_vld[j].eq(run[j] & ~slot.skip),
+            ]
+        m.d.comb += [
+            self.o_hit.eq(run[0]),
+            self.o_count.eq(sum(run[j] for j in range(self.width))),
+        ]
+
+        # Fill
+        ftag, fidx, foff = self._split(self.fill.pc)
+        fline = self.line[fidx]
+        fused = Signal()
+        fits  = Signal()
+        m.d.comb += [
+            fused.eq(self.fill.uop.fuse != FuseOp.NONE),
+            fits.eq(~fused | (foff != self.width - 1)),
+        ]
+        with m.If(self.i_flush):
+            m.d.sync += [ self.line_vld[i].eq(0) for i in range(self.num_lines) ]
+        with m.Elif(self.fill.en & fits):
+            # Replace the line if it belongs to some other address
+            with m.If(~self.line_vld[fidx] | (self.line_tag[fidx] != ftag)):
+                m.d.sync += [
+                    self.line_vld[fidx].eq(1),
+                    self.line_tag[fidx].eq(ftag),
+                ]
+                m.d.sync += [ fline[j].vld.eq(0) for j in range(self.width) ]
+            m.d.sync += [
+                fline[foff].vld.eq(1),
+                fline[foff].skip.eq(0),
+                fline[foff].uop.eq(self.fill.uop),
+            ]
+            with m.If(fused):
+                m.d.sync += [
+                    fline[foff + 1].vld.eq(1),
+                    fline[foff + 1].skip.eq(1),
+                ]
+            # Don't leave behind the second half of a previously-fused pair
+            with m.Elif((foff != self.width - 1) & fline[foff + 1].skip):
+                m.d.sync += fline[foff + 1].vld.eq(0)
+
+        return m
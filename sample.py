@@ -0,0 +1,141 @@
+""" sample.py
+Sampled simulation: estimate the IPC of a whole program on the core.
+
+Running a whole program through the RTL is far too slow. Instead, the
+functional simulator in 'rvre.iss' runs the whole program, and the core is
+only simulated in detail for short windows spaced 'interval' instructions
+apart. For each sample:
+
+1. Fast-forward the functional simulator, and take a checkpoint 'warmup'
+   instructions before the start of the sample
+2. Build a core that starts at the checkpoint PC, and load the architectural
+   registers from the checkpoint (with the 'load' interface on the core)
+3. Simulate until the core has renamed 'warmup' instructions (warming the 
+   uop cache and other state with the instructions leading up to the 
+   sample), then measure over 'window' cycles
+
+The IPC for the whole program is extrapolated from the average CPI of all of
+the samples.
+
+Usage:
+
+    python sample.py fw/kernels/dep_chain.bin [--interval 10000]
+        [--window 200] [--warmup 100] [--max-insts 1000000]
+
+NOTE: The core doesn't have a data memory yet, so only the registers and PC
+are loaded from a checkpoint (the program itself is loaded into the fetch
+unit ROM).
+"""
+
+import argparse
+import math
+import sys
+from struct import unpack
+
+from amaranth.sim import *
+
+from rvre.param import PARAM
+from rvre.common import FuseOp
+from rvre.core import RVRECore
+from rvre.iss import ISS
+
+
+def read_image(path):
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    return unpack("<{}L".format(len(data)//4), data)
+
+
+def run_window(image, ckpt, warmup, window):
+    """ Simulate the core starting from a checkpoint.
+    Returns the number of instructions renamed during the 'window' cycles
+    after the first 'warmup' instructions were renamed (a fused uop counts 
+    as two instructions).
+    """
+    insts = 0
+    def renamed():
+        if not (yield dut.r_uop_vld):
+            return 0
+        fuse = yield dut.r_uop.fuse
+        return 1 if FuseOp(fuse) == FuseOp.NONE else 2
+    def proc():
+        nonlocal insts
+        for areg in range(1, PARAM.arf_size):
+            yield dut.load.en.eq(1)
+            yield dut.load.areg.eq(areg)
+            yield dut.load.data.eq(ckpt.regs[areg])
+            yield Tick()
+        yield dut.load.en.eq(0)
+        # NOTE: Counted in instructions (like the checkpoint), not cycles
+        warm = 0
+        while warm < warmup:
+            yield Settle()
+            warm += yield from renamed()
+            yield Tick()
+        for cycle in range(window):
+            yield Settle()
+            insts += yield from renamed()
+            yield Tick()
+    dut = RVRECore(reset_vector=ckpt.pc, rom_data=image)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+    return insts
+
+
+def run_sampled(image, interval, window, warmup, max_insts):
+    """ Returns the total number of instructions in the program, and a
+    list of (instructions, cycles) for each sample.
+    """
+    if interval <= warmup:
+        raise ValueError("The sampling interval must be larger than warmup")
+    iss = ISS(image)
+    samples = []
+    while not iss.halted and iss.icount < max_insts:
+        iss.run(interval - warmup)
+        if iss.halted:
+            break
+        insts = run_window(image, iss.checkpoint(), warmup, window)
+        samples.append((insts, window))
+        print("sample {:>4} @ {:>10}: IPC {:.3f}".format(
+            len(samples), iss.icount + warmup, insts / window))
+        iss.run(warmup)
+    return iss.icount, samples
+
+
+def extrapolate(total_insts, samples):
+    """ Returns the estimated IPC for the whole program, the estimated number
+    of cycles, and the (95% confidence) relative error of the estimate.
+    """
+    cpi  = [ cycles / max(insts, 1) for insts, cycles in samples ]
+    mean = sum(cpi) / len(cpi)
+    err  = 0.0
+    if len(cpi) > 1:
+        var = sum((x - mean) ** 2 for x in cpi) / (len(cpi) - 1)
+        err = 1.96 * math.sqrt(var / len(cpi)) / mean
+    return 1.0 / mean, total_insts * mean, err
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("image", help="Program binary (loaded at address 0)")
+    ap.add_argument("--interval", type=int, default=10000,
+                    help="Instructions between the start of each sample")
+    ap.add_argument("--window", type=int, default=200,
+                    help="Cycles measured in each sample")
+    ap.add_argument("--warmup", type=int, default=100,
+                    help="Instructions simulated before measuring each sample")
+    ap.add_argument("--max-insts", type=int, default=1000000,
+                    help="Stop after this many instructions")
+    args = ap.parse_args()
+
+    image = read_image(args.image)
+    total, samples = run_sampled(image, args.interval, args.window,
+                                 args.warmup, args.max_insts)
+    if not samples:
+        sys.exit("The program is shorter than a single sampling interval")
+    ipc, cycles, err = extrapolate(total, samples)
+    print("{} instructions, {} samples".format(total, len(samples)))
+    print("Estimated IPC {:.3f} ({:.0f} cycles, +/- {:.1f}%)".format(
+        ipc, cycles, err * 100))
@@ -9,15 +9,34 @@ from rvre.decode import *
 from rvre.rf import *
 from rvre.alu import *
 from rvre.cam import *
+from rvre.rvc import *
+from rvre.trace import *
+from rvre.soc import *
+from rvre.prefetch import *
+from rvre.cache import *
+from rvre.iss import *
+from rvre.lsu import *
+from rvre.issue import *
+from rvre.rename import *
+from rvre.uopcache import *
 
 # NOTE: Right now, the fetch unit is just a ROM
-def read_test_rom():
+def read_rom(path):
     from struct import unpack
-    with open("fw/test.bin", "rb") as f:
+    with open(path, "rb") as f:
         data = bytearray(f.read())
     res = unpack("<{}L".format(len(data)//4), data)
     return res
 
+def read_test_rom():
+    return read_rom("fw/test.bin")
+
+
+def drive(rec, **values):
+    """ Set some fields of a record (the others are cleared) """
+    for name, field in rec.fields.items():
+        yield field.eq(values.get(name, 0))
+
 
 def test_cam():
     INIT_CAM = [ 0x00, 0x00, 0x00, 0x00, 0x00, 0x55, 0x00, 0x00 ]
@@ -116,6 +135,174 @@ def test_decoder_from_rom():
     sim.run()
 
 
+def test_fusion():
+    TESTS = [
+        # lui x1, 0x12345; addi x1, x1, 0x678
+        (0x123450b7, 0x67808093, FuseOp.LUI_ADDI, 0x12345678),
+        # auipc x5, 1; jalr x5, 16(x5)
+        (0x00001297, 0x010282e7, FuseOp.AUIPC_JALR, 0x00001010),
+        # slli x6, x7, 2; add x6, x8, x6
+        (0x00239313, 0x00640333, FuseOp.SLLI_ADD, 0x00000002),
+        # auipc x5, 0x12345; addi x5, x5, 0x678
+        (0x12345297, 0x67828293, FuseOp.AUIPC_ADDI, 0x12345678),
+        # slli x6, x7, 2; add x6, x6, x8
+        (0x00239313, 0x00830333, FuseOp.SLLI_ADD, 0x00000002),
+        # lui x1, 0x12345; addi x2, x1, 0x678 (different 'rd')
+        (0x123450b7, 0x67808113, FuseOp.NONE, 0x12345000),
+        # lui x1, 0x12345; addi x1, x2, 0x678 (doesn't use 'x1')
+        (0x123450b7, 0x67810093, FuseOp.NONE, 0x12345000),
+        # slli x6, x7, 2; add x7, x8, x6 (different 'rd')
+        (0x00239313, 0x006403b3, FuseOp.NONE, 0x00000002),
+        # slli x6, x7, 2; add x6, x8, x9 (doesn't use 'x6')
+        (0x00239313, 0x00940333, FuseOp.NONE, 0x00000002),
+        # slli x6, x7, 2; add x6, x6, x6 (uses 'x6' twice)
+        (0x00239313, 0x00630333, FuseOp.NONE, 0x00000002),
+        # slli x0, x7, 2; add x0, x8, x0 (writes 'x0')
+        (0x00239013, 0x00040033, FuseOp.NONE, 0x00000002),
+    ]
+    def proc():
+        yield dut.i_en.eq(1)
+        for test in TESTS:
+            yield dec0.i_inst.eq(test[0])
+            yield dec1.i_inst.eq(test[1])
+            yield Settle()
+            fuse = yield dut.o_uop.fuse
+            imm  = yield dut.o_uop.imm
+            if FuseOp(fuse) != test[2] or imm != test[3]:
+                raise Exception("got {} {:08x}, exp {} {:08x}".format(
+                    FuseOp(fuse), imm, test[2], test[3]))
+        # Nothing is fused when disabled
+        yield dut.i_en.eq(0)
+        yield dec0.i_inst.eq(TESTS[0][0])
+        yield dec1.i_inst.eq(TESTS[0][1])
+        yield Settle()
+        assert not (yield dut.o_fused)
+    dut = FusionUnit()
+    dec0 = DecodeUnit()
+    dec1 = DecodeUnit()
+    m = Module()
+    m.submodules += [ dut, dec0, dec1 ]
+    m.d.comb += [
+        dut.i_head.eq(dec0.o_duop),
+        dut.i_tail.eq(dec1.o_duop),
+    ]
+    sim = Simulator(m)
+    sim.add_process(proc)
+    sim.run()
+
+
+def test_rvc_expander():
+    TESTS = [
+        # c.li x10, 5 => addi x10, x0, 5
+        (0x4515, 0x00500513),
+        # c.mv x10, x11 => add x10, x0, x11
+        (0x852e, 0x00b00533),
+        # c.add x10, x11 => add x10, x10, x11
+        (0x952e, 0x00b50533),
+        # c.jr x1 => jalr x0, 0(x1)
+        (0x8082, 0x00008067),
+        # c.lw x8, 4(x9) => lw x8, 4(x9)
+        (0x40c0, 0x0044a403),
+        # c.sw x8, 4(x9) => sw x8, 4(x9)
+        (0xc0c0, 0x0084a223),
+        # c.addi16sp 16 => addi x2, x2, 16
+        (0x6141, 0x01010113),
+        # c.srai x8, 3 => srai x8, x8, 3
+        (0x840d, 0x40345413),
+        # c.beqz x8, 8 => beq x8, x0, 8
+        (0xc401, 0x00040463),
+        # c.j -2 => jal x0, -2
+        (0xbffd, 0xfffff06f),
+        # c.swsp x1, 12 => sw x1, 12(x2)
+        (0xc606, 0x00112623),
+        # Not compressed
+        (0x002081b3, 0x002081b3),
+    ]
+    def proc():
+        for inst, exp in TESTS:
+            yield dut.i_inst.eq(inst)
+            yield Settle()
+            res = yield dut.o_inst
+            if res != exp:
+                raise Exception("{:04x}: got {:08x}, exp {:08x}".format(
+                    inst, res, exp))
+        # Reserved encoding (all zeroes)
+        yield dut.i_inst.eq(0x0000)
+        yield Settle()
+        assert (yield dut.o_illegal)
+    dut = CompressedExpander()
+    sim = Simulator(dut)
+    sim.add_process(proc)
+    sim.run()
+
+
+def test_fetch_aligner():
+    """ Mixed 16-bit and 32-bit instructions are extracted from fetched 
+    words, including ones that straddle two words, and after a redirect to 
+    a halfword address.
+    """
+    PROG = [
+        (0x00, 0x0085),     # c.addi x1, 1
+        (0x02, 0x00110113), # addi   x2, x2, 1
+        (0x06, 0x0001),     # c.nop
+        (0x08, 0x00118193), # addi   x3, x3, 1
+        (0x0c, 0x0085),     # c.addi x1, 1
+        (0x0e, 0x0001),     # c.nop
+    ]
+    halves = []
+    for _, inst in PROG:
+        halves += [ inst & 0xffff ] if inst & 3 != 3 else \
+                  [ inst & 0xffff, inst >> 16 ]
+    WORDS = [ halves[i] | (halves[i + 1] << 16) 
+              for i in range(0, len(halves), 2) ]
+
+    def run(start):
+        out = []
+        def proc():
+            addr = 0
+            pending = None
+            for cycle in range(20):
+                # Redirect after the buffer has been partly filled (the word
+                # that is in-flight is discarded)
+                if cycle == 4:
+                    yield dut.i_redirect.eq(1)
+                    yield dut.i_pc.eq(start)
+                    yield dut.i_word_vld.eq(0)
+                    yield Tick()
+                    yield dut.i_redirect.eq(0)
+                    addr = start & ~3
+                    pending = None
+                    out.clear()
+                word = WORDS[pending >> 2] if pending is not None and \
+                       pending >> 2 < len(WORDS) else 0
+                yield dut.i_word.eq(word)
+                yield dut.i_word_vld.eq(pending is not None)
+                yield Settle()
+                if (yield dut.o_vld):
+                    inst = yield dut.o_inst
+                    assert (yield dut.o_rvc) == (inst & 3 != 3)
+                    out.append(((yield dut.o_pc), inst))
+                pending = None
+                if (yield dut.o_ready):
+                    pending = addr
+                    addr += 4
+                yield Tick()
+        dut = FetchAligner()
+        m = Module()
+        m.submodules.aln = dut
+        m.d.comb += dut.i_ack.eq(1)
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(proc)
+        sim.run()
+        return out
+
+    for idx, (pc, _) in enumerate(PROG):
+        out = run(pc)
+        assert out[:len(PROG) - idx] == PROG[idx:], \
+            "{:02x}: {}".format(pc, out)
+
+
 def test_alu():
     TESTS = [
         (ALUOp.ADD, 0x00000001, 0xffffffff, 0x00000000),
@@ -165,8 +352,1131 @@ def test_core():
     sim = Simulator(dut)
     sim.add_clock(1e-6)
     sim.add_sync_process(proc)
-    with sim.write_vcd(vcd_file="/tmp/core.vcd", gtkw_file="/tmp/core.gtkw"):
+    # NOTE: Only trace a few groups of signals; use 'start'/'stop'/'trigger'
+    # to narrow things down when debugging long runs.
+    signals = dut.trace_signals("fetch", "decode", "rename", "issue")
+    # The pipeline trace can be opened with Konata
+    with WaveformTracer("/tmp/core.vcd", signals) as tracer, \
+         PipeTracer("/tmp/core.kanata", dut) as pipe:
+        sim.add_process(tracer.process)
+        sim.add_process(pipe.process)
+        sim.run()
+
+
+def test_state_load():
+    REGS = [ 0 ] + [ 0x1000 + idx for idx in range(1, 32) ]
+    def proc():
+        for areg in range(1, 32):
+            yield dut.load.en.eq(1)
+            yield dut.load.areg.eq(areg)
+            yield dut.load.data.eq(REGS[areg])
+            yield Tick()
+        yield dut.load.en.eq(0)
+        yield Settle()
+        for areg in range(1, 32):
+            preg = yield dut.rat.rat[areg]
+            data = yield dut.prf.mem[preg]
+            assert preg == areg and data == REGS[areg]
+        # Nothing is renamed while loading
+        assert (yield dut.rft.freetbl) == (((1 << PARAM.prf_size) - 1) &
+                                           ~((1 << PARAM.arf_size) - 1))
+    dut = RVRECore(reset_vector=0x10, rom_data=[ 0x002081b3 ] * 8)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_move_elim():
+    """ Moves and zero idioms are renamed without allocating a physical 
+    register, and so are writes to 'x0'.
+    """
+    ROM = [
+        0x00500093, # 0x00: addi x1, x0, 5
+        0x00008113, # 0x04: addi x2, x1, 0
+        0x0031c1b3, # 0x08: xor  x3, x3, x3
+        0x00008233, # 0x0c: add  x4, x1, x0
+        0x00108013, # 0x10: addi x0, x1, 1
+        0x0000006f, # 0x14: jal  x0, 0x14
+    ]
+    def proc():
+        for _ in range(24):
+            yield Tick()
+        yield Settle()
+        prd = PARAM.arf_size
+        pregs = []
+        for areg in range(5):
+            pregs.append((yield dut.rat.rat[areg]))
+        assert pregs == [ 0, prd, prd, 0, prd ]
+        assert (yield dut.rrt.refcnt[prd]) == 3
+        # Only 'x1' was allocated a physical register
+        assert (yield dut.rft.freetbl) == (((1 << PARAM.prf_size) - 1) &
+                                           ~((1 << (prd + 1)) - 1))
+    dut = RVRECore(reset_vector=0x00, rom_data=ROM)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_ref_table():
+    """ A physical register is only freed (and reused) after its last 
+    reference is dropped.
+    """
+    def proc():
+        yield from drive(rft.alloc, en=1)
+        yield Settle()
+        prd = yield rft.alloc.prd
+        assert prd == PARAM.arf_size and (yield rft.alloc.ok)
+        yield from drive(rrt.alloc, en=1, prd=prd)
+        yield Tick()
+        yield from drive(rft.alloc)
+        yield from drive(rrt.alloc)
+        # Another reference (i.e. an eliminated move)
+        yield from drive(rrt.inc, en=1, prd=prd)
+        yield Tick()
+        yield from drive(rrt.inc)
+        yield Settle()
+        assert (yield rrt.refcnt[prd]) == 2
+        # Dropping and adding a reference on the same cycle doesn't free it
+        yield from drive(rrt.dec, en=1, prd=prd)
+        yield from drive(rrt.inc, en=1, prd=prd)
+        yield Settle()
+        assert not (yield rrt.free.en)
+        yield Tick()
+        yield from drive(rrt.inc)
+        for refs in (2, 1):
+            yield Settle()
+            assert (yield rrt.refcnt[prd]) == refs
+            assert (yield rrt.free.en) == (refs == 1)
+            yield Tick()
+        yield from drive(rrt.dec)
+        # The register is allocated again
+        yield from drive(rft.alloc, en=1)
+        yield Settle()
+        assert (yield rft.alloc.prd) == prd
+        # The zero register is never freed
+        yield from drive(rft.alloc)
+        yield from drive(rrt.dec, en=1, prd=0)
+        yield Settle()
+        assert not (yield rrt.free.en)
+
+    rft = RegisterFreeTable(PARAM.prf_size, PARAM.arf_size)
+    rrt = RegisterRefTable(PARAM.prf_size, PARAM.arf_size, PARAM.rob_size)
+    m = Module()
+    m.submodules.rft = rft
+    m.submodules.rrt = rrt
+    m.d.comb += rft.free.eq(rrt.free)
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_uop_cache():
+    """ Decoded uops are filled into the uop cache, hit on the next lookup, 
+    and are invalidated when their line is replaced or flushed.
+    """
+    def fill(pc, rd, fuse=FuseOp.NONE):
+        yield from drive(uc.fill, en=1, pc=pc)
+        yield uc.fill.uop.op.eq(Opcode.OP_IMM)
+        yield uc.fill.uop.rd.eq(rd)
+        yield uc.fill.uop.fuse.eq(fuse)
+        yield Tick()
+        yield from drive(uc.fill)
+
+    def lookup(pc):
+        yield uc.i_pc.eq(pc)
+        yield Settle()
+        return ((yield uc.o_hit), (yield uc.o_count), (yield uc.o_vld))
+
+    def proc():
+        assert (yield from lookup(0x100)) == (0, 0, 0)
+        yield from fill(0x100, rd=1)
+        assert (yield from lookup(0x100)) == (1, 1, 0b0001)
+        assert (yield uc.o_uops[0].rd) == 1
+        # A fused pair covers two slots (only the first one is renamed)
+        yield from fill(0x104, rd=2, fuse=FuseOp.LUI_ADDI)
+        assert (yield from lookup(0x100)) == (1, 3, 0b0011)
+        assert (yield uc.o_uops[1].rd) == 2
+        assert (yield from lookup(0x108)) == (1, 1, 0b0000)
+        # A fused pair that would straddle two lines isn't filled
+        yield from fill(0x10c, rd=3, fuse=FuseOp.LUI_ADDI)
+        assert (yield from lookup(0x10c)) == (0, 0, 0)
+        # Another line with the same index replaces this one
+        yield from fill(0x100 + 16 * 4 * 4, rd=4)
+        assert (yield from lookup(0x100)) == (0, 0, 0)
+        assert (yield from lookup(0x100 + 16 * 4 * 4)) == (1, 1, 0b0001)
+        # Flushing invalidates every line
+        yield from fill(0x200, rd=5)
+        yield uc.i_flush.eq(1)
+        yield Tick()
+        yield uc.i_flush.eq(0)
+        assert (yield from lookup(0x200)) == (0, 0, 0)
+        assert (yield from lookup(0x100 + 16 * 4 * 4)) == (0, 0, 0)
+
+    uc = UopCache(16, 4)
+    sim = Simulator(uc)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+    # In the core, a loop hits in the uop cache after its first iteration, 
+    # and the decoder input is held while it does.
+    ROM = [
+        0x00108093, # 0x00: addi x1, x1, 1
+        0x00110113, # 0x04: addi x2, x2, 1
+        0xff9ff06f, # 0x08: jal  x0, 0x00
+    ]
+    def core_proc():
+        hits = 0
+        prev = None
+        for _ in range(32):
+            yield Settle()
+            inst = yield dut.r_inst
+            if (yield dut.r_inst_uc_hit):
+                hits += 1
+                assert inst == prev
+            prev = inst
+            yield Tick()
+        assert hits > 0
+    dut = RVRECore(reset_vector=0x00, rom_data=ROM)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(core_proc)
+    sim.run()
+
+
+def test_decode_redirect():
+    """ A jump and a backward branch redirect fetch at decode, and the 
+    instructions fetched after them are discarded.
+    """
+    ROM = [
+        0x00108093, # 0x00: addi x1, x1, 1
+        0x0080006f, # 0x04: jal  x0, 0x0c
+        0x00128293, # 0x08: addi x5, x5, 1
+        0xfe009ae3, # 0x0c: bne  x1, x0, 0x00
+        0x00210113, # 0x10: addi x2, x2, 1
+    ]
+    def run(reset_vector):
+        pcs = []
+        def proc():
+            for cycle in range(24):
+                yield Settle()
+                if (yield dut.r_uop_vld):
+                    pcs.append((yield dut.r_uop.pc))
+                yield Tick()
+        dut = RVRECore(reset_vector=reset_vector, rom_data=ROM)
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(proc)
         sim.run()
+        return pcs
+
+    # Nothing before the reset vector is renamed
+    pcs = run(0x00)
+    assert pcs[:6] == [ 0x00, 0x04, 0x0c ] * 2
+    assert set(pcs) == { 0x00, 0x04, 0x0c }
+    pcs = run(0x0c)
+    assert pcs[:4] == [ 0x0c, 0x00, 0x04, 0x0c ]
+    assert set(pcs) == { 0x00, 0x04, 0x0c }
+
+
+def test_rvc_fusion():
+    """ A pair with a 16-bit instruction isn't fused ('c.jalr' links 
+    'pc + 2', not 'pc + 8'), and uops record whether they were 16 bits.
+    """
+    if not PARAM.rvc:
+        return with_params("test_rvc_fusion", rvc=True)
+    ROM = [
+        0x00000097, # 0x00: auipc x1, 0
+        0x00019082, # 0x04: c.jalr x1; 0x06: c.nop
+        0x00010001, # 0x08: c.nop; 0x0a: c.nop
+    ] + [ 0x00010001 ] * 5
+    def proc():
+        uops = {}
+        for _ in range(16):
+            yield Settle()
+            if (yield dut.r_uop_vld):
+                uop = dut.r_uop
+                uops[(yield uop.pc)] = (Opcode((yield uop.op)), 
+                    FuseOp((yield uop.fuse)), (yield uop.rvc))
+            yield Tick()
+        assert uops[0x00] == (Opcode.AUIPC, FuseOp.NONE, 0)
+        assert uops[0x04] == (Opcode.JALR, FuseOp.NONE, 1)
+        assert uops[0x06] == (Opcode.OP_IMM, FuseOp.NONE, 1)
+    dut = RVRECore(reset_vector=0x00, rom_data=ROM)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_waveform_tracer():
+    """ Samples are only written inside the capture window, and after the
+    trigger fires.
+    """
+    import os, shutil, tempfile
+
+    def trace(**kwargs):
+        """ Returns the tracer, and a list of (cycle, value) samples """
+        ctr = Signal(8)
+        m = Module()
+        m.d.sync += ctr.eq(ctr + 1)
+        def proc():
+            for _ in range(16):
+                yield Tick()
+        if "trigger" in kwargs:
+            kwargs["trigger"] = kwargs["trigger"](ctr)
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(proc)
+        fd, path = tempfile.mkstemp(suffix=".vcd")
+        os.close(fd)
+        try:
+            with WaveformTracer(path, { "counter.value": ctr }, 
+                                **kwargs) as tr:
+                sim.add_process(tr.process)
+                sim.run()
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            os.remove(path)
+        samples = []
+        cycle = None
+        for line in lines:
+            if line.startswith("#"):
+                cycle = int(line[1:])
+            # The initial (unknown) value is dumped even if nothing is
+            # captured
+            elif line.startswith("b") and "x" not in line:
+                samples.append((cycle, int(line[1:].split()[0], 2)))
+        return tr, samples
+
+    # Every cycle in the window (the counter matches the cycle number)
+    tr, samples = trace(start=3, stop=8)
+    assert samples == [ (cycle, cycle) for cycle in range(3, 8) ]
+    assert tr.triggered_at == 3
+
+    # Capture begins when the trigger fires
+    tr, samples = trace(start=2, trigger=lambda ctr: ctr == 5)
+    assert tr.triggered_at == 5 and samples[0] == (5, 5)
+    assert samples == [ (cycle, cycle) 
+                        for cycle in range(5, 5 + len(samples)) ]
+    tr, samples = trace(start=2, trigger=lambda ctr: ctr == 5, length=3)
+    assert samples == [ (5, 5), (6, 6), (7, 7) ]
+
+    # Nothing is written when the trigger doesn't fire in the window
+    tr, samples = trace(stop=10, trigger=lambda ctr: ctr == 12)
+    assert tr.triggered_at is None and samples == []
+
+    try:
+        WaveformTracer("/tmp/bad.vcd", {}, start=8, stop=8)
+        assert False, "stop <= start must be rejected"
+    except ValueError:
+        pass
+    if shutil.which("vcd2fst") is None:
+        try:
+            WaveformTracer("/tmp/missing.fst", {})
+            assert False, "a missing 'vcd2fst' must be reported"
+        except FileNotFoundError:
+            pass
+
+
+def test_pipe_trace():
+    """ Pipeline traces (in both formats) have a record for each instruction,
+    with its stages in order, and the instructions fetched after a redirect
+    are flushed.
+    """
+    import os, tempfile
+    ROM = [
+        0x00108093, # 0x00: addi x1, x1, 1
+        0x0080006f, # 0x04: jal  x0, 0x0c
+        0x00128293, # 0x08: addi x5, x5, 1
+        0xfe009ae3, # 0x0c: bne  x1, x0, 0x00
+        0x00210113, # 0x10: addi x2, x2, 1
+    ]
+    STAGES = [ "F", "F2", "Rn", "Ds" ]
+
+    def trace(fmt):
+        def proc():
+            for _ in range(24):
+                yield Tick()
+        dut = RVRECore(reset_vector=0x00, rom_data=ROM)
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(proc)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with PipeTracer(path, dut, fmt=fmt) as pipe:
+                sim.add_process(pipe.process)
+                sim.run()
+            with open(path) as f:
+                return f.read().splitlines()
+        finally:
+            os.remove(path)
+
+    def check(recs):
+        """ 'recs' is a list of (pc, {stage: cycle}, retire cycle/None) """
+        for pc, stages, retire in recs:
+            names = [ s for s in STAGES if s in stages ]
+            assert list(stages) == names
+            cycles = [ stages[s] for s in names ]
+            assert cycles == sorted(cycles)
+            if retire is not None:
+                assert names == STAGES and retire > cycles[-1]
+        retired = [ (retire, pc) for pc, _, retire in recs 
+                    if retire is not None ]
+        assert [ pc for _, pc in sorted(retired) ][:6] == \
+               [ 0x00, 0x04, 0x0c ] * 2
+        # Instructions after a jump or a backward branch are flushed before
+        # they are renamed
+        flushed = [ (pc, stages) for pc, stages, retire in recs 
+                    if retire is None ]
+        assert { pc for pc, _ in flushed } >= { 0x08, 0x10 }
+        for pc, stages in flushed:
+            if pc in (0x08, 0x10):
+                assert "Rn" not in stages
+
+    # Kanata
+    lines = trace("kanata")
+    assert lines[0] == "Kanata\t0004" and lines[1] == "C=\t0"
+    cycle = 0
+    recs = {}
+    rid = 0
+    for line in lines[2:]:
+        f = line.split("\t")
+        if f[0] == "C":
+            assert int(f[1]) > 0
+            cycle += int(f[1])
+            continue
+        kid = int(f[1])
+        if f[0] == "I":
+            assert kid == len(recs)
+            recs[kid] = [ None, {}, None, False ]
+            continue
+        rec = recs[kid]
+        assert not rec[3]
+        if f[0] == "L":
+            if rec[0] is None:
+                rec[0] = int(f[3], 16)
+        elif f[0] == "S":
+            rec[1][f[3]] = cycle
+        elif f[0] == "R":
+            rec[3] = True
+            if f[3] == "0":
+                assert int(f[2]) == rid
+                rid += 1
+                rec[2] = cycle
+        else:
+            raise Exception("unexpected record: {}".format(line))
+    assert all(rec[3] for rec in recs.values())
+    # The first instruction is at the reset vector
+    assert recs[0][0] == 0x00
+    check([ tuple(rec[:3]) for rec in recs.values() ])
+
+    # gem5 O3PipeView
+    lines = trace("o3")
+    assert len(lines) % 7 == 0
+    recs = []
+    for idx in range(0, len(lines), 7):
+        f = [ line.split(":") for line in lines[idx:idx + 7] ]
+        assert [ x[1] for x in f ] == [ "fetch", "decode", "rename", 
+            "dispatch", "issue", "complete", "retire" ]
+        fetch, decode, rename, dispatch = [ int(x[2]) // 1000 for x in f[:4] ]
+        retire = int(f[6][2]) // 1000
+        # Stages that weren't reached are zero ('decode' is the rename cycle
+        # when there is no 'F2')
+        stages = { "F": fetch }
+        if decode != rename:
+            stages["F2"] = decode
+        if rename:
+            stages["Rn"] = rename
+        if dispatch:
+            stages["Ds"] = dispatch
+        recs.append((int(f[0][3], 16), stages, retire or None))
+    check(recs)
+
+
+def with_params(test, **params):
+    """ Run 'test' (the name of a function in this file) in a fresh 
+    interpreter with a different 'RVREParams'.
+    NOTE: Constants like 'PhysReg' are computed from 'PARAM' when 
+    'rvre.common' is first imported (see bench.py).
+    """
+    import os, subprocess, sys
+    subprocess.run([ sys.executable, "-c", "; ".join([
+        "import rvre.param",
+        "rvre.param.PARAM = rvre.param.RVREParams(**{!r})".format(params),
+        "import tb",
+        "tb.{}()".format(test),
+    ])], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_icount_select():
+    """ The thread with the fewest instructions is chosen, ties alternate, 
+    and inactive threads are never chosen.
+    """
+    def choose(counts, active=0b11):
+        for t, count in enumerate(counts):
+            yield dut.i_count[t].eq(count)
+        yield dut.i_active.eq(active)
+        yield Settle()
+        res = (yield dut.o_tid) if (yield dut.o_vld) else None
+        yield Tick()
+        return res
+    def proc():
+        assert (yield from choose([ 2, 1 ])) == 1
+        assert (yield from choose([ 0, 3 ])) == 0
+        assert (yield from choose([ 1, 1 ])) == 1
+        assert (yield from choose([ 1, 1 ])) == 0
+        assert (yield from choose([ 1, 1 ])) == 1
+        assert (yield from choose([ 3, 0 ], active=0b01)) == 0
+        assert (yield from choose([ 0, 0 ], active=0b00)) is None
+    dut = ICountSelect(2, 3)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_smt():
+    """ Each thread runs its own code, and neither thread is starved. """
+    if PARAM.smt_threads != 2:
+        return with_params("test_smt", smt_threads=2, prf_size=128)
+    ROM = [
+        0x00108093, # 0x00: addi x1, x1, 1  (thread 0)
+        0x00110113, # 0x04: addi x2, x2, 1
+        0x00118193, # 0x08: addi x3, x3, 1
+        0x00120213, # 0x0c: addi x4, x4, 1
+        0xff1ff06f, # 0x10: jal  x0, 0x00
+        0x00128293, # 0x14: addi x5, x5, 1  (thread 1)
+        0x00130313, # 0x18: addi x6, x6, 1
+        0xff9ff06f, # 0x1c: jal  x0, 0x14
+    ]
+    pcs = [ [], [] ]
+    fetches = [ 0, 0 ]
+    def proc():
+        for cycle in range(64):
+            yield Settle()
+            if (yield dut.r_uop_vld):
+                pcs[(yield dut.r_uop_tid)].append((yield dut.r_uop.pc))
+            # NOTE: Fetches that hit in the uop cache count too
+            if (yield dut.seq_en):
+                fetches[(yield dut.fetch_tid)] += 1
+            yield Tick()
+    dut = RVRECore(reset_vector=[ 0x00, 0x14 ], rom_data=ROM)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+    loops = [ [ 0x00, 0x04, 0x08, 0x0c, 0x10 ], [ 0x14, 0x18, 0x1c ] ]
+    for tid, loop in enumerate(loops):
+        assert len(pcs[tid]) >= 2 * len(loop)
+        assert pcs[tid] == (loop * len(pcs[tid]))[:len(pcs[tid])]
+    assert abs(fetches[0] - fetches[1]) <= 2, fetches
+
+
+def test_iss():
+    """ The functional simulator runs a small program to completion, and 
+    restoring a checkpoint replays the same instructions.
+    """
+    PROG = [
+        0x00a00093, # 0x00: addi x1, x0, 10
+        0x00000113, # 0x04: addi x2, x0, 0
+        0x00110133, # 0x08: add  x2, x2, x1
+        0xfff08093, # 0x0c: addi x1, x1, -1
+        0xfe009ce3, # 0x10: bne  x1, x0, 0x08
+        0x000011b7, # 0x14: lui  x3, 0x1
+        0x0021a223, # 0x18: sw   x2, 4(x3)
+        0x0041a203, # 0x1c: lw   x4, 4(x3)
+        0x008002ef, # 0x20: jal  x5, 0x28
+        0x00100313, # 0x24: addi x6, x0, 1
+        0xfff00393, # 0x28: addi x7, x0, -1
+        0x0000006f, # 0x2c: jal  x0, 0x2c
+    ]
+    iss = ISS(PROG)
+    assert iss.run(1000) == 38 and iss.halted
+    assert iss.pc == 0x2c and iss.icount == 38
+    assert iss.regs[1:8] == [ 0, 55, 0x1000, 55, 0x24, 0, 0xffffffff ]
+    assert iss.mem[0x1004 >> 2] == 55
+
+    iss = ISS(PROG)
+    iss.run(17)
+    ckpt = iss.checkpoint()
+    first = []
+    iss.run(1000, trace=first)
+    assert first[0].pc == ckpt.pc and first[-1].pc == 0x2c
+    assert [ r.addr for r in first if r.addr is not None ] == [ 0x1004 ] * 2
+    # The checkpoint isn't changed by running after it
+    assert ckpt.regs[4] == 0 and (0x1004 >> 2) not in ckpt.mem
+    iss.restore(ckpt)
+    assert iss.icount == 17 and not iss.halted
+    again = []
+    iss.run(1000, trace=again)
+    assert again == first and iss.icount == 38
+    assert iss.regs[1:8] == [ 0, 55, 0x1000, 55, 0x24, 0, 0xffffffff ]
+
+
+def test_store_sets():
+    """ A load that conflicted with a store waits for the next instance of
+    that store, until the store issues (or the LFST is squashed).
+    """
+    LD_PC, ST_PC = 0x100, 0x204
+    def dispatch(pc, store, rob):
+        yield from drive(dut.dispatch, en=1, pc=pc, store=store, rob=rob)
+        yield Settle()
+        res = ((yield dut.dispatch.ssid_vld), (yield dut.dispatch.dep_vld), 
+               (yield dut.dispatch.dep_rob), (yield dut.dispatch.ssid))
+        yield Tick()
+        yield from drive(dut.dispatch)
+        return res
+    def proc():
+        # No store set yet
+        assert (yield from dispatch(LD_PC, 0, 1))[0:2] == (0, 0)
+        # Train on a violation
+        yield from drive(dut.violation, en=1, load_pc=LD_PC, load_rob=1,
+                         store_pc=ST_PC)
+        yield Tick()
+        yield from drive(dut.violation)
+        yield Settle()
+        assert (yield dut.flush.en) and (yield dut.flush.pc) == LD_PC
+        yield Tick()
+        # The load waits for the store
+        ssid_vld, _, _, ssid = yield from dispatch(ST_PC, 1, 3)
+        assert ssid_vld
+        assert (yield from dispatch(LD_PC, 0, 5))[0:3] == (1, 1, 3)
+        # ... until it issues
+        yield from drive(dut.store_issue, en=1, ssid=ssid, rob=3)
+        yield Tick()
+        yield from drive(dut.store_issue)
+        assert (yield from dispatch(LD_PC, 0, 6))[0:2] == (1, 0)
+        # Squashed stores are forgotten
+        yield from dispatch(ST_PC, 1, 7)
+        yield dut.i_squash.eq(1)
+        yield Tick()
+        yield dut.i_squash.eq(0)
+        assert (yield from dispatch(LD_PC, 0, 8))[0:2] == (1, 0)
+    dut = StoreSetPredictor(PARAM.ssit_size, PARAM.lfst_size, 1024)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_load_queue():
+    """ A store finds the oldest younger load to the same address that 
+    already executed, and a squash (in the same cycle as a retire) leaves 
+    only the older loads.
+    """
+    def alloc(rob, pc):
+        yield from drive(dut.alloc, en=1, rob=rob, pc=pc)
+        yield Settle()
+        res = ((yield dut.alloc.ok), (yield dut.alloc.idx))
+        yield Tick()
+        yield from drive(dut.alloc)
+        return res
+    def check(rob, addr):
+        yield from drive(dut.check, en=1, rob=rob, pc=0x200, addr=addr)
+        yield Settle()
+        res = (yield dut.violation.en), (yield dut.violation.load_pc)
+        yield from drive(dut.check)
+        return res
+    def proc():
+        for rob in (1, 2, 3):
+            ok, idx = yield from alloc(rob, 0x100 + 4 * rob)
+            assert ok
+            yield from drive(dut.execute, en=1, idx=idx, addr=0x40)
+            yield Tick()
+        yield from drive(dut.execute)
+        assert (yield from check(0, 0x40)) == (1, 0x104)
+        assert (yield from check(2, 0x43)) == (1, 0x10c)
+        assert (yield from check(3, 0x40))[0] == 0
+        assert (yield from check(0, 0x44))[0] == 0
+        # Retire the oldest load while squashing the two youngest
+        yield from drive(dut.retire, en=1)
+        yield from drive(dut.squash, en=1, rob=2)
+        yield Tick()
+        yield from drive(dut.retire)
+        yield from drive(dut.squash)
+        assert (yield from check(0, 0x40))[0] == 0
+        # The queue is empty
+        for rob in range(dut.size):
+            assert (yield from alloc(4 + rob, 0))[0]
+        assert not (yield from alloc(4 + dut.size, 0))[0]
+    dut = LoadQueue(4)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_load_replay():
+    """ The oldest ready uop is selected first. Dependents of a load are 
+    woken up speculatively, replayed when the load misses, and issued again
+    after the data arrives.
+    """
+    LOAD_PRD = 10
+    def dispatch(rob, op, ps1=0, rdy1=1):
+        yield from drive(iq.dispatch, en=1, rob=rob, ps1_rdy=rdy1, ps2_rdy=1)
+        yield iq.dispatch.uop.op.eq(op)
+        yield iq.dispatch.uop.ps1.eq(ps1)
+        yield Tick()
+        yield iq.dispatch.en.eq(0)
+    def select():
+        yield Settle()
+        if not (yield iq.select.vld):
+            return None
+        return (yield iq.select.rob), (yield iq.select.dep)
+    def proc():
+        yield iq.i_stall.eq(1)
+        yield from dispatch(3, Opcode.OP)
+        yield from dispatch(0, Opcode.LOAD)
+        yield from dispatch(1, Opcode.OP, ps1=LOAD_PRD, rdy1=0)
+        yield iq.i_stall.eq(0)
+
+        # The load issues first, and takes a speculative load slot
+        assert (yield from select()) == (0, 0)
+        yield from drive(lhp.issue, en=1, pc=0x100, prd=LOAD_PRD)
+        yield Settle()
+        assert (yield lhp.issue.spec)
+        slot = yield lhp.issue.slot
+        yield Tick()
+        yield from drive(lhp.issue)
+        assert (yield from select()) == (3, 0)
+        yield Tick()
+        # The dependent issues speculatively (when the load's data would be 
+        # available, if it hits)
+        for _ in range(PARAM.l1_hit_latency - 1):
+            yield Tick()
+        assert (yield from select()) == (1, 1 << slot)
+        yield Tick()
+        assert (yield from select()) is None
+        # The load misses: the dependent is replayed, and waits for the data
+        yield from drive(lhp.resolve, en=1, slot=slot, hit=0)
+        yield Tick()
+        yield from drive(lhp.resolve)
+        for _ in range(4):
+            assert (yield from select()) is None
+            yield Tick()
+        yield from drive(iq.wakeup, en=1, prd=LOAD_PRD)
+        yield Tick()
+        yield from drive(iq.wakeup)
+        assert (yield from select()) == (1, 0)
+        yield Tick()
+        yield Settle()
+        assert (yield iq.o_free) == iq.queue_size
+
+        # A wakeup that depends on a load being replayed is ignored
+        yield iq.i_stall.eq(1)
+        yield from dispatch(4, Opcode.OP, ps1=LOAD_PRD + 1, rdy1=0)
+        yield from drive(iq.wakeup, en=1, prd=LOAD_PRD + 1, dep=1 << slot)
+        yield from drive(lhp.resolve, en=1, slot=slot, hit=0)
+        yield Tick()
+        yield from drive(iq.wakeup)
+        yield from drive(lhp.resolve)
+        yield iq.i_stall.eq(0)
+        assert (yield from select()) is None
+
+        # Only one slot is woken up per cycle (the other one waits)
+        for s in range(2):
+            yield lhp.slot_vld[s].eq(1)
+            yield lhp.slot_prd[s].eq(20 + s)
+            yield lhp.slot_tmr[s].eq(1)
+        woken = []
+        for _ in range(3):
+            yield Settle()
+            if (yield lhp.spec_wakeup.en):
+                woken.append((yield lhp.spec_wakeup.prd))
+            yield Tick()
+        assert woken == [ 20, 21 ]
+
+    iq  = IssueUnit(4)
+    lhp = LoadHitPredictor(PARAM.lhp_size, PARAM.l1_hit_latency, 
+                           PARAM.spec_load_slots)
+    m = Module()
+    m.submodules.iq  = iq
+    m.submodules.lhp = lhp
+    m.d.comb += [
+        iq.spec_wakeup.eq(lhp.spec_wakeup),
+        iq.confirm.eq(lhp.confirm),
+        iq.replay.eq(lhp.replay),
+    ]
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_payload_ram():
+    """ Wakeup and select happen on separate cycles, and the rest of the uop
+    is read from the payload RAM on the cycle after select.
+    """
+    def dispatch(rob, prd, imm, ps1=0, rdy1=1):
+        yield from drive(iq.dispatch, en=1, rob=rob, ps1_rdy=rdy1, ps2_rdy=1)
+        yield iq.dispatch.uop.op.eq(Opcode.OP_IMM)
+        yield iq.dispatch.uop.prd.eq(prd)
+        yield iq.dispatch.uop.ps1.eq(ps1)
+        yield iq.dispatch.uop.imm.eq(imm)
+        yield Tick()
+        yield iq.dispatch.en.eq(0)
+    def state():
+        yield Settle()
+        sel = (yield iq.select.rob) if (yield iq.select.vld) else None
+        issue = None
+        if (yield iq.issue.vld):
+            issue = ((yield iq.issue.rob), (yield iq.issue.uop.prd),
+                     (yield iq.issue.uop.ps1), (yield iq.issue.uop.imm))
+        return sel, issue
+    def proc():
+        # Waiting for 'p9'
+        yield from dispatch(5, prd=7, imm=0x123, ps1=9, rdy1=0)
+        assert (yield from state()) == (None, None)
+        # A uop is selected on the cycle after dispatch, and issued (with its
+        # payload) on the cycle after that
+        yield from dispatch(2, prd=8, imm=0x456)
+        assert (yield from state()) == (2, None)
+        yield Tick()
+        # A uop woken up on this cycle is selected on the next cycle
+        yield from drive(iq.wakeup, en=1, prd=9)
+        assert (yield from state()) == (None, (2, 8, 0, 0x456))
+        yield Tick()
+        yield from drive(iq.wakeup)
+        assert (yield from state()) == (5, None)
+        yield Tick()
+        assert (yield from state()) == (None, (5, 7, 9, 0x123))
+
+    iq = IssueUnit(4)
+    sim = Simulator(iq)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_operand_capture():
+    """ Operand values are captured at dispatch (when they are available) or
+    from the writeback bus, and sent out with the issued uop.
+    """
+    if not PARAM.operand_capture:
+        return with_params("test_operand_capture", operand_capture=True)
+    def dispatch(rob, ps1, rdy1, data1, ps2=0, data2=0):
+        yield from drive(iq.dispatch, en=1, rob=rob, 
+                         ps1_rdy=rdy1, ps1_data=data1, 
+                         ps2_rdy=1, ps2_data=data2)
+        yield iq.dispatch.uop.op.eq(Opcode.OP)
+        yield iq.dispatch.uop.ps1.eq(ps1)
+        yield iq.dispatch.uop.ps2.eq(ps2)
+    def issued():
+        yield Settle()
+        if not (yield iq.issue.vld):
+            return None
+        return ((yield iq.issue.rob), (yield iq.issue.ps1_data), 
+                (yield iq.issue.ps2_data))
+    def proc():
+        # Both operands are available at dispatch
+        yield from dispatch(0, ps1=3, rdy1=1, data1=0x11, ps2=4, data2=0x22)
+        yield Tick()
+        yield iq.dispatch.en.eq(0)
+        yield Tick()
+        assert (yield from issued()) == (0, 0x11, 0x22)
+
+        # The first operand is captured when it is broadcast
+        yield from dispatch(1, ps1=9, rdy1=0, data1=0xdead)
+        yield Tick()
+        yield iq.dispatch.en.eq(0)
+        for _ in range(2):
+            yield Tick()
+            assert (yield from issued()) is None
+        yield from drive(iq.wakeup, en=1, prd=9)
+        yield from drive(iq.writeback, en=1, prd=9, data=0x99)
+        yield Tick()
+        yield from drive(iq.wakeup)
+        yield from drive(iq.writeback)
+        yield Tick()
+        assert (yield from issued()) == (1, 0x99, 0)
+
+        # The operand is written back on the same cycle as dispatch
+        yield from dispatch(2, ps1=10, rdy1=0, data1=0xdead)
+        yield from drive(iq.wakeup, en=1, prd=10)
+        yield from drive(iq.writeback, en=1, prd=10, data=0xaa)
+        yield Tick()
+        yield iq.dispatch.en.eq(0)
+        yield from drive(iq.wakeup)
+        yield from drive(iq.writeback)
+        yield Tick()
+        assert (yield from issued()) == (2, 0xaa, 0)
+
+    iq = IssueUnit(4)
+    sim = Simulator(iq)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_distributed_issue():
+    """ Uops are steered to the reservation station for their functional 
+    unit, and dispatch stalls when that station is full.
+    """
+    def dispatch(rob, op):
+        yield from drive(dut.dispatch, en=1, rob=rob, ps1_rdy=1, ps2_rdy=1)
+        yield dut.dispatch.uop.op.eq(op)
+        yield Settle()
+        ok = yield dut.dispatch.ok
+        yield Tick()
+        yield dut.dispatch.en.eq(0)
+        return ok
+    def free():
+        yield Settle()
+        res = []
+        for rs in dut.stations:
+            res.append((yield rs.o_free))
+        return res
+    def proc():
+        yield dut.i_stall.eq(0b1111)
+        # ALU uops alternate between the ALU stations (whichever has more
+        # free entries)
+        assert (yield from dispatch(0, Opcode.OP))
+        assert (yield from free()) == [ 1, 2, 2, 2 ]
+        assert (yield from dispatch(1, Opcode.OP_IMM))
+        assert (yield from free()) == [ 1, 1, 2, 2 ]
+        assert (yield from dispatch(2, Opcode.BRANCH))
+        assert (yield from dispatch(3, Opcode.LOAD))
+        assert (yield from dispatch(4, Opcode.STORE))
+        assert (yield from free()) == [ 1, 1, 1, 0 ]
+        # The LSU station is full, even though the others aren't
+        assert not (yield from dispatch(5, Opcode.LOAD))
+        assert (yield from free()) == [ 1, 1, 1, 0 ]
+        assert (yield from dispatch(5, Opcode.JAL))
+        assert (yield from free()) == [ 1, 1, 0, 0 ]
+        assert not (yield from dispatch(6, Opcode.JALR))
+
+        # Each station issues to its own port (the payload is read on the
+        # cycle after select)
+        yield dut.i_stall.eq(0b1000)
+        yield Tick()
+        yield dut.i_stall.eq(0b1111)
+        yield Settle()
+        issued = []
+        for port in dut.issue[:3]:
+            assert (yield port.vld)
+            issued.append(((yield port.rob), Opcode((yield port.uop.op))))
+        assert issued == [ (0, Opcode.OP), (1, Opcode.OP_IMM), 
+                           (2, Opcode.BRANCH) ]
+        assert not (yield dut.issue[3].vld)
+
+    dut = DistributedIssueUnit(2, 2, 2, 2)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_soc():
+    """ Data written by one core is visible to the other, and stays visible
+    after it's evicted from the private caches (and the L2).
+    """
+    def access(dc, addr, we=0, data=0):
+        # Retry until the access completes
+        while True:
+            yield dc.i_en.eq(1)
+            yield dc.i_we.eq(we)
+            yield dc.i_addr.eq(addr)
+            yield dc.i_data.eq(data)
+            yield Tick()
+            yield dc.i_en.eq(0)
+            yield Settle()
+            if (yield dc.o_vld):
+                return (yield dc.o_data)
+            yield Tick()
+
+    def proc():
+        d0, d1 = dut.dcache[0:2]
+        # Shared, then modified by the other core
+        yield from access(d0, 0x800, 1, 0x1234)
+        assert (yield from access(d1, 0x800)) == 0x1234
+        yield from access(d1, 0x800, 1, 0x5678)
+        assert (yield from access(d0, 0x800)) == 0x5678
+        # Conflicting lines evict modified lines from the L1 and the L2
+        l1_span = PARAM.l1d_lines * PARAM.line_words * 4
+        l2_span = PARAM.l2_lines * PARAM.line_words * 4
+        yield from access(d0, 0x804, 1, 0xaaaa)
+        yield from access(d0, 0x804 + l1_span, 1, 0xbbbb)
+        yield from access(d0, 0x804 + l2_span, 1, 0xcccc)
+        assert (yield from access(d1, 0x804)) == 0xaaaa
+        assert (yield from access(d1, 0x804 + l1_span)) == 0xbbbb
+        assert (yield from access(d1, 0x804 + l2_span)) == 0xcccc
+        # Both cores are fetching through their instruction caches
+        for ctr in dut.counters:
+            assert (yield ctr.uops) > 0 and (yield ctr.l1i_miss) > 0
+
+    dut = RVRESoC(image=[ 0x00108093 ] * 64, mem_depth=1024)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_stride_prefetcher():
+    def proc():
+        # A load walking through an array with a 24-byte stride
+        for idx in range(4):
+            yield dut.port.train.eq(1)
+            yield dut.port.train_pc.eq(0x100)
+            yield dut.port.train_addr.eq(0x2000 + 24 * idx)
+            yield Tick()
+        yield dut.port.train.eq(0)
+        yield dut.port.pf_ready.eq(1)
+        yield Settle()
+        for idx in range(DEGREE):
+            assert (yield dut.port.pf)
+            assert (yield dut.port.pf_addr) == 0x2000 + 24 * (3 + DISTANCE + idx)
+            yield Tick()
+            yield Settle()
+        assert not (yield dut.port.pf)
+
+    DEGREE, DISTANCE = 2, 2
+    dut = StridePrefetcher(16, DEGREE, DISTANCE, 64)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_next_line_prefetcher():
+    """ Moving into a new line prefetches the next 'degree' lines (starting
+    'distance' lines ahead).
+    """
+    def train(addr):
+        yield dut.port.train.eq(1)
+        yield dut.port.train_addr.eq(addr)
+        yield Tick()
+        yield dut.port.train.eq(0)
+    def prefetches():
+        res = []
+        for _ in range(DEGREE + 2):
+            yield Settle()
+            if (yield dut.port.pf):
+                res.append((yield dut.port.pf_addr))
+            yield Tick()
+        return res
+    def proc():
+        yield dut.port.pf_ready.eq(1)
+        yield from train(0x1004)
+        assert (yield from prefetches()) == [ 0x1020, 0x1030 ]
+        # More accesses to the same line don't trigger it again
+        yield from train(0x1008)
+        assert (yield from prefetches()) == []
+        yield from train(0x1010)
+        assert (yield from prefetches()) == [ 0x1030, 0x1040 ]
+        # Prefetches are held until the cache is ready
+        yield dut.port.pf_ready.eq(0)
+        yield from train(0x2000)
+        for _ in range(3):
+            yield Tick()
+        yield dut.port.pf_ready.eq(1)
+        assert (yield from prefetches()) == [ 0x2020, 0x2030 ]
+
+    DEGREE, DISTANCE = 2, 2
+    dut = NextLinePrefetcher(4, DEGREE, DISTANCE, 64)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_prefetch_throttle():
+    """ The degree goes down when prefetches aren't useful, and back up when 
+    they are.
+    """
+    def interval(issued, useful):
+        for idx in range(max(issued, useful)):
+            yield dut.i_issued.eq(idx < issued)
+            yield dut.i_useful.eq(idx < useful)
+            yield Tick()
+        yield dut.i_issued.eq(0)
+        yield dut.i_useful.eq(0)
+        yield dut.i_trigger.eq(1)
+        for _ in range(INTERVAL):
+            yield Tick()
+        yield dut.i_trigger.eq(0)
+        yield Settle()
+        return (yield dut.o_degree)
+    def proc():
+        assert (yield dut.o_degree) == MAX_DEGREE
+        # Less than a quarter useful
+        for degree in reversed(range(MAX_DEGREE)):
+            assert (yield from interval(8, 1)) == degree
+        # Turned back on after the next interval
+        assert (yield from interval(0, 0)) == 1
+        # Between a quarter and three quarters useful
+        assert (yield from interval(8, 2)) == 1
+        assert (yield from interval(8, 5)) == 1
+        # At least three quarters useful
+        for degree in range(2, MAX_DEGREE + 1):
+            assert (yield from interval(8, 6)) == degree
+        assert (yield from interval(8, 8)) == MAX_DEGREE
+
+    MAX_DEGREE, INTERVAL = 3, 4
+    dut = PrefetchThrottle(MAX_DEGREE, INTERVAL)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+def test_l1_hit_under_fill():
+    """ While a prefetched line is being filled, accesses to other lines 
+    still hit (with the right data), and accesses to that line are 
+    rejected until it arrives.
+    """
+    def line(base):
+        return sum((base + idx) << (32 * idx) for idx in range(4))
+    def access(addr):
+        yield dut.i_en.eq(1)
+        yield dut.i_addr.eq(addr)
+        yield Tick()
+        yield dut.i_en.eq(0)
+        yield Settle()
+        return (yield dut.o_vld), (yield dut.o_data)
+    def respond(data):
+        yield Settle()
+        assert (yield dut.port.req)
+        addr = yield dut.port.req_addr
+        yield dut.port.resp.eq(1)
+        yield dut.port.resp_data.eq(data)
+        yield Tick()
+        yield dut.port.resp.eq(0)
+        yield Tick()
+        return addr
+    def proc():
+        # Fill the line at 0x40 (on a miss)
+        assert not (yield from access(0x44))[0]
+        yield Tick()
+        assert (yield from respond(line(0x100))) == 0x40
+        # A hit trains the prefetcher, which starts filling the next line
+        assert (yield from access(0x44)) == (1, 0x101)
+        for _ in range(3):
+            yield Tick()
+            yield Settle()
+            if (yield dut.port.req):
+                break
+        assert (yield dut.port.req_addr) == 0x50
+        # Hit under the fill
+        assert (yield from access(0x48)) == (1, 0x102)
+        assert (yield from access(0x4c)) == (1, 0x103)
+        assert not (yield from access(0x54))[0]
+        assert (yield from respond(line(0x200))) == 0x50
+        assert (yield from access(0x54)) == (1, 0x201)
+        assert (yield dut.o_useful)
+        assert (yield from access(0x40)) == (1, 0x100)
+
+    dut = L1Cache(4, 4, NextLinePrefetcher(4, 1, 1, 64))
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
 
 
 def dump_verilog():
@@ -184,13 +1494,130 @@ def dump_verilog():
 
 
 
+# Assumptions about the machine that aren't in 'RVREParams' (yet)
+FETCH_WIDTH        = 1 # Instructions fetched/decoded/renamed per cycle
+ALU_LATENCY        = 1
+REDIRECT_PENALTY   = 2 # Fetch bubbles after a correctly-predicted taken branch
+MISPREDICT_PENALTY = 8 # Cycles lost after a mispredicted branch
+
+# Per-iteration characteristics of the main loop in each of the kernels in
+# 'fw/kernels' (see the comments in each source file). 'chain' is the 
+# latency of the loop-carried dependence chain.
+KERNELS = {
+    "dep_chain": dict(insts=18, alu=17, bru=1, lsu=0, taken=1, mispredict=0,
+        chain=lambda p: 16 * ALU_LATENCY),
+    "indep_alu": dict(insts=18, alu=17, bru=1, lsu=0, taken=1, mispredict=0,
+        chain=lambda p: 2 * ALU_LATENCY),
+    "branch_loop": dict(insts=2, alu=1, bru=1, lsu=0, taken=1, mispredict=0,
+        chain=lambda p: ALU_LATENCY),
+    "data_branch": dict(insts=10.5, alu=8.5, bru=2, lsu=0, taken=1.5, 
+        mispredict=0.5, chain=lambda p: 6 * ALU_LATENCY),
+    "pointer_chase": dict(insts=10, alu=1, bru=1, lsu=8, taken=1, 
+        mispredict=0, chain=lambda p: 8 * p.l1_hit_latency),
+    "memcpy": dict(insts=12, alu=3, bru=1, lsu=8, taken=1, mispredict=0,
+        chain=lambda p: ALU_LATENCY),
+    "store_load": dict(insts=5, alu=2, bru=1, lsu=2, taken=1, mispredict=0,
+        chain=lambda p: 2 * p.l1_hit_latency + ALU_LATENCY),
+    "rename_pressure": dict(insts=98, alu=73, bru=1, lsu=24, taken=1,
+        mispredict=0, chain=lambda p: 24 * p.l1_hit_latency),
+}
+
+def ipc_ceiling(kernel, p):
+    """ Return the best IPC we could expect for a kernel, given parameters 'p'.
+    The main loop takes at least as many cycles as the most-constrained 
+    resource (front-end bandwidth, functional units, the loop-carried 
+    dependence chain, or the instruction window) needs, plus the cost of 
+    mispredicted branches.
+    """
+    k = KERNELS[kernel]
+    chain  = k["chain"](p)
+    # Instructions behind the oldest one can only be held in the window
+    # until it completes (Little's law)
+    window = min(p.rob_size, p.prf_size - p.arf_size)
+    cycles = max(
+        k["insts"] / FETCH_WIDTH + k["taken"] * REDIRECT_PENALTY,
+        k["alu"] / p.rs_alu_count,
+        k["bru"],
+        k["lsu"],
+        chain,
+        k["insts"] * chain / window,
+    ) + k["mispredict"] * MISPREDICT_PENALTY
+    return k["insts"] / cycles
+
+def run_kernel(kernel, cycles):
+    """ Run a kernel on the core and return the number of instructions that
+    were renamed (a fused uop counts as two instructions).
+    """
+    res = 0
+    def proc():
+        nonlocal res
+        for cycle in range(cycles):
+            yield Settle()
+            if (yield dut.r_uop_vld):
+                fuse = yield dut.r_uop.fuse
+                res += 1 if FuseOp(fuse) == FuseOp.NONE else 2
+            yield Tick()
+    dut = RVRECore(rom_data=read_rom("fw/kernels/{}.bin".format(kernel)))
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+    return res
+
+def bench_kernels(cycles=2000):
+    """ Build and run all of the kernels, and compare the measured IPC with
+    the expected ceiling for the current parameters.
+    NOTE: The core doesn't execute branches (or anything else) yet, so the 
+    measured IPC is only the front-end throughput.
+    """
+    import subprocess
+    subprocess.run([ "make", "-C", "fw" ], check=True)
+    fmt = "{:<16} {:>8} {:>8} {:>6}"
+    print(fmt.format("kernel", "IPC", "ceiling", "ratio"))
+    for kernel in KERNELS:
+        ipc  = run_kernel(kernel, cycles) / cycles
+        ceil = ipc_ceiling(kernel, PARAM)
+        print(fmt.format(kernel, "{:.3f}".format(ipc), 
+                         "{:.3f}".format(ceil), "{:.2f}".format(ipc / ceil)))
+
+
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == [ "bench" ]:
+        bench_kernels()
+        sys.exit(0)
+
     test_cam()
     #test_register_file()
     test_fetch_unit()
     test_alu()
     test_decoder_from_rom()
+    test_fusion()
+    test_rvc_expander()
+    test_fetch_aligner()
     test_core()
+    test_state_load()
+    test_move_elim()
+    test_ref_table()
+    test_uop_cache()
+    test_decode_redirect()
+    test_rvc_fusion()
+    test_waveform_tracer()
+    test_pipe_trace()
+    test_icount_select()
+    test_smt()
+    test_iss()
+    test_store_sets()
+    test_load_queue()
+    test_load_replay()
+    test_payload_ram()
+    test_operand_capture()
+    test_distributed_issue()
+    test_soc()
+    test_stride_prefetcher()
+    test_next_line_prefetcher()
+    test_prefetch_throttle()
+    test_l1_hit_under_fill()
 
     dump_verilog()
 